@@ -0,0 +1,165 @@
+#! /usr/bin/env python
+"""
+ORM BENCHMARK
+=============
+
+Measures the mappers in `sql` on a scratch copy of the `price` table, 600k rows
+by default (as big as a full rebuild makes it): rows loaded per second by
+`all()` and `filter()`, along with the old dict-per-row loading for
+comparison, and calls per second of `get()` by ID and `count()`.
+
+Each case reports operations (rows, or calls) per second, best of several
+runs. The results can be written out as JSON, and compared against an earlier
+such file to show regressions:
+
+    python bench_orm.py [--quick] [--rows N] [--json results.json]
+                        [--compare old.json]
+"""
+
+import os
+import sys
+import json
+import time
+import sqlite3
+import tempfile
+import platform
+from collections import OrderedDict
+
+import sql
+from sql import BaseMapper, VarChar, Integer, get_cursor, connection
+
+
+# Distinct items in the table, each with rows / ITEMS rows
+ITEMS = 600
+
+
+class Price(BaseMapper):
+    tablename = 'price'
+    columns = (VarChar('item', 40), Integer('quantity'), Integer('price'))
+
+
+class LegacyRow(object):
+
+    """
+    The per-row work of the dict-based `BaseMapper` this benchmark is measured
+    against: a converted row, a property rebuilt for every column, and a
+    prefixed attribute per value.
+    """
+
+    def __init__(self, row):
+        cols = row.keys()
+        self._all_cols = list(cols)
+        self._in_db = 'id' in cols
+        for col in cols:
+            mcol = '_col_' + col
+            setattr(LegacyRow, col,
+                    property(lambda self, mcol=mcol: getattr(self, mcol)))
+        for col in cols:
+            setattr(self, '_col_' + col, row[col])
+
+
+def populate(path, rows):
+    def connector():
+        conn = sqlite3.connect(path, check_same_thread=False)
+        conn.text_factory = str
+        return conn
+    sql.init(connector, sqlite3.Row)
+    sql.initialize_database([Price])
+    with connection(commit=True) as conn:
+        conn.executemany(
+          'insert into price(item, quantity, price) values (?, ?, ?)',
+          (('item %d' % (i % ITEMS), i % 50 + 1, i % 9000 + 1)
+           for i in range(rows)))
+
+
+### Timing
+
+def best(func, repeat):
+    """
+    Run `func` `repeat` times. It returns the number of operations it did;
+    gives the best operations per second.
+    """
+    rates = []
+    for i in range(repeat):
+        start = time.time()
+        ops = func()
+        rates.append(ops / max(time.time() - start, 1e-9))
+    return max(rates)
+
+
+def cases(rows, quick=False):
+    """
+    Generate the (name, `best()` case) pairs of the suite.
+    """
+    number = 500 if quick else 5000
+
+    def all_rows():
+        return sum(1 for row in Price.all())
+    yield 'all', all_rows
+
+    def all_legacy():
+        curs = get_cursor().execute('select * from price')
+        count = 0
+        for row in curs:
+            LegacyRow(sqlite3.Row(curs, row))
+            count += 1
+        return count
+    yield 'all/legacy', all_legacy
+
+    def filter_rows():
+        return sum(1 for i in range(5)
+                   for row in Price.filter(item='item %d' % i))
+    yield 'filter', filter_rows
+
+    def get_by_id():
+        for i in range(number):
+            Price.get(id=i % rows + 1)
+        return number
+    yield 'get/id', get_by_id
+
+    def count_rows():
+        for i in range(number // 100 or 1):
+            Price.count()
+        return number // 100 or 1
+    yield 'count', count_rows
+
+
+def main(args):
+    quick = '--quick' in args
+    repeat = 2 if quick else 3
+    rows = int(args[args.index('--rows') + 1]) if '--rows' in args else \
+      (60000 if quick else 600000)
+
+    fd, path = tempfile.mkstemp(suffix='.sqlite')
+    os.close(fd)
+    try:
+        start = time.time()
+        populate(path, rows)
+        print('%d rows written in %.1fs\n' % (rows, time.time() - start))
+
+        results = OrderedDict()
+        with connection():
+            for name, case in cases(rows, quick):
+                results[name] = rate = best(case, repeat)
+                print('%-32s %14.0f ops/s' % (name, rate))
+    finally:
+        os.remove(path)
+
+    if '--compare' in args:
+        with open(args[args.index('--compare') + 1]) as f:
+            old = json.load(f)['results']
+        print('\n%-32s %8s' % ('change against ' + f.name, ''))
+        for name, rate in results.items():
+            if name in old:
+                print('%-32s %+7.1f%%' % (name, 100. * rate / old[name] - 100))
+
+    if '--json' in args:
+        with open(args[args.index('--json') + 1], 'w') as f:
+            json.dump(dict(python=platform.python_version(),
+                           platform=platform.platform(), time=time.time(),
+                           rows=rows, quick=quick, results=results),
+                      f, indent=2)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,211 @@
+#! /usr/bin/env python
+"""
+WIRE BENCHMARK
+==============
+
+Measures the codec in `wire`: `PacketBuffer` framing of fixed- and
+variable-length packets in bursts of 1k to 100k packets, fed one `recv()`
+worth at a time or as one whole burst (along with the old copy-per-packet
+string buffer, for comparison, which is quadratic in the size of a whole
+burst), `PacketIn.parse()` for every packet type the bot decodes, `PacketOut`
+construction for the chat packets, and coordinate packing.
+
+Each case reports operations per second, best of several runs. The results can
+be written out as JSON, and compared against an earlier such file to show
+regressions:
+
+    python bench_wire.py [--quick] [--json results.json] [--compare old.json]
+"""
+
+import sys
+import json
+import time
+import struct
+import socket
+import platform
+from collections import OrderedDict
+
+from wire import *
+from wire import packet_lengths, pack, unpack
+
+
+class LegacyPacketBuffer(object):
+
+    """
+    The string-concatenating `PacketBuffer` this benchmark is measured against.
+    """
+
+    def __init__(self):
+        self.buff = ''
+
+    def feed(self, data):
+        self.buff += data
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if len(self.buff) < 2:
+            raise StopIteration
+
+        pkttype = struct.unpack('<H', self.buff[:2])[0]
+        if packet_lengths[pkttype] < 0:
+            if len(self.buff) < 4:
+                raise StopIteration
+            pktlen = struct.unpack('<H', self.buff[2:4])[0]
+        else:
+            pktlen = packet_lengths[pkttype]
+
+        if len(self.buff) < pktlen:
+            raise StopIteration
+        packet = self.buff[:pktlen]
+        self.buff = self.buff[pktlen:]
+        return PacketIn(packet)
+    __next__ = next
+
+
+### Sample traffic
+
+def norm_msg(i):
+    msg = 'Player%d : %s\0' % (i % 50, 'x' * (i % 60))
+    return struct.pack('<HHL', S_NORM_MSG, len(msg) + 8, i) + msg
+
+
+def emote(i):
+    return struct.pack('<HLB', S_EMOTE, i, i % 12)
+
+
+def make_burst(count, variable=True):
+    """
+    Build `count` packets as one string: S_NORM_MSG of varying length if
+    `variable`, otherwise S_EMOTE.
+    """
+    make = norm_msg if variable else emote
+    return ''.join(make(i) for i in range(count))
+
+
+# One of each packet type with a schema, as the server would send it
+SAMPLES = OrderedDict([
+  ('S_NORM_MSG', norm_msg(30)),
+  ('S_WHISPER', struct.pack('<HH24s', S_WHISPER, 34, 'Someone') + 'hello\0'),
+  ('S_OTHER_MSG', struct.pack('<HH', S_OTHER_MSG, 14) + 'Restart!\0\0'),
+  ('S_EMOTE', emote(3)),
+  ('S_NAME_RES', struct.pack('<HL24s', S_NAME_RES, 150000, 'Someone')),
+  ('S_NAME_RES2', struct.pack('<HHL', S_NAME_RES2, 16, 150000) + 'Someone\0'),
+  ('S_REMOVE', struct.pack('<HLB', S_REMOVE, 150000, 1)),
+  ('S_PING', struct.pack('<HL', S_PING, 123456)),
+  ('S_CONNECTED', struct.pack('<HLBBB2x', S_CONNECTED, 0, *pack(50, 50, 4))),
+  ('S_CSERV', struct.pack('<HHLLL30xB4sH', S_CSERV, 53, 1, 2, 3, 0,
+                          socket.inet_aton('127.0.0.1'), 6122)),
+  ('S_MSERV', struct.pack('<HL16s4sH', S_MSERV, 150000, 'map.gat',
+                          socket.inet_aton('127.0.0.1'), 5122)),
+])
+
+
+# Packets per framing burst, and the largest whole burst the legacy buffer
+# is timed on (about 6s a run)
+BURSTS = (1000, 10000, 50000, 100000)
+LEGACY_WHOLE_CAP = 50000
+
+
+### Timing
+
+def best(func, repeat):
+    """
+    Run `func` `repeat` times. It returns the number of operations it did;
+    gives the best operations per second.
+    """
+    rates = []
+    for i in range(repeat):
+        start = time.time()
+        ops = func()
+        rates.append(ops / max(time.time() - start, 1e-9))
+    return max(rates)
+
+
+def loop(func, args, number):
+    """
+    Make a `best()` case calling `func(*args)` `number` times.
+    """
+    def case():
+        for i in xrange(number):
+            func(*args)
+        return number
+    return case
+
+
+def frame(cls, burst, chunk):
+    """
+    Make a `best()` case feeding `burst` into a new `cls` buffer `chunk` bytes
+    at a time, as `recv()` would, and framing every packet.
+    """
+    def case():
+        buff = cls()
+        count = 0
+        for pos in range(0, len(burst), chunk):
+            buff.feed(burst[pos:pos + chunk])
+            for packet in buff:
+                count += 1
+        return count
+    return case
+
+
+def cases(quick=False):
+    """
+    Generate the (name, `best()` case) pairs of the suite.
+    """
+    sizes = BURSTS[:2] if quick else BURSTS
+    number = 2000 if quick else 50000
+
+    for variable in (False, True):
+        kind = 'variable' if variable else 'fixed'
+        for size in sizes:
+            burst = make_burst(size, variable)
+            for chunk, how in ((2024, 'sliced'), (len(burst), 'whole')):
+                name = 'frame/%s/%s/%s' % (kind, size, how)
+                yield name, frame(PacketBuffer, burst, chunk)
+                # Whole bursts are quadratic for the legacy buffer; past the
+                # cap, one run takes longer than the rest of the suite
+                if how == 'sliced' or size <= LEGACY_WHOLE_CAP:
+                    yield (name + '/legacy',
+                           frame(LegacyPacketBuffer, burst, chunk))
+
+    for name, data in SAMPLES.items():
+        packet = PacketIn(data)
+        assert packet.parse() is not None, name
+        yield 'parse/%s' % name, loop(packet.parse, (), number)
+
+    yield 'out/C_WHISPER', loop(PacketOut, (C_WHISPER, 'Someone', 'x' * 40),
+                                number)
+    yield 'out/C_MSG', loop(PacketOut, (C_MSG, 'Bot : ' + 'x' * 40), number)
+
+    yield 'coords/pack', loop(pack, (50, 60, 4), number)
+    yield 'coords/unpack', loop(unpack, pack(50, 60, 4), number)
+
+
+def main(args):
+    quick = '--quick' in args
+    repeat = 3 if quick else 5
+    results = OrderedDict()
+    for name, case in cases(quick):
+        results[name] = rate = best(case, repeat)
+        print('%-36s %14.0f ops/s' % (name, rate))
+
+    if '--compare' in args:
+        with open(args[args.index('--compare') + 1]) as f:
+            old = json.load(f)['results']
+        print('\n%-36s %8s' % ('change against ' + f.name, ''))
+        for name, rate in results.items():
+            if name in old:
+                print('%-36s %+7.1f%%' % (name, 100. * rate / old[name] - 100))
+
+    if '--json' in args:
+        with open(args[args.index('--json') + 1], 'w') as f:
+            json.dump(dict(python=platform.python_version(),
+                           platform=platform.platform(),
+                           time=time.time(), quick=quick, results=results),
+                      f, indent=2)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
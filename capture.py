@@ -0,0 +1,204 @@
+#! /usr/bin/env python
+"""
+LOF BOT CAPTURE
+===============
+
+This module provides a compact binary format for recording packet traffic. A
+capture is the 8-byte header `LOFCAP1\\n` followed by one record per packet:
+
+    <d   timestamp (seconds since the epoch)
+     B   direction (0 = in-coming, 1 = out-going)
+     H   payload length
+         payload (the whole packet, ID included)
+
+The packet log, which gathers the packets of every bot, is the same with the
+header `LOFPKT1\\n` and the account name added to each record:
+
+    <d   timestamp
+     B   direction
+     B   account name length
+     H   payload length
+         account name
+         payload
+
+Run it directly to list the packets in captures and packet logs, gzipped or
+not, optionally only those of one account or of some packet types (by name or
+hexadecimal ID):
+
+    python capture.py [--account NAME] [--packet S_WHISPER,0x0095 ...] FILE...
+"""
+
+import os
+import sys
+import gzip
+import time
+import struct
+
+from taskit.threaded import allocate_lock
+
+from wire import PACKET_NAMES
+
+
+__all__ = ['CaptureWriter', 'read_capture', 'open_capture', 'read_records', 
+           'pack_log_record', 'IN', 'OUT', 'MAGIC', 'LOG_MAGIC']
+
+
+MAGIC = b'LOFCAP1\n'
+LOG_MAGIC = b'LOFPKT1\n'
+IN = 0
+OUT = 1
+
+_record = struct.Struct('<dBH')
+_log_record = struct.Struct('<dBBH')
+
+
+class CaptureWriter(object):
+
+    """
+    Appends packet records to a file. Thread-safe; records written after
+    `close()` are dropped.
+    """
+
+    def __init__(self, fobj):
+        self.fobj = fobj
+        self.lock = allocate_lock()
+        self.count = 0
+        self.closed = False
+
+    def write(self, direction, data, timestamp=None):
+        """
+        Record packet `data` (a string, bytearray or memoryview).
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        head = _record.pack(timestamp, direction, len(data))
+        with self.lock:
+            if self.closed:
+                return
+            self.fobj.write(head)
+            self.fobj.write(data)
+            self.count += 1
+
+    def flush(self):
+        with self.lock:
+            if not self.closed:
+                self.fobj.flush()
+
+    def close(self):
+        with self.lock:
+            if not self.closed:
+                self.closed = True
+                self.fobj.close()
+
+
+def open_capture(path):
+    """
+    Open a `CaptureWriter` appending to the capture at `path`, starting it if
+    it does not exist yet.
+    """
+    new = not os.path.exists(path) or not os.path.getsize(path)
+    fobj = open(path, 'ab')
+    if new:
+        fobj.write(MAGIC)
+    return CaptureWriter(fobj)
+
+
+def read_capture(fobj):
+    """
+    Iterate over the (timestamp, direction, data) records in capture file
+    `fobj`. A record cut short at the end (by a crash, say) is ignored.
+    """
+    if fobj.read(len(MAGIC)) != MAGIC:
+        raise ValueError('Not a LoF bot capture!')
+
+    size = _record.size
+    while True:
+        head = fobj.read(size)
+        if len(head) < size:
+            return
+        timestamp, direction, length = _record.unpack(head)
+        data = fobj.read(length)
+        if len(data) < length:
+            return
+        yield timestamp, direction, data
+
+
+def pack_log_record(timestamp, direction, account, data):
+    """
+    Build a packet log record, as a string.
+    """
+    if isinstance(account, type(u'')):
+        account = account.encode('utf-8')
+    account = account[:255]
+    return (_log_record.pack(timestamp, direction, len(account), len(data)) + 
+            account + data)
+
+
+def read_records(fobj):
+    """
+    Iterate over the (timestamp, direction, account, data) records in capture 
+    or packet log file `fobj`. Captures have no account; it is None.
+    """
+    magic = fobj.read(len(MAGIC))
+    if magic == MAGIC:
+        fobj.seek(0)
+        for timestamp, direction, data in read_capture(fobj):
+            yield timestamp, direction, None, data
+        return
+    if magic != LOG_MAGIC:
+        raise ValueError('Not a LoF bot capture or packet log!')
+
+    size = _log_record.size
+    while True:
+        head = fobj.read(size)
+        if len(head) < size:
+            return
+        timestamp, direction, name_length, length = _log_record.unpack(head)
+        account = fobj.read(name_length)
+        data = fobj.read(length)
+        if len(data) < length:
+            return
+        yield timestamp, direction, account, data
+
+
+def describe(timestamp, direction, data, account=None):
+    """
+    Format a record as one line of text.
+    """
+    pid = struct.unpack('<H', data[:2])[0]
+    name = PACKET_NAMES.get(pid, '%04x' % pid)
+    stamp = time.strftime('%H:%M:%S', time.localtime(timestamp))
+    return '%s.%03d %s%s %-22s %s' % (
+      stamp, (timestamp % 1) * 1000, 
+      '' if account is None else account.ljust(15) + ' ', '<>'[direction], 
+      name, ' '.join('%02x' % b for b in bytearray(data)))
+
+
+def main(args):
+    account = None
+    packets = None
+    paths = []
+    args = iter(args)
+    for arg in args:
+        if arg == '--account':
+            account = next(args)
+        elif arg == '--packet':
+            names = dict((v, k) for k, v in PACKET_NAMES.items())
+            packets = set(names[p] if p in names else int(p, 16) 
+                          for p in next(args).split(','))
+        else:
+            paths.append(arg)
+
+    for path in paths:
+        with (gzip.open if path.endswith('.gz') else open)(path, 'rb') as f:
+            for timestamp, direction, name, data in read_records(f):
+                if account is not None and name != account:
+                    continue
+                if (packets is not None and 
+                    struct.unpack('<H', data[:2])[0] not in packets):
+                    continue
+                print(describe(timestamp, direction, data, name))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -7,9 +7,22 @@ This module provides the mod_command inteface for LoF bot.
 
 import string
 import sys
+import time
 
 from taskit.log import ERROR
 
+from scheduler import Job
+import metrics
+import profiler
+
+
+COMMAND_SECONDS = metrics.histogram('lofbot_command_seconds', 
+                                    'Command run times, by command', 
+                                    'command')
+COMMAND_ERRORS = metrics.counter('lofbot_command_errors_total', 
+                                 'Commands that failed, by command', 
+                                 'command')
+
 
 class MissingRequirementsError(Exception):
 
@@ -60,10 +73,20 @@ def evaluate(client, nick, msg):
     if not cmd in client.command_db:
         return client.cb_404(client, nick, cmd)
 
+    watchdog = profiler.WATCHDOG
+    token = watchdog.begin(cmd, watchdog.command_budget)
+    start = time.time()
     try:
         return client.command_db[cmd](client, nick, crawler)
     except ValueError as e:
+        COMMAND_ERRORS[cmd].inc()
         return 'Error! -- ' + (e.message or 'unknown cause')
+    except Exception:
+        COMMAND_ERRORS[cmd].inc()
+        raise
+    finally:
+        COMMAND_SECONDS[cmd].observe(time.time() - start)
+        watchdog.end(token)
 
 
 def parse_help(func):
@@ -134,8 +157,14 @@ def setup_commands(bot):
             # Optional filters are loaded and added to the list
             add_optional(bot.filters, 'filters')
 
-            # Ditto for time-cycle callbacks
-            add_optional(bot.periodic_cbs, 'periodic')
+            # Time-cycle callbacks are similar, but may come with options
+            for entry in getattr(m, 'periodic', ()):
+                if isinstance(entry, str):
+                    entry = (entry, {})
+                name, options = entry
+                options = dict(dict(interval=bot.period), **options)
+                bot.periodic_cbs.append(
+                  Job('%s.%s' % (mod, name), getattr(m, name), **options))
 
             # Handlers are the same, but structured as a dict with
             # "type": "single function-name" items
@@ -159,6 +188,10 @@ def setup_commands(bot):
     if missing:
         raise MissingRequirementsError(missing)
 
+    # The unknown-packet handlers and periodic callbacks may have changed
+    bot.update_subscriptions()
+    bot.update_schedule()
+
     # And now for the post-install triggers.
     for mod, m in bot.installed_mods.items():
         post = getattr(m, 'post_prepare', None)
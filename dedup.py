@@ -0,0 +1,62 @@
+"""
+LOF BOT DEDUPLICATION
+=====================
+
+This module provides the time window used to drop repeat observations of the
+same chat line, as happens when the master and slaves stand within earshot of
+the same speaker.
+"""
+
+import time
+from collections import OrderedDict
+
+from taskit.threaded import allocate_lock
+
+
+__all__ = ['DedupWindow']
+
+
+class DedupWindow(object):
+
+    """
+    Remembers (being ID, message hash) pairs for `window` seconds, and at most
+    `size` of them at a time, oldest evicted first.
+    """
+
+    def __init__(self, window=2., size=1024):
+        self.window = window
+        self.size = size
+        # key -> time first seen, in the order seen
+        self.seen = OrderedDict()
+        self.lock = allocate_lock()
+        self.hits = self.misses = 0
+
+    def check(self, being_id, msg):
+        """
+        Record an observation of `being_id` saying `msg`. Returns True if it
+        is the first within the window, False if it is a duplicate.
+        """
+        key = (being_id, hash(msg))
+        now = time.time()
+        seen = self.seen
+        with self.lock:
+            horizon = now - self.window
+            while seen and (len(seen) >= self.size or
+                            seen[next(iter(seen))] < horizon):
+                seen.popitem(last=False)
+
+            if key in seen:
+                self.hits += 1
+                return False
+            seen[key] = now
+            self.misses += 1
+            return True
+
+    def stats(self):
+        """
+        Get a dict of the duplicates dropped, the lines let through, the hit
+        rate, and the number of entries held.
+        """
+        total = self.hits + self.misses
+        return dict(hits=self.hits, misses=self.misses, size=len(self.seen),
+                    rate=float(self.hits) / total if total else 0.)
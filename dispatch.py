@@ -0,0 +1,165 @@
+"""
+LOF BOT DISPATCH
+================
+
+This module provides the bounded worker pool that in-coming packets are handled
+on, in place of a new thread per packet.
+"""
+
+import sys
+import struct
+
+try:
+    from Queue import Queue, Full
+except ImportError:
+    from queue import Queue, Full
+
+from taskit.threaded import threaded
+
+from wire import S_NORM_MSG, S_EMOTE, S_REMOVE, S_NAME_RES, S_NAME_RES2, \
+                 S_WHISPER
+
+
+__all__ = ['Dispatcher', 'being_key']
+
+
+_uint32 = struct.Struct('<L')
+
+# Where the being ID sits in the packets that have one
+_being_offsets = {S_NORM_MSG: 4, S_EMOTE: 2, S_REMOVE: 2, S_NAME_RES: 2,
+                  S_NAME_RES2: 4}
+
+
+def being_key(packet):
+    """
+    Get the being (or, for whispers, the nick) that `packet` concerns, without
+    parsing it. Packets concerning no being fall back to their type.
+    """
+    pid = packet.packet_id
+    if pid == S_WHISPER:
+        return packet.data[4:28].tobytes()
+    offset = _being_offsets.get(pid)
+    if offset is None:
+        return pid
+    return _uint32.unpack_from(packet.data, offset)[0]
+
+
+class Dispatcher(object):
+
+    """
+    A fixed pool of worker threads handling packets off bounded queues. Each
+    worker has its own queue, and packets are sharded between them by
+    connection and an ordering key, so that packets sharing both are handled
+    in the order they were received.
+
+    When a queue is full, the overload policy decides: 'block' makes the
+    receiving connection wait, which pushes back on `recv()` and so on the
+    server; 'shed' drops relay traffic (which can be lost without anyone
+    waiting on it) and waits for everything else. Neither may ever block the
+    reactor, which every bot shares: there, packets are submitted without
+    `block`, and a connection whose packet finds no room stops reading until
+    there is some, which pushes back on that connection alone.
+    """
+
+    # Packets which only feed the relay, and so may be shed under load
+    sheddable = frozenset([S_NORM_MSG, S_EMOTE])
+
+    def __init__(self, workers=4, queue=512, order='being', overload='shed'):
+        """
+        workers  -- The number of worker threads.
+        queue    -- The total number of packets that may wait, split evenly
+                    between the workers.
+        order    -- 'being' to keep packets about the same being in order,
+                    'type' to keep packets of the same type in order, or None
+                    to spread packets evenly with no ordering at all.
+        overload -- 'shed' or 'block'; see above.
+        """
+        if order not in ('being', 'type', None):
+            raise ValueError('Unknown ordering %r!' % order)
+        if overload not in ('shed', 'block'):
+            raise ValueError('Unknown overload policy %r!' % overload)
+
+        self.order = order
+        self.overload = overload
+        size = max(1, queue // workers)
+        self.queues = [Queue(size) for i in range(workers)]
+        # One counter per worker, so that no locking is needed
+        self.handled = [0] * workers
+        self.dropped = {}
+        self.peak = 0
+        self._turn = 0
+
+        for i in range(workers):
+            threaded(self._work, (i,))
+
+    def _work(self, i):
+        queue = self.queues[i]
+        handled = self.handled
+        while True:
+            item = queue.get()
+            if item is None:
+                break
+            func, args = item
+            try:
+                func(*args)
+            except Exception:
+                sys.excepthook(*sys.exc_info())
+            handled[i] += 1
+
+    def _pick(self, client, packet):
+        if self.order == 'being':
+            key = (id(client), being_key(packet))
+        elif self.order == 'type':
+            key = (id(client), packet.packet_id)
+        else:
+            key = self._turn = self._turn + 1
+        return self.queues[hash(key) % len(self.queues)]
+
+    def submit(self, client, packet, block=True):
+        """
+        Queue `packet` to be handled by `client`. Returns False if it was shed.
+        Without `block`, raises `Full` instead of waiting for room.
+        """
+        queue = self._pick(client, packet)
+        item = (client._handle_packet, (packet,))
+
+        if self.overload == 'shed' and packet.packet_id in self.sheddable:
+            try:
+                queue.put_nowait(item)
+            except Full:
+                pid = packet.packet_id
+                self.dropped[pid] = self.dropped.get(pid, 0) + 1
+                return False
+        elif block:
+            queue.put(item)
+        else:
+            queue.put_nowait(item)
+
+        depth = queue.qsize()
+        if depth > self.peak:
+            self.peak = depth
+        return True
+
+    def depth(self):
+        """
+        Get the number of packets waiting across all queues.
+        """
+        return sum(queue.qsize() for queue in self.queues)
+
+    def stats(self):
+        """
+        Get a dict of the queue depth, the deepest any one queue has been, and
+        the handled and dropped packet counts, with drops also given per
+        packet ID.
+        """
+        return dict(depth=self.depth(), peak=self.peak,
+                    handled=sum(self.handled),
+                    dropped=sum(self.dropped.values()),
+                    dropped_by_id=dict(self.dropped))
+
+    def stop(self):
+        """
+        Stop the workers once they have finished what is already queued.
+        """
+        for queue in self.queues:
+            queue.put(None)
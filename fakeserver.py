@@ -0,0 +1,364 @@
+#! /usr/bin/env python
+"""
+LOF BOT FAKE SERVER
+===================
+
+This module provides a stand-in for a tmwAthena server, good enough to bring
+bots all the way into the game and to throw traffic at them, so that the bot
+can be load tested on one machine. It speaks the login, character and map
+server handshakes that `TMWAClient.connect_task()` expects, answers pings and
+name requests, records the whispers and chat the bots send, and can flood the
+bots with `S_NORM_MSG`, `S_WHISPER`, `S_NAME_RES` and `S_EMOTE` packets.
+
+Run it directly to serve on the usual ports, for a bot configured with
+`server = 'localhost'` and `same_ip = True`:
+
+    python fakeserver.py [--port 6901] [--flood KIND:RATE ...]
+
+where KIND is one of msg, whisper, name or emote, and RATE is packets per
+second sent to every connected bot.
+"""
+
+import sys
+import time
+import socket
+import struct
+import random
+
+from taskit.threaded import threaded, allocate_lock
+
+from wire import *
+from wire import pack
+
+
+__all__ = ['FakeServer', 'norm_msg', 'whisper', 'name_res', 'emote']
+
+
+## Server packet builders
+
+def norm_msg(being_id, name, text):
+    """
+    Build `S_NORM_MSG`: being `being_id`, called `name`, saying `text`.
+    """
+    msg = ('%s : %s' % (name, text)).encode() + b'\0'
+    return struct.pack('<HHL', S_NORM_MSG, 8 + len(msg), being_id) + msg
+
+
+def whisper(nick, text):
+    """
+    Build `S_WHISPER`: `nick` whispering `text`.
+    """
+    msg = text.encode() + b'\0'
+    return struct.pack('<HH24s', S_WHISPER, 28 + len(msg),
+                       nick.encode()) + msg
+
+
+def name_res(being_id, name):
+    """
+    Build `S_NAME_RES`: being `being_id` is called `name`.
+    """
+    return struct.pack('<HL24s', S_NAME_RES, being_id, name.encode())
+
+
+def emote(being_id, emote_id):
+    """
+    Build `S_EMOTE`: being `being_id` shows emote `emote_id`.
+    """
+    return struct.pack('<HLB', S_EMOTE, being_id, emote_id)
+
+
+def _tick():
+    return int(time.time() * 1000) & 0xffffffff
+
+
+def _listen(host, port):
+    sock = socket.socket()
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(128)
+    return sock
+
+
+def _packets(conn, buff):
+    """
+    Iterate over the packets arriving on `conn` until it closes.
+    """
+    while True:
+        try:
+            if not buff.recv_into(conn):
+                return
+        except socket.error:
+            return
+        for packet in buff:
+            yield packet
+
+
+class Session(object):
+
+    """
+    One bot's connection to the fake map server.
+    """
+
+    def __init__(self, conn, account, account_id):
+        self.conn = conn
+        self.account = account
+        self.account_id = account_id
+        self.lock = allocate_lock()
+        # Packet ID -> number received
+        self.received = {}
+        self.closed = False
+
+    def send(self, data):
+        """
+        Send packet bytes `data`. Returns False if the bot has gone.
+        """
+        if self.closed:
+            return False
+        try:
+            with self.lock:
+                self.conn.sendall(data)
+        except socket.error:
+            self.closed = True
+            return False
+        return True
+
+
+class FakeServer(object):
+
+    """
+    A fake tmwAthena login, character and map server, each on its own port and
+    handling each connection on a thread of its own.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, char_port=0, map_port=0):
+        """
+        Ports of 0 are picked by the OS; see the attributes of the same names
+        once `start()`ed.
+        """
+        self.host = host
+        self.port = port
+        self.char_port = char_port
+        self.map_port = map_port
+
+        self.lock = allocate_lock()
+        # account -> account ID, and back
+        self.accounts = {}
+        self.account_names = {}
+        # being ID -> name, answered to C_NAME_REQ
+        self.beings = {}
+        # account -> `Session`, for the bots in the game
+        self.sessions = {}
+        # Called with (session, nick, message) for every C_WHISPER...
+        self.whisper_cbs = []
+        # ...and with (session, message) for every C_MSG
+        self.msg_cbs = []
+        self.socks = []
+
+    def start(self):
+        for attr, handler in [('port', self._login),
+                              ('char_port', self._char),
+                              ('map_port', self._map)]:
+            sock = _listen(self.host, getattr(self, attr))
+            setattr(self, attr, sock.getsockname()[1])
+            self.socks.append(sock)
+            threaded(self._accept, (sock, handler))
+
+    def close(self):
+        for sock in self.socks:
+            sock.close()
+        for session in list(self.sessions.values()):
+            session.conn.close()
+
+    def _accept(self, sock, handler):
+        while True:
+            try:
+                conn, addr = sock.accept()
+            except socket.error:
+                # Closed
+                return
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            threaded(self._serve, (conn, handler))
+
+    def _serve(self, conn, handler):
+        try:
+            handler(conn, PacketBuffer())
+        except socket.error:
+            pass
+        finally:
+            conn.close()
+
+    def _account_id(self, account):
+        with self.lock:
+            if account not in self.accounts:
+                account_id = 2000000 + len(self.accounts)
+                self.accounts[account] = account_id
+                self.account_names[account_id] = account
+            return self.accounts[account]
+
+    def _login(self, conn, buff):
+        for packet in _packets(conn, buff):
+            if packet == C_L_LOGIN:
+                packet.skip(4)
+                account = packet.string(24)
+                account_id = self._account_id(account)
+                conn.sendall(struct.pack(
+                  '<HHLLL30xB4sH', S_CSERV, 53, 1, account_id, 2, 0,
+                  socket.inet_aton(self.host), self.char_port))
+                return
+
+    def _char(self, conn, buff):
+        for packet in _packets(conn, buff):
+            if packet == C_C_LOGIN:
+                account_id = packet.int32()
+                conn.sendall(struct.pack('<L', account_id))
+                # An empty character list; the bot picks its slot regardless
+                conn.sendall(struct.pack('<HH', S_PICK_CHAR, 4))
+            elif packet == C_PICK_CHAR:
+                conn.sendall(struct.pack(
+                  '<HL16s4sH', S_MSERV, 150000 + account_id % 100000,
+                  b'fake.gat', socket.inet_aton(self.host), self.map_port))
+                return
+
+    def _map(self, conn, buff):
+        session = None
+        for packet in _packets(conn, buff):
+            if session is None:
+                if packet.packet_id != C_M_LOGIN:
+                    continue
+                account_id = packet.int32()
+                session = Session(conn, self.account_names.get(account_id),
+                                  account_id)
+                conn.sendall(struct.pack('<L', account_id))
+                conn.sendall(struct.pack('<HLBBB2x', S_CONNECTED, _tick(),
+                                         *pack(50, 50, 4)))
+                with self.lock:
+                    self.sessions[session.account] = session
+                continue
+
+            pid = packet.packet_id
+            session.received[pid] = session.received.get(pid, 0) + 1
+            if pid == C_PING:
+                session.send(struct.pack('<HL', S_PING, _tick()))
+            elif pid == C_NAME_REQ:
+                being_id = packet.int32()
+                session.send(name_res(
+                  being_id, self.beings.get(being_id, 'Being%d' % being_id)))
+            elif pid == C_WHISPER:
+                packet.skip(2)
+                nick = packet.string(24)
+                msg = packet.string()
+                for cb in self.whisper_cbs:
+                    cb(session, nick, msg)
+            elif pid == C_MSG:
+                packet.skip(2)
+                msg = packet.string()
+                for cb in self.msg_cbs:
+                    cb(session, msg)
+
+        if session is not None:
+            session.closed = True
+            with self.lock:
+                if self.sessions.get(session.account) is session:
+                    del self.sessions[session.account]
+
+    ### Traffic
+
+    def wait_for(self, count, timeout=60):
+        """
+        Wait for `count` bots to be in the game. Returns whether they are.
+        """
+        end = time.time() + timeout
+        while len(self.sessions) < count:
+            if time.time() > end:
+                return False
+            time.sleep(.01)
+        return True
+
+    def add_being(self, name, being_id=None):
+        """
+        Make up a being called `name`, which is announced to every bot in the
+        game. Returns its ID.
+        """
+        with self.lock:
+            if being_id is None:
+                being_id = 110000 + len(self.beings)
+            self.beings[being_id] = name
+        self.send_all(name_res(being_id, name))
+        return being_id
+
+    def send_to(self, account, data):
+        """
+        Send packet bytes `data` to the bot logged in as `account`.
+        """
+        session = self.sessions.get(account)
+        return bool(session) and session.send(data)
+
+    def send_all(self, data):
+        """
+        Send packet bytes `data` to every bot in the game, as though they were
+        all within earshot.
+        """
+        for session in list(self.sessions.values()):
+            session.send(data)
+
+    def make(self, kind):
+        """
+        Build a random packet of `kind` (msg, whisper, name or emote) from the
+        known beings.
+        """
+        if not self.beings:
+            self.add_being('Someone')
+        being_id, name = random.choice(list(self.beings.items()))
+        if kind == 'msg':
+            return norm_msg(being_id, name, 'Hello %s' % random.random())
+        elif kind == 'whisper':
+            return whisper(name, 'Hello %s' % random.random())
+        elif kind == 'name':
+            return name_res(being_id, name)
+        elif kind == 'emote':
+            return emote(being_id, random.randint(1, 12))
+        raise ValueError('Unknown packet kind %r!' % kind)
+
+    def flood(self, kind, rate, count=None, duration=None, account=None):
+        """
+        Send `rate` packets of `kind` (see `make()`) a second to every bot, or
+        just to `account`, until `count` have been sent or `duration` seconds
+        have passed, whichever comes first. Blocks, so start it on a thread of
+        its own for several floods at once. Returns the number sent.
+        """
+        start = time.time()
+        sent = 0
+        while ((count is None or sent < count) and
+               (duration is None or time.time() - start < duration)):
+            data = self.make(kind)
+            if account is None:
+                self.send_all(data)
+            else:
+                self.send_to(account, data)
+            sent += 1
+            delay = start + float(sent) / rate - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        return sent
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    port = int(args[args.index('--port') + 1]) if '--port' in args else 6901
+    server = FakeServer(port=port, char_port=6122, map_port=5122)
+    server.start()
+    server.whisper_cbs.append(
+      lambda session, nick, msg: sys.stdout.write(
+        '%s -> %s: %s\n' % (session.account, nick, msg)))
+    print('Serving on %s:%s' % (server.host, server.port))
+
+    for i, arg in enumerate(args):
+        if arg == '--flood':
+            kind, rate = args[i + 1].split(':')
+            threaded(server.flood, (kind, float(rate)))
+
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.close()
@@ -0,0 +1,241 @@
+#! /usr/bin/env python
+"""
+LOF BOT LOAD TEST
+=================
+
+Brings a `LOFBot` master and its slaves up against a `fakeserver.FakeServer` on
+this machine, then measures:
+
+* how long the master and slaves take to get into the game;
+* the end-to-end latency of whispered commands, from the fake server sending
+  the whisper to it receiving the first line of the reply;
+* relay fan-out throughput: chat is flooded at every bot, and the relayed
+  whispers reaching the listeners are counted;
+* the process's memory use along the way.
+
+    python loadtest.py [--slaves 4] [--commands 50] [--command .about]
+                       [--listeners 20] [--chat 5] [--duration 10]
+                       [--rate R] [--burst B]
+
+Mods, dispatch and supervision settings come from config.py, as for the real
+bot. `--rate` and `--burst` override the send queue settings, which otherwise
+bound both the command latency and the relay throughput. The relay test needs
+the listen mod; it registers its listeners with `.listen`, in the real database.
+"""
+
+import gc
+import os
+import sys
+import time
+import resource
+
+from taskit.log import ERROR
+from taskit.threaded import threaded, allocate_lock
+
+import config
+import lof_bot
+from lof_bot import TMWAClient, BotBase, LOFBot, SlaveBot, LOFLogNode, \
+                    LOFFileLog
+from dispatch import Dispatcher
+from reactor import Reactor
+from supervisor import READY
+from fakeserver import FakeServer, whisper
+from utils import percentile
+
+
+def memory():
+    """
+    Get the resident memory of this process in KiB; the peak if the current
+    figure is not available.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * resource.getpagesize() // 1024
+    except (IOError, OSError):
+        # Already KiB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def report_memory(stage):
+    print('memory %-10s %8d KiB, %d objects' % (
+      stage, memory(), len(gc.get_objects())))
+
+
+def report_latency(name, latencies, expected):
+    lat = sorted(latencies)
+    print('%s: %d/%d answered' % (name, len(lat), expected))
+    if lat:
+        print('  latency ms: p50 %.1f, p90 %.1f, p99 %.1f, max %.1f' % tuple(
+          1000 * percentile(lat, p) for p in (50, 90, 99, 100)))
+
+
+class Replies(object):
+
+    """
+    Times the first reply whispered back to each nick.
+    """
+
+    def __init__(self):
+        self.lock = allocate_lock()
+        self.waiting = {}
+        self.latencies = []
+
+    def expect(self, nick):
+        with self.lock:
+            self.waiting[nick] = time.time()
+
+    def __call__(self, session, nick, msg):
+        with self.lock:
+            sent = self.waiting.pop(nick, None)
+            if sent is not None:
+                self.latencies.append(time.time() - sent)
+
+    def wait(self, timeout):
+        end = time.time() + timeout
+        while self.waiting and time.time() < end:
+            time.sleep(.01)
+
+
+class Relayed(object):
+
+    """
+    Counts the whispers relayed to a set of listeners, by sending account.
+    """
+
+    def __init__(self, listeners):
+        self.listeners = set(listeners)
+        self.lock = allocate_lock()
+        self.count = 0
+        self.by_account = {}
+        self.last = None
+
+    def __call__(self, session, nick, msg):
+        if nick not in self.listeners or not msg.startswith('<'):
+            return
+        with self.lock:
+            self.count += 1
+            account = session.account
+            self.by_account[account] = self.by_account.get(account, 0) + 1
+            self.last = time.time()
+
+
+def test_commands(server, bot, count, command):
+    replies = Replies()
+    server.whisper_cbs.append(replies)
+    for i in range(count):
+        nick = 'Tester%d' % i
+        replies.expect(nick)
+        server.send_to(bot.account, whisper(nick, command))
+        time.sleep(.02)
+    replies.wait(30 + count)
+    server.whisper_cbs.remove(replies)
+    report_latency('commands (%s)' % command, replies.latencies, count)
+
+
+def test_relay(server, bot, count, chat, duration):
+    if 'listen' not in bot.installed_mods:
+        print('relay: skipped, the listen mod is not installed')
+        return
+    listeners = ['Listener%d' % i for i in range(count)]
+
+    # Sign up as listeners through the command, as players would
+    replies = Replies()
+    server.whisper_cbs.append(replies)
+    for nick in listeners:
+        replies.expect(nick)
+        server.send_to(bot.account, whisper(nick, '.listen yes'))
+    replies.wait(30 + count)
+    server.whisper_cbs.remove(replies)
+    report_latency('relay sign-up', replies.latencies, count)
+
+    # Keep the online list from being refreshed from the real server
+    bot.periodic_cbs = [job for job in bot.periodic_cbs
+                        if job.name != 'online.get_playerlist']
+    bot.update_schedule()
+    with bot.mod_online_lock:
+        bot.online_players = [nick.lower() for nick in listeners]
+
+    relayed = Relayed(listeners)
+    server.whisper_cbs.append(relayed)
+    server.add_being('Chatter')
+    start = time.time()
+    lines = server.flood('msg', chat, duration=duration)
+    # Then let the send queues drain
+    while time.time() - (relayed.last or start) < 5:
+        time.sleep(.1)
+    server.whisper_cbs.remove(relayed)
+
+    taken = (relayed.last or time.time()) - start
+    print('relay: %d lines heard by %d bots, %d/%d whispers relayed in %.1fs:'
+          ' %.1f whispers/s' % (lines, 1 + len(bot.slavelist), relayed.count,
+                                lines * count, taken, relayed.count / taken))
+    print('  spread: %s' % ', '.join('%s %d' % item for item in
+                                    sorted(relayed.by_account.items())))
+    print('  dedup: %(hits)d dropped, %(misses)d let through' %
+          bot.dedup.stats())
+
+
+def drive(server, bot, args):
+    start = time.time()
+    expected = 1 + args['slaves']
+    if not server.wait_for(expected, 120):
+        print('Only %d of %d bots got in!' % (len(server.sessions), expected))
+    else:
+        while any(state != READY for account, state, reconnects
+                  in bot.supervisor.stats()):
+            time.sleep(.01)
+        print('connect: %d bots in the game in %.2fs' % (
+          expected, time.time() - start))
+    report_memory('connected')
+
+    test_commands(server, bot, args['commands'], args['command'])
+    report_memory('commands')
+    test_relay(server, bot, args['listeners'], args['chat'], args['duration'])
+    report_memory('relay')
+
+    bot.done = True
+    for slave in bot.slavelist:
+        slave.done = True
+
+
+def main(argv):
+    args = dict(slaves=4, commands=50, command='.about', listeners=20, chat=5.,
+                duration=10., rate=None, burst=None)
+    for i, arg in enumerate(argv):
+        if arg.startswith('--'):
+            name = arg[2:]
+            value = argv[i + 1]
+            args[name] = type(args[name])(value) \
+              if args[name] is not None else float(value)
+
+    report_memory('start')
+
+    lof_bot.log = log = LOFLogNode((LOFFileLog(sys.stderr, [ERROR], 0),))
+    TMWAClient.set_log(log)
+    TMWAClient.set_dispatcher(Dispatcher(**getattr(config, 'dispatch', {})))
+    send_conf = dict(getattr(config, 'send', {}))
+    for name in ('rate', 'burst'):
+        if args[name] is not None:
+            send_conf[name] = args[name]
+    TMWAClient.set_send_conf(send_conf)
+    reactor = Reactor()
+    TMWAClient.set_reactor(reactor)
+    BotBase.set_scheduler_conf(getattr(config, 'scheduler', {}))
+    BotBase.set_mod_conf(config.mod_conf)
+    LOFBot.set_mods(config.master_mods)
+    SlaveBot.set_mods(config.slave_mods)
+
+    server = FakeServer()
+    server.start()
+    bot = LOFBot(server.host, server.port, 'LoadMaster', 'x', same_ip=True)
+    slavedefs = [('LoadSlave%d' % i, 'x', 'n') for i in range(args['slaves'])]
+
+    threaded(drive, (server, bot, args))
+    reactor.run_until_complete(
+      bot.go_task('n', slavedefs, **getattr(config, 'supervision', {})))
+    server.close()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -28,9 +28,13 @@ and released under the Apache License, version 2.0.
 __version__ = '2.2.1'
 
 
+import os
 import sys
 import time
+import errno
 import socket
+import itertools
+# Game sockets get their own timeouts; this is a backstop for the HTTP fetches
 socket.setdefaulttimeout(120)
 
 from taskit.threaded import threaded, allocate_lock
@@ -38,6 +42,20 @@ from taskit.log import *
 
 from utils import Vector
 from wire import *
+from dispatch import Dispatcher, Full
+from reactor import Reactor, Return, Timeout, readable, writable, sleep
+from supervisor import Supervisor, READY, DEAD
+from sendq import SendQueue, PRIO_CONTROL, PRIO_COMMAND, PRIO_RELAY, \
+                  PRIO_COSMETIC
+from relay import RelayFanout
+from dedup import DedupWindow
+from capture import open_capture, pack_log_record, LOG_MAGIC, \
+                    IN as CAPTURE_IN, OUT as CAPTURE_OUT
+from scheduler import Scheduler
+from logwriter import LogWriter, RotatingFile
+import metrics
+import profiler
+import sql
 import config
 import commands
 
@@ -50,40 +68,139 @@ PACKET = 'PDUMP'
 ### Specialized logger
 
 
+def _foreign_sink(logger):
+    """
+    Adapt a logger from outside this module, such as taskit's own, which only 
+    takes (importance, msg), to be called as a sink. The title goes in front 
+    of the message.
+    """
+    def sink(importance, msg, title=''):
+        logger(importance, '%s: %s' % (title, msg) if title else msg)
+    return sink
+
+
 class LOFLogNode(LoggerNode):
+    
+    """
+    A logging node that routes each level straight to the sinks under it that 
+    take it. The routes are worked out once per level and kept until any 
+    node's children or filter change. Messages may be given as functions 
+    returning the text, which are only called if some sink takes the level.
+    """
+    
+    # Bumped by every change to any node's children or filter, so that every 
+    # node's routes are worked out afresh
+    _generation = 0
+    # (generation, {level: (sink function, ...)})
+    _routes = (-1, {})
+    
+    @property
+    def allowed(self):
+        return self._allowed
+    
+    @allowed.setter
+    def allowed(self, allowed):
+        self._allowed = allowed
+        LOFLogNode._generation += 1
+    
+    @property
+    def children(self):
+        return self._children
+    
+    @children.setter
+    def children(self, children):
+        self._children = list(children)
+        LOFLogNode._generation += 1
+    
+    def add_children(self, *loggers):
+        """
+        Add loggers as children of this logger.
+        """
+        self._children.extend(loggers)
+        LOFLogNode._generation += 1
+    
+    def remove_children(self, *loggers):
+        """
+        Remove loggers from the children of this logger.
+        """
+        for logger in loggers:
+            self._children.remove(logger)
+        LOFLogNode._generation += 1
+    
     def make_client_log(self, client):
         def log(level, msg):
             self.__call__(level, msg, client.account)
         return log
     
-    # I really didn't want to copy-hack this bit from taskit.log, but this is 
-    # currently very much a special case sub-class
-    def __call__(self, importance, msg, title=''):
+    def _sinks(self, importance):
         """
-        Log message `' '.join(msg)` with `importance` importance.
+        List the functions to hand `importance` messages to.
         """
-        ## Quick-cache for speed... really!
         allowed = self.allowed
-        ## Ignore dis-allowed importances.
         if allowed is not None and importance not in allowed:
-            return False
+            return []
         
+        sinks = []
         for logger in self.children:
-            # Yes, we're completely redoing this just to change this call. 
-            # TODO: Something to think about for the next version of taskit.log...
-            ## .__call__() is much faster for classes, but has bad aesthetics...
-            logger(importance, msg, title)
+            sub = getattr(logger, '_sinks', None)
+            if sub is None:
+                # Foreign loggers can't tell us, so assume that they would
+                sinks.append(_foreign_sink(logger))
+            else:
+                sinks.extend(sub(importance))
+        return sinks
+    
+    def _route(self, importance):
+        generation, routes = self._routes
+        if generation != LOFLogNode._generation:
+            routes = {}
+            self._routes = (LOFLogNode._generation, routes)
+        sinks = routes.get(importance)
+        if sinks is None:
+            sinks = routes[importance] = tuple(self._sinks(importance))
+        return sinks
+    
+    def __call__(self, importance, msg, title=''):
+        """
+        Log message `msg` (or whatever it returns, if a function) with 
+        `importance` importance.
+        """
+        sinks = self._route(importance)
+        if not sinks:
+            return False
+        
+        if callable(msg):
+            msg = msg()
+        for sink in sinks:
+            sink(importance, msg, title)
         
         return True
+    
+    def accepts(self, importance):
+        """
+        Check whether any sink under this node would take `importance` 
+        messages.
+        """
+        return bool(self._route(importance))
+
+
+# Level tags for the log files
+_level_tags = {INFO: 'info:', ERROR: 'ERROR', IMPORTANT: '<IMP>'}
 
 
 class LOFFileLog(LOFLogNode):
+    
+    # The `logwriter.LogWriter` that writes for all file logs, or None to 
+    # write on the logging thread
+    writer = None
+    
     def __init__(self, fobj, allowed=None, flush=5, children=()):
         """
         fobj  -- The file-like object to be written to.
         flush -- How many lines to write before flush()ing if greater than 
                  zero, otherwise flush will not be called and the close() 
-                 method will have to be used to save data.
+                 method will have to be used to save data. With a writer, 
+                 any number above zero flushes after every batch.
         """
         LoggerNode.__init__(self, children, allowed)
         
@@ -91,49 +208,95 @@ class LOFFileLog(LOFLogNode):
         self.flush = flush
         # Set up the flush counter.
         self.count = 0
+        # Records dropped by the writer, and how many of those it has noted
+        self.dropped = self.reported = 0
+        # The last second formatted, and its string
+        self._stamp = (None, '')
+    
+    def _time(self, timestamp):
+        second = int(timestamp)
+        # One tuple, so that other threads never see half an update
+        stamp = self._stamp
+        if stamp[0] != second:
+            stamp = self._stamp = (second, time.strftime(
+              '%H:%M:%S %d.%m.%y', time.localtime(second)))
+        return stamp[1]
+    
+    def _format(self, level, msg, title, timestamp):
+        if level == PACKET:
+            # Raw packets, as hex
+            msg = '**%04x**: %s' % (
+              ord(msg[0]) | ord(msg[1]) << 8, 
+              ' '.join('%02x' % ord(c) for c in msg))
+        level = _level_tags.get(level) or level.lower()[:5]
+        return '%s  %s%s\t%s\n' % (self._time(timestamp), title.ljust(15), 
+                                   level, msg)
+    
+    def _sinks(self, importance):
+        sinks = LOFLogNode._sinks(self, importance)
+        allowed = self.allowed
+        if allowed is None or importance in allowed:
+            sinks.append(self.emit)
+        return sinks
     
-    def _format(self, level, msg, title):
-        level = {INFO: 'info:',
-                 ERROR: 'ERROR',
-                 IMPORTANT: '<IMP>'
-                 }.get(level, level.lower()[:5])
-        
-        t = time.strftime('%H:%M:%S %d.%m.%y')
-        
-        return '%s  %s%s\t%s\n' % (t, title.ljust(15), level, msg)
-    
-    # I really didn't want to copy-hack this bit from taskit.log, but this is 
-    # currently very much a special case sub-class
-    def __call__(self, importance, msg, title=''):
-        ## Let the super-class take care of the children...
-        res = LOFLogNode.__call__(self, importance, msg, title)
-        
-        ## If we aren't logging this event... well... then don't!
-        if not res:
-            return False
+    def emit(self, importance, msg, title=''):
+        """
+        Write a message out, without any filtering.
+        """
+        writer = self.writer
+        if writer is not None:
+            writer.submit(self, importance, msg, title)
+            return
         
-        # Yes, we're completely redoing this just to change this call. 
-        # TODO: Something to think about for the next version of taskit.log...
-        ## Then take care of our handling.
-        self.fobj.write(self._format(importance, msg, title))
+        self.fobj.write(self._format(importance, msg, title, time.time()))
         if self.flush:
             self.count += 1
             if self.count == self.flush:
                 self.fobj.flush()
                 self.count = 0
-        
-        return True
     
     def close(self):
         """
-        Close the underlying file. Does not close child loggers; see 
-        `close_children()`.
+        Close the underlying file, once anything queued for it is written. 
+        Does not close child loggers; see `close_children()`.
         """
+        if self.writer is not None:
+            self.writer.drain()
         self.fobj.close()
+    
+    @classmethod
+    def set_writer(cls, writer):
+        """
+        Set the `logwriter.LogWriter` that all file logs write through, or 
+        None to write on the logging thread.
+        """
+        cls.writer = writer
+
+
+class LOFPacketLog(LOFFileLog):
+    
+    """
+    Writes PACKET messages (raw packets) as packet log records; see 
+    capture.py, which reads them back. `fobj` must be binary, and start with 
+    `capture.LOG_MAGIC`.
+    """
+    
+    def __init__(self, fobj, flush=5, children=()):
+        LOFFileLog.__init__(self, fobj, [PACKET], flush, children)
+    
+    def _format(self, level, msg, title, timestamp):
+        if level != PACKET:
+            # The writer's notes of dropped records, which have no place here
+            return ''
+        return pack_log_record(timestamp, CAPTURE_IN, title, msg)
 
 
 ### Base client
 
+PACKETS_IN = metrics.counter('lofbot_packets_in_total', 
+                             'Packets handled, by type', 'type')
+
+
 class TMWAClient(object):
     
     """
@@ -154,11 +317,27 @@ class TMWAClient(object):
           S_REMOVE=self.got_remove, S_XXX_USED_AFTER_DEATH=self.got_xxx_ad,
           S_PING=self.got_ping)
         
-        # Personalize the logger
+        # Personalize the logger, keeping the node around for accepts()
+        self.log_node = self.log
         self.log = self.log.make_client_log(self)
+        
+        # The packet IDs decoded once connected; see update_subscriptions()
+        self.subscribed = None
+        
+        # See the supervisor module for the states
+        self.state = DEAD
+        self.ready = False
+        self.last_seen = 0
+        # Only used on a reactor; otherwise packets are sent right away
+        self.sendq = None
+        # A capture.CaptureWriter when capturing traffic
+        self.capture = None
+        # A packet that found its dispatcher queue full, on a reactor
+        self.held = None
     
     def _handle_packet(self, packet):
         name = PACKET_NAMES.get(packet.packet_id)
+        PACKETS_IN[name or '%04x' % packet.packet_id].inc()
         parsed = packet.parse()
         if parsed:
             cb = self.packet_cbs.get(name)
@@ -167,53 +346,124 @@ class TMWAClient(object):
         else:
             self.got_unknown(packet)
     
+    def wants_unknown(self):
+        """
+        Check whether anything consumes `got_unknown()`. If not, packets 
+        without a callback are skipped without being decoded.
+        """
+        return False
+    
+    def update_subscriptions(self):
+        """
+        Work out which packet IDs are worth decoding, and apply that to the 
+        packet buffer if we are connected. Must be called whenever 
+        `packet_cbs` or the unknown-packet consumers change.
+        """
+        if self.wants_unknown():
+            self.subscribed = None
+        else:
+            self.subscribed = frozenset(PACKET_IDS[name] 
+                                        for name in self.packet_cbs)
+        if getattr(self, 'ready', False):
+            self.buff.wanted = self.subscribed
+    
+    def skip_counts(self):
+        """
+        Get a dict of how many packets of each ID were skipped undecoded.
+        """
+        buff = getattr(self, 'buff', None)
+        return dict(buff.skipped) if buff else {}
+    
     #### Connect
     
+    # Seconds that each handshake stage, and each send, may take
+    timeout = 120
+    
     def connect(self):
         """
         Does protocol with the server to get all the way into the game. 
         Returns the boolean success of the connection.
         """
-        
+        return Reactor().run_until_complete(self.connect_task())
+    
+    def _open(self, addr):
+        """
+        Connect a new socket to `addr` without blocking. A sub-task.
+        """
+        sock = socket.socket()
+        sock.setblocking(False)
+        err = sock.connect_ex(addr)
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            raise socket.error(err, os.strerror(err))
+        yield writable(sock, self.timeout)
+        err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            raise socket.error(err, os.strerror(err))
+        # Sends may wait a while, but recv()s only ever follow readable()
+        sock.settimeout(self.timeout)
+        raise Return(sock)
+    
+    def _recv(self, sock, count=2048):
+        """
+        Receive into the packet buffer once `sock` is readable. A sub-task 
+        giving the number of bytes received.
+        """
+        yield readable(sock, self.timeout)
+        raise Return(self.buff.recv_into(sock, count))
+    
+    def _discard(self, sock, count):
+        """
+        Throw away the next `count` bytes from `sock`. A sub-task.
+        """
+        while count > 0:
+            yield readable(sock, self.timeout)
+            data = sock.recv(count)
+            if not data:
+                raise socket.error(errno.ECONNRESET, 'Connection closed')
+            count -= len(data)
+    
+    def connect_task(self):
+        """
+        `connect()` as a reactor task, so that many clients can do their 
+        handshakes at once. Each stage gets `timeout` seconds.
+        """
         self.ready = False
         
         self.buff = PacketBuffer()
+        self.held = None
         
         self.log(IMPORTANT, 'Connecting to the login server...')
         
         try:
-            login = socket.socket()
-            login.connect((self.server, self.port))
-        except socket.error:
-            log(ERROR, 'Could not connect to the login server!')
-            return False
+            login = yield self._open((self.server, self.port))
+        except (socket.error, Timeout):
+            self.log(ERROR, 'Could not connect to the login server!')
+            raise Return(False)
         
         self.log(IMPORTANT, 'Connected to the login server!')
         
-        p = PacketOut(C_L_LOGIN, self.account, self.pswd)
-        p.send(login)
-        
         charip = charport = None
         
-        while True:
-            data = login.recv(2048)
-            if not data:
-                break
-            self.buff.feed(data)
-            for packet in self.buff:
-                if packet == S_LOGIN_ERROR:
-                    self.log(ERROR, 'Could not log in!')
-                    return False
-                elif packet == S_CSERV:
-                    self.log(IMPORTANT, 'Successfully logged in!')
-                    id1, accid, id2, sex, charip, charport = packet.parse()
-                    login.close()
+        try:
+            PacketOut(C_L_LOGIN, self.account, self.pswd).send(login)
+            while not charip:
+                if not (yield self._recv(login)):
                     break
-            if charip:
-                break
+                for packet in self.buff:
+                    if packet == S_LOGIN_ERROR:
+                        self.log(ERROR, 'Could not log in!')
+                        raise Return(False)
+                    elif packet == S_CSERV:
+                        self.log(IMPORTANT, 'Successfully logged in!')
+                        id1, accid, id2, sex, charip, charport = packet.parse()
+                        break
+        except (socket.error, Timeout) as e:
+            self.log(ERROR, 'Lost the login server (%s)!' % e)
+        finally:
+            login.close()
         
         if not charport:
-            return False
+            raise Return(False)
         
         self.buff.reset()
         
@@ -221,72 +471,75 @@ class TMWAClient(object):
         self.log(IMPORTANT, 'Connecting to the character server (%s:%s)...' % charserv)
         
         try:
-            char = socket.socket()
-            char.connect(charserv)
-        except socket.error as e:
-            log(ERROR, 'Could not connect to the character server (%s)!' % e)
-            return False
-        
-        p = PacketOut(C_C_LOGIN, accid, id1, id2, sex)
-        p.send(char)
-        
-        # What's this?
-        char.recv(4)
+            char = yield self._open(charserv)
+        except (socket.error, Timeout) as e:
+            self.log(ERROR, 'Could not connect to the character server (%s)!' % e)
+            raise Return(False)
         
         mapip = mapport = None
         
-        while True:
-            data = char.recv(2048)
-            if not data:
-                break
-            self.buff.feed(data)
-            for packet in self.buff:
-                if packet == S_PICK_CHAR:
-                    self.log(IMPORTANT, 'Picking character...')
-                    PacketOut(C_PICK_CHAR, self.cindex).send(char)
-                elif packet == S_MSERV:
-                    self.log(IMPORTANT, 'Received MServ information.')
-                    charid, mapip, mapport = packet.parse()
-                    char.close()
+        try:
+            PacketOut(C_C_LOGIN, accid, id1, id2, sex).send(char)
+            
+            # What's this?
+            yield self._discard(char, 4)
+            
+            while not mapip:
+                if not (yield self._recv(char)):
                     break
-            if mapip:
-                break
-
+                for packet in self.buff:
+                    if packet == S_PICK_CHAR:
+                        self.log(IMPORTANT, 'Picking character...')
+                        PacketOut(C_PICK_CHAR, self.cindex).send(char)
+                    elif packet == S_MSERV:
+                        self.log(IMPORTANT, 'Received MServ information.')
+                        charid, mapip, mapport = packet.parse()
+                        break
+        except (socket.error, Timeout) as e:
+            self.log(ERROR, 'Lost the character server (%s)!' % e)
+        finally:
+            char.close()
+        
         if not mapport:
-            return False
+            raise Return(False)
         
         self.buff.reset()
         
         self.log(IMPORTANT, 'Connecting to the map server...')
         
         try:
-            mapserv = socket.socket()
-            mapserv.connect((self.server if self.same_ip else mapip, mapport))
-        except socket.error:
+            mapserv = yield self._open(
+              (self.server if self.same_ip else mapip, mapport))
+        except (socket.error, Timeout):
             self.log(ERROR, 'Could not connect to the map server!')
-            return False
-        
-        p = PacketOut(C_M_LOGIN, accid, charid, id1, id2, sex)
-        p.send(mapserv)
-        
-        # Again, what are we trashing?
-        mapserv.recv(4)
+            raise Return(False)
         
         done = False
         pos = Vector(0, 0)
-        while not done:
-            data = mapserv.recv(2024)
-            if not data:
-                break
-            self.buff.feed(data)
-            for packet in self.buff:
-                if packet == S_CONNECTED:
-                    self.log(IMPORTANT, 'Successfully connected!')
-                    x, y, d = packet.parse()
-                    pos = Vector(x, y)
-                    PacketOut(C_MAP_LOADED).send(mapserv)
-                    done = True
+        
+        try:
+            PacketOut(C_M_LOGIN, accid, charid, id1, id2, sex).send(mapserv)
+            
+            # Again, what are we trashing?
+            yield self._discard(mapserv, 4)
+            
+            while not done:
+                if not (yield self._recv(mapserv, 2024)):
                     break
+                for packet in self.buff:
+                    if packet == S_CONNECTED:
+                        self.log(IMPORTANT, 'Successfully connected!')
+                        x, y, d = packet.parse()
+                        pos = Vector(x, y)
+                        PacketOut(C_MAP_LOADED).send(mapserv)
+                        done = True
+                        break
+        except (socket.error, Timeout) as e:
+            self.log(ERROR, 'Lost the map server (%s)!' % e)
+        
+        if not done:
+            mapserv.close()
+            raise Return(False)
         
         self.conn = mapserv
         
@@ -294,46 +547,157 @@ class TMWAClient(object):
         self.account_id = accid
         self.ready = True
         self.done = False
+        self.last_seen = time.time()
+        self.update_subscriptions()
         
-        return True
+        if self.capture_dir:
+            path = os.path.join(self.capture_dir, '%s.cap' % self.account)
+            capture = self.capture = open_capture(path)
+            self.buff.tap = lambda data: capture.write(CAPTURE_IN, data)
+        
+        if self.reactor:
+            self.sendq = SendQueue(self.reactor, mapserv, 
+                                   on_error=lambda e: self.drop(), 
+                                   **self.send_conf)
+            self.sendq.start()
+        
+        raise Return(True)
     
     #### Mainloop
     
+    def _dispatch_buffered(self, block=True):
+        """
+        Hand every packet received to the dispatcher, or handle it here if 
+        there is none. Without `block`, stops at the first packet whose queue 
+        is full, keeping it as `held` to be handed over first next time.
+        """
+        dispatcher = self.dispatcher
+        packets = self.buff
+        if self.held is not None:
+            packets = itertools.chain((self.held,), packets)
+            self.held = None
+        for packet in packets:
+            if not dispatcher:
+                self._handle_packet(packet)
+                continue
+            try:
+                dispatcher.submit(self, packet, block)
+            except Full:
+                self.held = packet
+                return
+    
     def main(self):
+        # This thread is all ours, so just block
+        self.conn.settimeout(None)
         while not self.done:
-            data = self.conn.recv(2024)
-            if not data:
+            if not self.buff.recv_into(self.conn):
+                break
+            self.last_seen = time.time()
+            self._dispatch_buffered()
+        self.ready = False
+    
+    def main_task(self):
+        """
+        `main()` as a reactor task.
+        """
+        conn = self.conn
+        while not self.done:
+            if self.held is not None:
+                # Its worker is swamped; read nothing more from this server 
+                # until there is room, without holding up the other bots
+                yield sleep(self.dispatch_wait)
+                self._dispatch_buffered(False)
+                continue
+            try:
+                # Wake up now and then to notice `done`
+                yield readable(conn, 1)
+            except Timeout:
+                continue
+            except socket.error as e:
+                # Closed under the reactor
+                self.log(ERROR, 'Connection error: %s' % e)
+                break
+            try:
+                if not self.buff.recv_into(conn):
+                    break
+            except socket.error as e:
+                self.log(ERROR, 'Connection error: %s' % e)
                 break
-            self.buff.feed(data)
-            for packet in self.buff:
-                threaded(self._handle_packet, (packet,))
+            self.last_seen = time.time()
+            self._dispatch_buffered(False)
+        self.ready = False
+        self.held = None
+        if self.sendq:
+            self.sendq.close()
+            self.sendq = None
+        capture = self.capture
+        if capture:
+            # Workers may still be sending; the writer drops their records
+            self.capture = None
+            capture.close()
+        conn.close()
+    
+    def drop(self):
+        """
+        Cut the connection off, so that the main loop finishes as though the 
+        server had closed it.
+        """
+        try:
+            self.conn.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+    
+    def on_ready(self):
+        """
+        Called by the supervisor every time the client has (re)connected.
+        """
     
     #### Commands
     
+    def send(self, packet, priority=PRIO_CONTROL):
+        """
+        Send `packet`, through the send queue in lane `priority` when there 
+        is one. On a reactor, packets sent while disconnected are dropped.
+        """
+        # Read these once, since the reactor may close and clear them 
+        # meanwhile
+        sendq = self.sendq
+        if sendq is None and self.reactor:
+            # The socket is closed, or being reconnected
+            return
+        capture = self.capture
+        if capture:
+            capture.write(CAPTURE_OUT, packet.data)
+        if sendq:
+            sendq.put(packet.data, priority)
+        else:
+            packet.send(self.conn)
+    
+    
     def sit(self):
         """
         Sit down.
         """
-        PacketOut(C_CHANGE_ACT, 2).send(self.conn)
+        self.send(PacketOut(C_CHANGE_ACT, 2), PRIO_COSMETIC)
     
     def stand(self):
         """
         Stand up.
         """
-        PacketOut(C_CHANGE_ACT, 3).send(self.conn)
+        self.send(PacketOut(C_CHANGE_ACT, 3), PRIO_COSMETIC)
     
-    def whisper(self, nick, msg):
+    def whisper(self, nick, msg, priority=PRIO_COMMAND):
         """
         Send whisper `msg` to `nick`.
         """
-        PacketOut(C_WHISPER, nick, msg).send(self.conn)
+        self.send(PacketOut(C_WHISPER, nick, msg), priority)
     
-    def msg(self, msg):
+    def msg(self, msg, priority=PRIO_COMMAND):
         """
         Send standard message `msg`.
         """
         msg = '%s : %s' % (self.account, msg)
-        PacketOut(C_MSG, msg).send(self.conn)
+        self.send(PacketOut(C_MSG, msg), priority)
     
     _e = [
       # Standard TMW (but server-side modifiable) emotes
@@ -385,7 +749,7 @@ class TMWAClient(object):
         e = str(emote_id)
         e = int(self.emote_id_db.get(e.lower(), e))
         
-        PacketOut(C_EMOTE, e).send(self.conn)
+        self.send(PacketOut(C_EMOTE, e), PRIO_COSMETIC)
     
     directions = dict(w=0, s=1, e=8, n=4)
     
@@ -396,14 +760,14 @@ class TMWAClient(object):
         
         d = int(self.directions.get(str(d)[0].lower(), d))
         
-        PacketOut(C_FACE, d).send(self.conn)
+        self.send(PacketOut(C_FACE, d), PRIO_COSMETIC)
     
     def goto(self, x, y, d=6):
         """
         Go to the given location. `d` doesn't seem to affect anything.
         """
         p = PacketOut(C_GOTO, x, y, d)
-        p.send(self.conn)
+        self.send(p)
     
     def respawn(self):
         """
@@ -411,21 +775,28 @@ class TMWAClient(object):
         """
         p = PacketOut(C_RESPAWN)
         p.fill()
-        p.send(self.conn)
+        self.send(p)
     
     def attack(self, being_id, keep):
         """
         Attack something. TESTING!
         """
         p = PacketOut(C_ATTACK, being_id, keep)
-        p.send(self.conn)
+        self.send(p)
+    
+    def ping(self):
+        """
+        Ping the map server, which should answer with S_PING.
+        """
+        tick = int(time.time() * 1000) & 0xffffffff
+        self.send(PacketOut(C_PING, tick))
     
     def whois(self, being_id):
         """
         Ask for the name corresponding to the given being id.
         """
         p = PacketOut(C_NAME_REQ, being_id)
-        p.send(self.conn)
+        self.send(p)
         
     
     #### Callbacks
@@ -483,6 +854,51 @@ class TMWAClient(object):
         Set the logging agent for this client class.
         """
         cls.log = log
+    
+    # Packets are handled on the receiving thread until this is set
+    dispatcher = None
+    # Seconds between tries to hand over a packet that found its dispatcher 
+    # queue full, on a reactor
+    dispatch_wait = 0.05
+    # The reactor that the *_task() methods run on
+    reactor = None
+    
+    # Where to record each connection's traffic, if anywhere
+    capture_dir = None
+    
+    @classmethod
+    def set_capture_dir(cls, capture_dir):
+        """
+        Record the traffic of every connection of this client class to 
+        `<account>.cap` in directory `capture_dir`, or stop if None.
+        """
+        cls.capture_dir = capture_dir
+    
+    # Keyword arguments for each connection's `sendq.SendQueue`
+    send_conf = {}
+    
+    @classmethod
+    def set_send_conf(cls, send_conf):
+        """
+        Set the send queue configuration (rate, burst, tick and timeout) for 
+        this client class.
+        """
+        cls.send_conf = send_conf
+    
+    @classmethod
+    def set_reactor(cls, reactor):
+        """
+        Set the `reactor.Reactor` that this client class runs its tasks on.
+        """
+        cls.reactor = reactor
+    
+    @classmethod
+    def set_dispatcher(cls, dispatcher):
+        """
+        Set the `dispatch.Dispatcher` that this client class hands in-coming 
+        packets to.
+        """
+        cls.dispatcher = dispatcher
 
 
 ### Base for all LoF bots
@@ -505,6 +921,9 @@ class BotBase(TMWAClient):
     def __init__(self, *args, **kw):
         TMWAClient.__init__(self, *args, **kw)
         
+        # Created once connected, if there are periodic callbacks
+        self.scheduler = None
+        
         # Initialize channel
         self.channel = 'main'
         
@@ -543,37 +962,52 @@ class BotBase(TMWAClient):
     def _basic_404(self, nick, cmd):
         return 'The `%s` command is not supported by this bot.' % cmd
     
+    def wants_unknown(self):
+        return bool(self.handlers['unknown'])
+    
     ### Controllers
     
+    # Seconds between runs of a periodic callback, unless its mod says 
+    # otherwise (5 runs a minute)
+    period = 12
+    # Keyword arguments for each bot's `scheduler.Scheduler`
+    scheduler_conf = {}
+    
     def main(self):
         if self.periodic_cbs:
-            threaded(self.periodic, ())
+            # No reactor to time the callbacks, so give them one of their own
+            reactor = Reactor()
+            self._start_scheduler(reactor)
+            threaded(reactor.run, ())
         TMWAClient.main(self)
     
-    def periodic(self):
-        while 1:
-            start = time.time()
-            
-            for cb in self.periodic_cbs:
-                try:
-                    cb(self)
-                except Exception:
-                    sys.excepthook(*sys.exc_info())
-            
-            # I'm willing to take a nanosec or two of error for some 
-            # self-explanatory variable names...
-            finish = time.time()
-            delta = finish - start
-            # 12 seconds = 5 runs a minute
-            adjusted = 12 - delta
-            if adjusted < 0:
-                log(IMPORTANT, 'Periodic loop too loaded for sleep period!')
-                log(IMPORTANT, '(time taken: %s)' % delta)
-            else:
-                time.sleep(adjusted)
+    def main_task(self):
+        periodic = bool(self.periodic_cbs)
+        if periodic:
+            self._start_scheduler(self.reactor)
+        try:
+            yield TMWAClient.main_task(self)
+        finally:
+            if periodic:
+                self.scheduler.stop()
+    
+    def _start_scheduler(self, reactor):
+        if self.scheduler is None:
+            self.scheduler = Scheduler(reactor, args=(self,), log=self.log, 
+                                       **self.scheduler_conf)
+            self.update_schedule()
+        self.scheduler.start()
+    
+    def update_schedule(self):
+        """
+        Apply the current `periodic_cbs` to the scheduler, if running. Must be 
+        called whenever they change.
+        """
+        if self.scheduler is not None:
+            self.scheduler.set_jobs(self.periodic_cbs)
     
     def got_whisper(self, whom, msg):
-        log(INFO, '%s: %s' % (whom, msg))
+        log(INFO, lambda: '%s: %s' % (whom, msg))
         response = commands.evaluate(self, whom, msg)
         if response:
             for L in response.split('\n'):
@@ -581,7 +1015,7 @@ class BotBase(TMWAClient):
     
     def got_xxx_ad(self, *args):
         log(INFO, 'sending reload finish')
-        PacketOut(C_MAP_LOADED).send(self.conn)
+        self.send(PacketOut(C_MAP_LOADED))
     def got_xxx_ad2(self, *args):
         log(INFO, 'sending reload finish 2')
     
@@ -597,6 +1031,14 @@ class BotBase(TMWAClient):
         """
         cls.enabled_mods = list(mods)
     
+    @classmethod
+    def set_scheduler_conf(cls, scheduler_conf):
+        """
+        Set the scheduler configuration (the number of workers) for this bot 
+        class.
+        """
+        cls.scheduler_conf = scheduler_conf
+    
     @classmethod
     def set_mod_conf(cls, mod_conf):
         """
@@ -630,12 +1072,25 @@ class SlaveBot(BotBase):
     
     def go(self):
         if self.connect():
-            self.face(self.facing)
-            self.sit()
+            self.on_ready()
             self.main()
         else:
             log(ERROR, 'The %s slave failed to connect!' % self.account)
     
+    def on_ready(self):
+        self.face(self.facing)
+        self.sit()
+    
+    def go_task(self):
+        """
+        `go()` as a reactor task.
+        """
+        if (yield self.connect_task()):
+            self.on_ready()
+            yield self.main_task()
+        else:
+            log(ERROR, 'The %s slave failed to connect!' % self.account)
+    
     def got_msg(self, being_id, msg):
         self.master.got_msg(being_id, msg, self)
 
@@ -653,6 +1108,10 @@ class LOFBot(BotBase):
     def __init__(self, *args, **kw):
         BotBase.__init__(self, *args, **kw)
         self.slavelist = []
+        self.supervisor = None
+        self.relay = RelayFanout(self)
+        self.dedup = DedupWindow()
+        self.facing = 'n'
     
     def spawn_slaves(self, slavedefs):
         """
@@ -662,9 +1121,30 @@ class LOFBot(BotBase):
         for nick, pswd, facing in slavedefs:
             slave = SlaveBot(self, facing, self.server, self.port, nick, pswd, self.same_ip)
             #slave.set_channel(channel)
-            threaded(slave.go, ())
+            if self.supervisor:
+                self.supervisor.watch(slave)
+            elif self.reactor:
+                # Just another socket on the same loop
+                self.reactor.spawn(slave.go_task())
+            else:
+                threaded(slave.go, ())
             self.slavelist.append(slave)
     
+    def go_task(self, facing, slavedefs, **supervision):
+        """
+        Bring this bot and its slaves up in parallel on the reactor, and keep 
+        them connected until this bot quits. A task. `**supervision` is passed 
+        on to the `Supervisor`.
+        """
+        self.facing = facing
+        self.supervisor = Supervisor(self.reactor, **supervision)
+        self.spawn_slaves(slavedefs)
+        yield self.supervisor.supervise(self)
+    
+    def on_ready(self):
+        self.face(self.facing)
+        self.sit()
+    
     def reset_commands(self):
         BotBase.reset_commands(self)
         self.required_mods = set(['listen'])
@@ -682,21 +1162,24 @@ class LOFBot(BotBase):
         `**kw`        -- ignored
         """
         if skip_slave or not skip_master:
-            self.msg(message)
+            self.msg(message, PRIO_RELAY)
         for slave in self.slavelist:
-            if slave.ready and slave is not skip_slave:
-                slave.msg(message)
+            if slave.state == READY and slave is not skip_slave:
+                slave.msg(message, PRIO_RELAY)
     
     def got_emote(self, being_id, emote_id):
         BotBase.got_emote(self, being_id, emote_id)
-        self.log(INFO, 'EMOTE: %s->%s' % (being_id, emote_id))
+        self.log(INFO, lambda: 'EMOTE: %s->%s' % (being_id, emote_id))
     
     def got_name_res(self, being_id, name):
         BotBase.got_name_res(self, being_id, name)
-        self.log(INFO, 'NAME RES: %s is %s' % (being_id, name))
+        self.log(INFO, lambda: 'NAME RES: %s is %s' % (being_id, name))
     
     def got_msg(self, being_id, msg, source_slave=None):
-        self.log(INFO, 'MSG: %s: %s' % (being_id, msg))
+        # Several of our bots may well have heard this
+        if not self.dedup.check(being_id, msg):
+            return
+        self.log(INFO, lambda: 'MSG: %s: %s' % (being_id, msg))
         def cb(sender):
             BotBase.got_msg(self, sender, msg, being_id=being_id, 
                             skip_slave=source_slave)
@@ -704,11 +1187,14 @@ class LOFBot(BotBase):
     
     def got_server(self, msg):
         BotBase.got_server(self, msg)
-        self.log(INFO, 'SERVER: %s' % msg)
+        self.log(INFO, lambda: 'SERVER: %s' % msg)
+    
+    def wants_unknown(self):
+        return self.log_node.accepts(PACKET)
     
     def got_unknown(self, packet):
-        packbody = ' '.join('%02x' % ord(c) for c in packet.data)
-        self.log(PACKET, '**%04x**: %s' % (packet.packet_id, packbody))
+        # The copy is only made if some sink takes it
+        self.log(PACKET, lambda: packet.raw)
     
     @staticmethod
     def catch_afk(client, nick, crawler):
@@ -721,13 +1207,28 @@ if __name__ == '__main__':
     
     heading = '=' * 5 + ' %s ' + '=' * 15
     
-    # File outs
-    _baslog = LOFFileLog(open('lofbot.log', 'a'), [INFO, IMPORTANT, ERROR], 2)
-    _implog = LOFFileLog(open('lofbot.imp.log', 'a'), [IMPORTANT, ERROR], 2)
-    _deblog = LOFFileLog(
-      open('lofbot.deb.log', 'a'), [DEBUG, INFO, IMPORTANT, ERROR], 2
+    # Everything is written on a thread of its own
+    writer = LogWriter(**getattr(config, 'log_writer', {}))
+    writer.start()
+    LOFFileLog.set_writer(writer)
+    metrics.gauge('lofbot_log_queued', 'Log records waiting to be written', 
+                  func=lambda: len(writer.queue))
+    
+    metrics_dump = getattr(config, 'metrics_dump', None)
+    if metrics_dump:
+        metrics.Dumper(**metrics_dump).start()
+    
+    # File outs, rotated and compressed as they grow
+    log_files = getattr(config, 'log_files', {})
+    _baslog = LOFFileLog(RotatingFile('lofbot.log', **log_files), 
+                         [INFO, IMPORTANT, ERROR], 2)
+    _implog = LOFFileLog(RotatingFile('lofbot.imp.log', **log_files), 
+                         [IMPORTANT, ERROR], 2)
+    _deblog = LOFFileLog(RotatingFile('lofbot.deb.log', **log_files), 
+                         [DEBUG, INFO, IMPORTANT, ERROR], 2)
+    _netlog = LOFPacketLog(
+      RotatingFile('lofbot.net.pkt', header=LOG_MAGIC, **log_files), 2
     )
-    _netlog = LOFFileLog(open('lofbot.net.log', 'a'), [PACKET, INFO], 2)
     
     # Console outs
     _errlog = LOFFileLog(sys.stderr, [ERROR], 0)
@@ -736,6 +1237,16 @@ if __name__ == '__main__':
     # Master
     log = LOFLogNode((_baslog, _implog, _deblog, _netlog, _outlog, _errlog))
     
+    # Database connections
+    sql.set_pool_options(warn=lambda msg: log(IMPORTANT, msg), 
+                         **getattr(config, 'sql_pool', {}))
+    
+    # Stacks of overrunning commands and callbacks
+    watchdog = getattr(config, 'watchdog', None)
+    if watchdog:
+        profiler.WATCHDOG = profiler.Watchdog(log=log, **watchdog)
+        profiler.WATCHDOG.start()
+    
     # stdio
     sys.stdout = OutToLog(log)
     #sys.stderr = OutToError(log)
@@ -754,6 +1265,13 @@ if __name__ == '__main__':
     ### Setup bot classes...
     
     TMWAClient.set_log(log)
+    TMWAClient.set_dispatcher(Dispatcher(**getattr(config, 'dispatch', {})))
+    TMWAClient.set_send_conf(getattr(config, 'send', {}))
+    TMWAClient.set_capture_dir(getattr(config, 'capture_dir', None))
+    # The master and every slave share this one loop
+    reactor = Reactor()
+    TMWAClient.set_reactor(reactor)
+    BotBase.set_scheduler_conf(getattr(config, 'scheduler', {}))
     BotBase.set_mod_conf(config.mod_conf)
     LOFBot.set_mods(config.master_mods)
     SlaveBot.set_mods(config.slave_mods)
@@ -775,13 +1293,9 @@ if __name__ == '__main__':
     
     try:
         log(IMPORTANT, heading % 'STARTING')
-        if bot.connect():
-            bot.spawn_slaves(config.slaves)
-            bot.face(config.direction)
-            bot.sit()
-            bot.main()
-        else:
-            log(ERROR, 'Could not connect!')
+        reactor.run_until_complete(
+          bot.go_task(config.direction, config.slaves, 
+                      **getattr(config, 'supervision', {})))
     except Exception as e:
         sys.excepthook(*sys.exc_info())
         log(ERROR, 'BUG: %s' % str(e))
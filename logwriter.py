@@ -0,0 +1,224 @@
+"""
+LOF BOT LOG WRITER
+==================
+
+This module takes log file I/O off the threads that log. Records are appended
+to a queue, which costs no lock and no system call, and one background thread
+formats them in batches, writes each file's share of a batch at once, and
+flushes.
+
+When more than `limit` records are waiting, DEBUG, INFO and packet records are
+dropped; past twice that, everything is. Each file gets a line saying how many
+records it lost.
+
+It also provides `RotatingFile`, which keeps log files from growing without
+bound.
+"""
+
+import os
+import re
+import glob
+import gzip
+import time
+import shutil
+from collections import deque
+
+from taskit.log import ERROR, IMPORTANT
+from taskit.threaded import threaded, allocate_lock
+
+
+__all__ = ['LogWriter', 'RotatingFile']
+
+
+class LogWriter(object):
+
+    """
+    Writes records for any number of sinks (see `LOFFileLog`) on a thread of
+    its own, every `interval` seconds.
+    """
+
+    def __init__(self, interval=0.1, limit=10000):
+        self.interval = interval
+        self.limit = limit
+        # (sink, timestamp, level, msg, title); deque appends are atomic
+        self.queue = deque()
+        # Held while draining, so that close() can drain too
+        self.lock = allocate_lock()
+        self.running = False
+
+        self.written = 0
+        self.batches = 0
+        self.dropped = 0
+
+    def start(self):
+        if not self.running:
+            self.running = True
+            threaded(self._run, ())
+
+    def stop(self):
+        """
+        Stop the thread, after writing whatever is still queued.
+        """
+        self.running = False
+        self.drain()
+
+    def submit(self, sink, level, msg, title):
+        """
+        Queue a record for `sink`. Returns False if it was dropped.
+        """
+        queue = self.queue
+        if len(queue) >= self.limit and (
+           len(queue) >= 2 * self.limit or level not in (ERROR, IMPORTANT)):
+            sink.dropped += 1
+            self.dropped += 1
+            return False
+        queue.append((sink, time.time(), level, msg, title))
+        return True
+
+    def _run(self):
+        while self.running:
+            time.sleep(self.interval)
+            self.drain()
+
+    def drain(self):
+        """
+        Write out everything queued so far. Safe to call from any thread.
+        """
+        queue = self.queue
+        with self.lock:
+            # Only what is there now, so that busy producers can't keep us
+            count = len(queue)
+            if not count:
+                return
+            batches = {}
+            for i in range(count):
+                sink, timestamp, level, msg, title = queue.popleft()
+                lines = batches.get(sink)
+                if lines is None:
+                    lines = batches[sink] = []
+                try:
+                    line = sink._format(level, msg, title, timestamp)
+                except ValueError:
+                    # Mixed-up encodings, most likely; lose just this one
+                    continue
+                if isinstance(line, unicode):
+                    # So that it joins with everything else
+                    line = line.encode('utf-8')
+                lines.append(line)
+
+            for sink, lines in batches.items():
+                lost = sink.dropped - sink.reported
+                if lost:
+                    sink.reported += lost
+                    lines.append(sink._format(
+                      IMPORTANT, '(%s log records dropped)' % lost, '',
+                      time.time()))
+                try:
+                    sink.fobj.write(''.join(lines))
+                    if sink.flush:
+                        sink.fobj.flush()
+                except (IOError, ValueError):
+                    # Closed, full, or badly encoded; nothing to be done
+                    # about it here
+                    pass
+
+            self.written += count
+            self.batches += 1
+
+    def stats(self):
+        """
+        Get a dict of the records waiting, written and dropped, and the number
+        of batches written.
+        """
+        return dict(queued=len(self.queue), written=self.written,
+                    dropped=self.dropped, batches=self.batches)
+
+
+# The name suffix of a set-aside segment: date-time, then a number if that
+# date-time was taken
+_segment = re.compile(r'^\.(\d{8}-\d{6})(?:-(\d+))?(?:\.gz)?$')
+
+
+class RotatingFile(object):
+
+    """
+    A file opened for appending which, once it grows past `max_bytes` or has
+    been open for `max_age` seconds, is set aside as `<path>.<date-time>`
+    and started afresh. Set-aside segments are gzipped on a thread of their
+    own, and only the newest `keep` are kept. Thread-safe.
+    """
+
+    def __init__(self, path, max_bytes=10 * 2 ** 20, max_age=24 * 3600,
+                 keep=10, compress=True, header=b''):
+        """
+        header -- Written at the start of every segment, for binary formats.
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.keep = keep
+        self.compress = compress
+        self.header = header
+        self.lock = allocate_lock()
+        self._open()
+
+    def _open(self):
+        self.fobj = open(self.path, 'ab')
+        self.fobj.seek(0, os.SEEK_END)
+        self.size = self.fobj.tell()
+        if not self.size and self.header:
+            self.fobj.write(self.header)
+            self.size = len(self.header)
+        self.opened = time.time()
+
+    def write(self, data):
+        with self.lock:
+            if self.size > len(self.header) and (
+               self.size + len(data) > self.max_bytes or
+               time.time() - self.opened > self.max_age):
+                self._rotate()
+            self.fobj.write(data)
+            self.size += len(data)
+
+    def flush(self):
+        with self.lock:
+            self.fobj.flush()
+
+    def close(self):
+        with self.lock:
+            self.fobj.close()
+
+    def _rotate(self):
+        self.fobj.close()
+        dest = '%s.%s' % (self.path, time.strftime('%Y%m%d-%H%M%S'))
+        n = 1
+        while os.path.exists(dest) or os.path.exists(dest + '.gz'):
+            dest = '%s.%s-%d' % (self.path, time.strftime('%Y%m%d-%H%M%S'), n)
+            n += 1
+        os.rename(self.path, dest)
+        self._open()
+        if self.compress:
+            threaded(self._compress, (dest,))
+        else:
+            self._prune()
+
+    def _compress(self, src):
+        with open(src, 'rb') as f:
+            with gzip.open(src + '.gz', 'wb') as g:
+                shutil.copyfileobj(f, g)
+        os.remove(src)
+        self._prune()
+
+    def _prune(self):
+        segments = []
+        for name in glob.glob(self.path + '.*'):
+            match = _segment.match(name[len(self.path):])
+            if match:
+                stamp, n = match.groups()
+                segments.append((stamp, int(n or 0), name))
+        segments.sort()
+        for stamp, n, old in segments[:-self.keep]:
+            try:
+                os.remove(old)
+            except OSError:
+                pass
@@ -0,0 +1,273 @@
+"""
+LOF BOT METRICS
+===============
+
+This module provides a process-wide registry of counters, gauges and latency
+histograms. Metrics are made once, at import time, and kept by whoever updates
+them:
+
+    PACKETS_IN = metrics.counter('lofbot_packets_in_total',
+                                 'Packets received, by type', 'type')
+    ...
+    PACKETS_IN['S_WHISPER'].inc()
+
+Updating one is a dict lookup and an addition, without any lock; under heavy
+contention a rare update may be lost, which is the price of that. Nothing else
+happens until someone reads the registry, be it `.admin stats` or a `Dumper`
+writing JSON or Prometheus text to a file every so often.
+"""
+
+import os
+import json
+import time
+from bisect import bisect_left
+from collections import OrderedDict
+
+from taskit.threaded import threaded
+
+
+__all__ = ['Counter', 'Gauge', 'Histogram', 'Family', 'Registry', 'Dumper',
+           'REGISTRY', 'counter', 'gauge', 'histogram']
+
+
+# Upper bounds, in seconds, of the default histogram buckets
+LATENCY_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1.,
+                   2.5, 5., 10., 30.)
+
+
+class Counter(object):
+
+    """
+    A value that only goes up.
+    """
+
+    kind = 'counter'
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+    def read(self):
+        return self.value
+
+
+class Gauge(object):
+
+    """
+    A value that goes up and down, or, given `func`, whatever that returns
+    when read.
+    """
+
+    kind = 'gauge'
+    __slots__ = ('value', 'func')
+
+    def __init__(self, func=None):
+        self.value = 0
+        self.func = func
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, n=1):
+        self.value += n
+
+    def dec(self, n=1):
+        self.value -= n
+
+    def read(self):
+        return self.func() if self.func else self.value
+
+
+class Histogram(object):
+
+    """
+    Counts observations (latencies, usually) into buckets with the upper
+    bounds `buckets`, plus one for anything larger.
+    """
+
+    kind = 'histogram'
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """
+        Estimate the `q` quantile (0 to 1) as the upper bound of the bucket it
+        falls in, or None if nothing has been observed.
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(self.buckets, self.counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+    def read(self):
+        return dict(count=self.count, sum=self.sum,
+                    buckets=list(zip(self.buckets, self.counts)),
+                    over=self.counts[-1])
+
+
+class Family(dict):
+
+    """
+    Metrics of one kind told apart by the value of one label; `family[value]`
+    makes the metric for `value` the first time it is asked for.
+    """
+
+    def __init__(self, make, label):
+        dict.__init__(self)
+        self.make = make
+        self.label = label
+
+    def __missing__(self, key):
+        metric = self[key] = self.make()
+        return metric
+
+
+class Registry(object):
+
+    """
+    Named metrics and families of metrics. Asking for a name a second time
+    (when a mod is reloaded, say) gives back what was made the first time.
+    """
+
+    def __init__(self):
+        # name -> (help, metric or `Family`)
+        self.metrics = OrderedDict()
+
+    def _get(self, name, help, label, make):
+        entry = self.metrics.get(name)
+        if entry is None:
+            entry = self.metrics[name] = (
+              help, Family(make, label) if label else make())
+        return entry[1]
+
+    def counter(self, name, help='', label=None):
+        return self._get(name, help, label, Counter)
+
+    def gauge(self, name, help='', label=None, func=None):
+        return self._get(name, help, label, lambda: Gauge(func))
+
+    def histogram(self, name, help='', label=None, buckets=LATENCY_BUCKETS):
+        return self._get(name, help, label, lambda: Histogram(buckets))
+
+    def samples(self, pattern=''):
+        """
+        Iterate over the (name, help, label, label value, metric) of every
+        metric whose name contains `pattern`; the label and its value are None
+        for metrics outside of families.
+        """
+        for name, (help, metric) in list(self.metrics.items()):
+            if pattern not in name:
+                continue
+            if isinstance(metric, Family):
+                for key, child in sorted(list(metric.items())):
+                    yield name, help, metric.label, key, child
+            else:
+                yield name, help, None, None, metric
+
+    def snapshot(self):
+        """
+        Get every metric's current value, as a JSON-ready dict.
+        """
+        values = OrderedDict()
+        for name, help, label, key, metric in self.samples():
+            if label:
+                values.setdefault(name, {})[str(key)] = metric.read()
+            else:
+                values[name] = metric.read()
+        return dict(time=time.time(), metrics=values)
+
+    def prometheus(self):
+        """
+        Get every metric's current value in the Prometheus text format.
+        """
+        lines = []
+        last = None
+        for name, help, label, key, metric in self.samples():
+            if name != last:
+                last = name
+                lines.append('# HELP %s %s' % (name, help))
+                lines.append('# TYPE %s %s' % (name, metric.kind))
+            labels = '%s="%s"' % (label, str(key).replace('"', '\\"')) \
+              if label else ''
+            if metric.kind != 'histogram':
+                lines.append('%s%s %s' % (
+                  name, '{%s}' % labels if labels else '', metric.read()))
+                continue
+            seen = 0
+            for bound, n in zip(metric.buckets, metric.counts):
+                seen += n
+                lines.append('%s_bucket{%sle="%s"} %s' % (
+                  name, labels + ',' if labels else '', bound, seen))
+            lines.append('%s_bucket{%sle="+Inf"} %s' % (
+              name, labels + ',' if labels else '', metric.count))
+            labels = '{%s}' % labels if labels else ''
+            lines.append('%s_sum%s %s' % (name, labels, metric.sum))
+            lines.append('%s_count%s %s' % (name, labels, metric.count))
+        return '\n'.join(lines) + '\n'
+
+
+class Dumper(object):
+
+    """
+    Writes `registry` to `path` every `interval` seconds, as 'json' or
+    'prometheus' text, on a thread of its own. Each file is written aside and
+    renamed into place, so that readers never see half of one.
+    """
+
+    def __init__(self, path, interval=60, format='json', registry=None):
+        self.path = path
+        self.interval = interval
+        self.format = format
+        self.registry = registry or REGISTRY
+        self.running = False
+
+    def start(self):
+        if not self.running:
+            self.running = True
+            threaded(self._run, ())
+
+    def stop(self):
+        self.running = False
+
+    def _run(self):
+        while self.running:
+            time.sleep(self.interval)
+            try:
+                self.dump()
+            except (IOError, OSError):
+                # A full disk, most likely; try again next time
+                pass
+
+    def dump(self):
+        if self.format == 'prometheus':
+            text = self.registry.prometheus()
+        else:
+            text = json.dumps(self.registry.snapshot(), indent=1)
+        temp = self.path + '.tmp'
+        with open(temp, 'w') as f:
+            f.write(text)
+        os.rename(temp, self.path)
+
+
+REGISTRY = Registry()
+counter = REGISTRY.counter
+gauge = REGISTRY.gauge
+histogram = REGISTRY.histogram
@@ -1,7 +1,11 @@
 import sys
 
 from utils import isection, rotate
+from wire import PACKET_NAMES
 import commands
+import metrics
+import profiler
+import sql
 import rebuild_prices
 
 
@@ -147,6 +151,133 @@ def admin_inner(client, nick, crawler):
     elif cmd == 'pos':
         return 'x=%s, y=%s' % tuple(client.pos)
     
+    elif cmd == 'skipped':
+        counts = sorted(client.skip_counts().items(), key=lambda i: -i[1])
+        if not counts:
+            return 'No packets have been skipped.'
+        return ',\n'.join(
+          ', '.join('%s=%s' % (PACKET_NAMES.get(pid, '%04x' % pid), n) 
+                    for pid, n in ten) 
+          for ten in isection(counts, 10)
+        )
+    
+    elif cmd == 'bots':
+        supervisor = getattr(client, 'supervisor', None)
+        if not supervisor:
+            return 'This bot is not supervising any connections.'
+        return ', '.join('%s: %s (%s reconnects)' % row 
+                         for row in supervisor.stats())
+    
+    elif cmd == 'sendq':
+        if not client.sendq:
+            return 'Packets are sent right away; there is no send queue.'
+        return '; '.join('%s: %s waiting, %s sent, %.2fs avg/%.2fs worst wait' 
+                         % row for row in client.sendq.stats())
+    
+    elif cmd == 'relay':
+        relay = getattr(client, 'relay', None)
+        if relay is None:
+            return 'Only the master bot relays whispers; ask it instead.'
+        return '%s; %s dropped with no bot connected.' % (
+          ', '.join('%s: %s relayed, %s waiting' % row 
+                    for row in relay.stats()), relay.dropped)
+    
+    elif cmd == 'dedup':
+        dedup = getattr(client, 'dedup', None)
+        if dedup is None:
+            return 'Only the master bot drops duplicate lines; ask it instead.'
+        s = dedup.stats()
+        s['rate'] *= 100
+        return ('%(hits)s duplicate lines dropped, %(misses)s let through '
+                '(%(rate).1f%% hit rate); %(size)s remembered.' % s)
+    
+    elif cmd == 'periodic':
+        scheduler = getattr(client, 'scheduler', None)
+        if not scheduler:
+            return 'This bot has no periodic callbacks running.'
+        return '\n'.join(
+          '%(name)s: every %(interval)ss, %(runs)s runs (%(avg_run).2fs avg/'
+          '%(worst_run).2fs worst), %(avg_late).2fs avg/%(worst_late).2fs '
+          'worst late, %(skips)s skipped, %(timeouts)s timed out, '
+          '%(errors)s failed' % s for s in scheduler.stats())
+    
+    elif cmd == 'logs':
+        writer = getattr(client.log_node.children[0], 'writer', None) \
+          if client.log_node.children else None
+        if not writer:
+            return 'Logs are written right away; there is no log writer.'
+        return ('%(queued)s log records waiting, %(written)s written in '
+                '%(batches)s batches, %(dropped)s dropped.' % writer.stats())
+    
+    elif cmd == 'stats':
+        # Everything, or only the metrics whose names contain the text given
+        samples = metrics.REGISTRY.samples(text.strip())
+        lines = []
+        for name, doc, label, key, metric in samples:
+            if label:
+                name = '%s{%s}' % (name, key)
+            if metric.kind == 'histogram':
+                if metric.count:
+                    lines.append('%s: %s, %.4fs avg, p50<=%ss, p99<=%ss' % (
+                      name, metric.count, metric.sum / metric.count, 
+                      metric.quantile(.5), metric.quantile(.99)))
+            else:
+                lines.append('%s=%s' % (name, metric.read()))
+        if not lines:
+            return 'No metrics match that.'
+        return '\n'.join(', '.join(five) for five in isection(lines, 5))
+    
+    elif cmd == 'profile':
+        # start [sample interval in ms] | stop | dump [path]
+        args = text.split()
+        action = args[0].lower() if args else ''
+        sampler = profiler.PROFILER
+        if action == 'start':
+            if args[1:]:
+                sampler.reset()
+            sampler.start(float(args[1]) / 1000 if args[1:] else None)
+            return 'Sampling every thread every %sms.' % (
+              sampler.interval * 1000)
+        elif action == 'stop':
+            sampler.stop()
+            return 'Stopped sampling; %s samples taken.' % sampler.samples
+        elif action == 'dump':
+            path = args[1] if args[1:] else 'lofbot.profile.txt'
+            sampler.dump(path)
+            return '%s samples written to %s; busiest: %s' % (
+              sampler.samples, path, ', '.join(
+                '%s %.0f%%' % (func.split(' ')[0], own * 100) 
+                for func, own, total in sampler.top(5)))
+        return 'Bad args! See the help sub-command.'
+    
+    elif cmd == 'mem':
+        if text.strip().lower() in ('start', 'stop'):
+            if not profiler.tracemalloc:
+                return 'tracemalloc is not available on this Python.'
+            if text.strip().lower() == 'start':
+                profiler.tracemalloc.start()
+            else:
+                profiler.tracemalloc.stop()
+            return 'OK.'
+        mods = client.installed_mods
+        return '\n'.join(profiler.memory_report(mods))
+    
+    elif cmd == 'db':
+        s = sql.pool_stats()
+        if not s:
+            return 'No database is in use.'
+        return ('%(busy)s of %(size)s database connections checked out (peak '
+                '%(peak)s, max %(max_size)s), %(checkouts)s checkouts, '
+                '%(waits)s waits, %(timeouts)s timeouts, %(evicted)s closed '
+                'idle, %(leaks)s leaks (%(reclaimed)s taken back).' % s)
+    
+    elif cmd == 'dispatch':
+        if not client.dispatcher:
+            return 'Packets are handled inline; there is no dispatch queue.'
+        s = client.dispatcher.stats()
+        return ('%(depth)s packets queued (peak %(peak)s per worker), '
+                '%(handled)s handled, %(dropped)s shed.' % s)
+    
     ### Resetters ############
     
     elif cmd == 'quit':
@@ -184,7 +315,20 @@ def admin_inner(client, nick, crawler):
           
           '`goto <x> <y>` to move the bot;',
           
-          '`names` to see all the names that the bot recognizes;',
+          '`names` to see all the names that the bot recognizes; '
+          '`skipped` to see how many packets of each type went undecoded; '
+          '`dispatch` to see the packet queue depth and drops; '
+          '`stats [name part]` to read the metrics, or those matching; '
+          '`db` to see the database connection pool; '
+          '`profile start [ms]|stop|dump [path]` to sample every thread; '
+          '`mem [start|stop]` to see what memory the mods hold (and to trace '
+          'allocations, on Python 3); '
+          '`periodic` to see the timing of every periodic callback; '
+          '`logs` to see how far behind the log writer is; '
+          '`bots` to see the state of every bot connection; '
+          '`sendq` to see the send queue lanes and their waits; '
+          '`relay` to see how relayed whispers are spread over the bots; '
+          '`dedup` to see how many overheard lines were duplicates;',
           
           '`respawn` to respawn; '
           '`refresh` to update the db of TMW prices (long!); '
@@ -1,6 +1,6 @@
 import json
 
-from schema import Listener, get_connection, close_connection
+from schema import Listener, connection
 
 
 command_bank = {'forward': [True, '.forward', '.f', 'forward'],
@@ -30,11 +30,13 @@ def listen_cb(client, nick, msg, **kw):
     """
     msg = expand(nick, msg)
     client.broadcast(msg, **kw)
-    for listener in Listener.filter(listening=True):
+    with connection():
+        listeners = list(Listener.filter(listening=True))
+    for listener in listeners:
         name = listener.listener
         ignores = json.loads(listener.ignores)
         if nick != name and nick.lower() not in ignores and name.lower() in client.online_players:
-            client.whisper(name, msg)
+            client.relay.whisper(name, msg)
 
 
 def check_special(client, nick, crawler):
@@ -66,17 +68,16 @@ def listen(client, nick, crawler):
     text = crawler.chain
     do_listen = text[0].lower() in 'yt' if text else None
 
-    listener = Listener.get(listener=nick)
-    if not listener:
-        do_listen = False if do_listen is False else True
-        Listener(dict(listener=nick, listening=do_listen, ignores='[]')).add()
-    elif do_listen is None:
-        do_listen = listener.listening
-    else:
-        listener.listening = do_listen
-
-    get_connection().commit()
-    close_connection()
+    with connection(commit=True):
+        listener = Listener.get(listener=nick)
+        if not listener:
+            do_listen = False if do_listen is False else True
+            Listener(dict(listener=nick, listening=do_listen, 
+                          ignores='[]')).add()
+        elif do_listen is None:
+            do_listen = listener.listening
+        else:
+            listener.listening = do_listen
 
     return 'You are%s listening.' % ('' if do_listen else 'n\'t')
 
@@ -85,30 +86,29 @@ def ignore(client, nick, crawler):
     """
     .ignore [<nick> true|false|yes|no] -- View or modify ignore list
     """
-    listener = Listener.get(listener=nick)
+    with connection(commit=True):
+        listener = Listener.get(listener=nick)
 
-    # Return current ignore list if no args are passed
-    if not crawler.chain:
-        return listener.ignores
+        # Return current ignore list if no args are passed
+        if not crawler.chain:
+            return listener.ignores
 
-    nick = crawler.quoted().lower()
-    remainder = crawler.chain.lower()
+        nick = crawler.quoted().lower()
+        remainder = crawler.chain.lower()
 
-    block = remainder[0] in 'yt' if remainder else True
+        block = remainder[0] in 'yt' if remainder else True
 
-    current = set(json.loads(listener.ignores))
-    if block:
-        current.add(nick)
-    else:
-        if nick in current:
-            current.remove(nick)
+        current = set(json.loads(listener.ignores))
+        if block:
+            current.add(nick)
+        else:
+            if nick in current:
+                current.remove(nick)
 
-    if current == set(json.loads(listener.ignores)):
-        return 'No ignore changes made.'
+        if current == set(json.loads(listener.ignores)):
+            return 'No ignore changes made.'
 
-    listener.ignores = json.dumps(list(current))
-    get_connection().commit()
-    close_connection()
+        listener.ignores = json.dumps(list(current))
 
     msg = 'Ignoring %s' if block else 'Unignoring %s.'
     return msg % nick
@@ -26,7 +26,8 @@ def sub_show(client, nick, *args):
         key = args[0].title()
         if key.isdigit():
             start = int(key) * l_page
-            parts = list(Listing.all())[start:start + l_page]
+            parts = list(Listing.query().order_by('id').offset(start)
+                                 .limit(l_page))
         elif key == 'mine':
             parts = list(Listing.filter(seller=nick))
         elif key == 'only':
@@ -40,7 +41,7 @@ def sub_show(client, nick, *args):
             return ('I don\'t know what you\'re trying to do, but you '
                     'might want to take a look at the "help" sub-command!')
     else:
-        parts = list(Listing.all())[:l_page]
+        parts = list(Listing.query().order_by('id').limit(l_page))
         tell_more = True
     
     return format_listing(parts, tell_more)
@@ -88,6 +89,7 @@ def listing(client, nick, crawler):
         # one or zero matches
         match = Listing.get(seller=nick, id=item)
         if not match:
+            close_connection()
             return 'You don\'t have an item with that id!'
         match.remove()
         close_connection()
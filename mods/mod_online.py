@@ -3,12 +3,15 @@ from time import time, gmtime, strftime
 from taskit.threaded import allocate_lock
 import requests
 
-from schema import Sighting, SingleStat, commit_and_close, close_connection
+from schema import Sighting, SingleStat, commit_and_close, close_connection, \
+     connection
 
 
 command_bank = {'online': [True, '.online'], 'seen': [True, '.seen', 'seen'], 
 		'recent': [True, '.recently-seen', '.recent']}
-periodic = ['get_playerlist', 'refresh_sightings']
+# The fetch may hang for a while; count sightings once it should be done
+periodic = [('get_playerlist', dict(timeout=30)), 
+            ('refresh_sightings', dict(delay=5))]
 
 
 def setup(client):
@@ -17,6 +20,8 @@ def setup(client):
     if not SingleStat.get(ref='mod_online.count'):
         SingleStat(dict(ref='mod_online.count', data='0')).add()
         commit_and_close()
+    else:
+        close_connection()
 
 
 ### Online players
@@ -76,20 +81,15 @@ def refresh_sightings(client):
     """
     Refresh the list of player sightings.
     """
-    for p in client.online_players:
-        if _is_bot(p):
-            continue
+    now = time()
+    with connection(commit=True):
+        # One statement for everyone, seen before or not
+        Sighting.upsert(['player'], ((p, now, 1) for p in 
+                                     client.online_players if not _is_bot(p)), 
+                        update={'count': 'count + excluded.count'})
         
-        s = Sighting.get(player=p)
-        if not s:
-            s = Sighting(dict(player=p, time=0, count=0))
-            s.add()
-        s.count += 1
-        s.time = time()
-    
-    stats = SingleStat.get(ref='mod_online.count')
-    stats.data = str(int(stats.data) + 1)
-    commit_and_close()
+        stats = SingleStat.get(ref='mod_online.count')
+        stats.data = str(int(stats.data) + 1)
 
 
 def time_msg(time, client, player):
@@ -127,13 +127,9 @@ def seen(client, nick, crawler):
         # Show max of ten entries
         top = min(top, 10)
         
-        # Inefficient -_-
-        L = list(Sighting.all())
-        L.sort(key=lambda sighting: sighting.count, reverse=True)
-        
         msg = ''
         new = True
-        for s in L[:top]:
+        for s in Sighting.query().order_by('-count').limit(top):
             pl = s.player
             msg += ('Last seen %s, ' % time_msg(s.time, client, pl) + 
                     '%s was seen %s;' % (pl, count_msg(s.count, ticks)) + 
@@ -144,6 +140,7 @@ def seen(client, nick, crawler):
     else:
         s = Sighting.get(player=a0)
         if not s:
+            close_connection()
             return 'Sorry, but I haven\'t ever seen %s.' % pl
         msg = 'I last saw %s %s. ' % (pl, time_msg(s.time, client, a0))
         msg += 'I saw %s %s. ' % (pl, count_msg(s.count, ticks))
@@ -157,12 +154,9 @@ def recent(client, nick, crawler):
     """
     number = int(crawler.chain) if crawler.chain else 5
     number = min(number, 20)    # Need a maximum!
-    L = list(Sighting.all())
-    L.sort(key=lambda sighting: sighting.time, reverse=True)
-    
     msg = ''
     new = True
-    for s in L[:number]:
+    for s in Sighting.query().order_by('-time').limit(number):
         pl = s.player
         msg += '%s was last seen %s' % (pl, time_msg(s.time, client, pl))
         msg += ', ' if new else ';\n'
@@ -1,7 +1,7 @@
 import time
 
 command_bank = {}
-periodic = ['ping_cb']
+periodic = [('ping_cb', dict(jitter=2))]
 
 
 PING_EMOTE = 229    # the sum of the ordinal values of the chars in 'BOT' :P
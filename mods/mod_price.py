@@ -17,23 +17,15 @@ def tmw_price(client, nick, crawler):
     if not item:
         return '`tmw-price` requires an item argument!'
     
-    cheap = expensive = total = items = records = 0
-   
-    for record in Price.filter(item=item):
-        if not cheap or record.price < cheap:
-            cheap = record.price
-        if record.price > expensive:
-            expensive = record.price
-        total += record.quantity * record.price
-        items += record.quantity
-        records += 1
-    
+    stats = Price.query(item=item).aggregate(
+      min='price', max='price', sum_total='quantity * price', 
+      sum_items='quantity', count='id')
     close_connection()
     
-    if not records:
+    if not stats['count']:
         return 'I see no %s in the records.' % item
     
-    average = total // items
-    reps = (items, records, cheap, expensive)
+    average = stats['sum_total'] // stats['sum_items']
+    reps = (stats['sum_items'], stats['count'], stats['min'], stats['max'])
     insert = 'over %s items in %s records, min %s, max %s' % reps
     return 'price for %s: %sgp (%s)' % (item, average, insert)
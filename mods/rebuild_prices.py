@@ -5,11 +5,33 @@ import sys
 from schema import Price, get_connection, close_connection
 
 
+def parse(f):
+    """
+    Generate the (item, quantity, price) of each row of the market's table, 
+    as they are read from `f`.
+    """
+    for L in f:
+        L = L.strip()
+        if L == '</table>':
+            # We're done :)
+            break
+        # In the name of speed... (rather than .startswith())
+        elif L[:4] != '<tr>':
+            continue
+        
+        # chop off the "<tr> <td>" (9 chars) at the beginning, split at the 
+        # cell borders ("</td> <td>"), and keep the first 3 rows, which will 
+        # be completely de-HTMLed :)
+        keep = L[9:].split('</td> <td>')[:3]
+        yield (keep[0], int(keep[1].replace(',', '')), 
+               int(keep[2].replace(',', '')))
+
+
 def rebuild(local=False):
     opened = False
     try:
         start = time.time()
-        Price.clear_table()
+        Price.bulk_remove()
         
         if local:
             f = open('manamarket.html')
@@ -17,25 +39,10 @@ def rebuild(local=False):
             f = urllib.urlopen('http://manamarket.sagdas.net/manamarket.html')
         opened = True
         
-        for L in f:
-            L = L.strip()
-            if L == '</table>':
-                # We're done :)
-                break
-            # In the name of speed... (rather than .startswith())
-            elif L[:4] != '<tr>':
-                continue
-            
-            # chop off the "<tr> <td>" (9 chars) at the beginning, split at the 
-            # cell borders ("</td> <td>"), and keep the first 3 rows, which 
-            # will be completely de-HTMLed :)
-            keep = L[9:].split('</td> <td>')[:3]
-            
-            # Create and add the entry
-            Price({'item': keep[0], 
-                   'quantity': int(keep[1].replace(',', '')), 
-                   'price': int(keep[2].replace(',', ''))
-                  }).add()
+        # Rows go in as they are parsed, a batch at a time
+        Price.bulk_add(parse(f), ('item', 'quantity', 'price'))
+        # The table is all new; let the planner know what it looks like now
+        Price.analyze()
     
     except Exception:
         # Output the error
@@ -43,7 +50,7 @@ def rebuild(local=False):
         w, success = 'failed', False
         get_connection().rollback()
     else:
-        w, success = 'has been completed', False
+        w, success = 'has been completed', True
         get_connection().commit()
     
     if opened:
@@ -0,0 +1,291 @@
+"""
+LOF BOT PROFILER
+================
+
+This module provides the diagnostics behind `.admin profile` and `.admin mem`:
+
+* `Profiler`, a sampling profiler which looks at the stack of every thread
+  every few milliseconds, and writes out how often each function was running
+  (and each whole stack, in the collapsed format flame graph tools read).
+* `Watchdog`, which notes when commands and periodic callbacks start and end,
+  and writes the stacks of all threads to a file whenever one runs over its
+  budget.
+* `memory_report()`, which tells how much memory each mod's globals hold on to
+  and, where `tracemalloc` is tracing (Python 3), which files allocated most.
+
+Nothing here costs anything until it is started, bar the watchdog's two dict
+operations per command or callback.
+"""
+
+import gc
+import sys
+import time
+import types
+import threading
+import traceback
+from collections import defaultdict
+
+try:
+    from thread import get_ident
+except ImportError:
+    from _thread import get_ident
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+from taskit.log import IMPORTANT
+from taskit.threaded import threaded, allocate_lock
+
+
+__all__ = ['Profiler', 'Watchdog', 'memory_report', 'PROFILER', 'WATCHDOG']
+
+
+def _frames():
+    """
+    Get {thread ID: (thread name, frame)} for every thread but this one.
+    """
+    names = dict((t.ident, t.name) for t in threading.enumerate())
+    me = get_ident()
+    return dict((tid, (names.get(tid, 'thread-%s' % tid), frame))
+                for tid, frame in sys._current_frames().items() if tid != me)
+
+
+class Profiler(object):
+
+    """
+    Samples the stacks of all threads every `interval` seconds while running.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.running = False
+        self.reset()
+
+    def reset(self):
+        # Collapsed stack -> samples
+        self.stacks = defaultdict(int)
+        # Function -> samples on top of the stack, and anywhere on it
+        self.own = defaultdict(int)
+        self.total = defaultdict(int)
+        # Rounds of sampling, and stacks sampled over all threads
+        self.samples = 0
+        self.stacks_seen = 0
+        self.started = None
+        self.taken = 0.
+
+    def start(self, interval=None):
+        """
+        Start sampling, adding to the samples taken so far.
+        """
+        if interval:
+            self.interval = interval
+        if not self.running:
+            self.running = True
+            self.started = time.time()
+            threaded(self._run, ())
+
+    def stop(self):
+        if self.running:
+            self.running = False
+            self.taken += time.time() - self.started
+
+    def _run(self):
+        while self.running:
+            self.sample()
+            time.sleep(self.interval)
+
+    def sample(self):
+        for tid, (name, frame) in _frames().items():
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('%s (%s:%s)' % (code.co_name, code.co_filename,
+                                             code.co_firstlineno))
+                frame = frame.f_back
+            if not stack:
+                continue
+            self.own[stack[0]] += 1
+            for func in set(stack):
+                self.total[func] += 1
+            stack.append(name)
+            self.stacks[';'.join(reversed(stack))] += 1
+            self.stacks_seen += 1
+        self.samples += 1
+
+    def top(self, count=10):
+        """
+        Get the (function, share of thread stacks it was on top of, share it
+        was anywhere in) of the `count` functions most often running. Threads
+        waiting on something count too.
+        """
+        samples = float(self.stacks_seen or 1)
+        funcs = sorted(self.own, key=self.own.get, reverse=True)[:count]
+        return [(func, self.own[func] / samples, self.total[func] / samples)
+                for func in funcs]
+
+    def dump(self, path):
+        """
+        Write the top functions, then every stack seen, to `path`.
+        """
+        taken = self.taken
+        if self.running:
+            taken += time.time() - self.started
+        with open(path, 'w') as f:
+            f.write('# %s samples over %.1fs, every %sms\n' % (
+              self.samples, taken, self.interval * 1000))
+            f.write('# own%  total%  function\n')
+            for func, own, total in self.top(50):
+                f.write('# %5.1f  %6.1f  %s\n' % (own * 100, total * 100,
+                                                 func))
+            for stack, n in sorted(self.stacks.items(), key=lambda i: -i[1]):
+                f.write('%s %s\n' % (stack, n))
+
+
+class Watchdog(object):
+
+    """
+    Writes the stacks of all threads to `path` whenever a watched operation
+    runs over its budget, checking every `interval` seconds while started.
+    """
+
+    def __init__(self, path='lofbot.stacks.log', command_budget=2.,
+                 periodic_budget=10., interval=0.5, log=None):
+        """
+        command_budget  -- Seconds a command may take; None for no limit.
+        periodic_budget -- Seconds a periodic callback may take, or None.
+        log             -- A `log(level, msg)` function to note overruns with.
+        """
+        self.path = path
+        self.command_budget = command_budget
+        self.periodic_budget = periodic_budget
+        self.interval = interval
+        self.log = log
+        self.running = False
+        self.lock = allocate_lock()
+        # token -> (name, budget, thread ID, start time)
+        self.watched = {}
+        self.seq = 0
+        self.overruns = 0
+
+    def start(self):
+        if not self.running:
+            self.running = True
+            threaded(self._run, ())
+
+    def stop(self):
+        self.running = False
+
+    def begin(self, name, budget):
+        """
+        Note the start of operation `name` on this thread, which should take
+        no longer than `budget` seconds. Returns a token for `end()`, or None
+        when not started.
+        """
+        if not self.running or not budget:
+            return None
+        with self.lock:
+            self.seq += 1
+            token = self.seq
+            self.watched[token] = (name, budget, get_ident(), time.time())
+        return token
+
+    def end(self, token):
+        if token is not None:
+            self.watched.pop(token, None)
+
+    def _run(self):
+        while self.running:
+            time.sleep(self.interval)
+            now = time.time()
+            with self.lock:
+                over = [(token, info) for token, info in self.watched.items()
+                        if now - info[3] > info[1]]
+                # Once is enough for each
+                for token, info in over:
+                    del self.watched[token]
+            for token, info in over:
+                self.capture(*info)
+
+    def capture(self, name, budget, tid, start):
+        self.overruns += 1
+        lines = ['=== %s: %s over its %ss budget after %.2fs\n' % (
+          time.strftime('%H:%M:%S %d.%m.%y'), name, budget,
+          time.time() - start)]
+        for other, (thread, frame) in sorted(_frames().items()):
+            lines.append('--- %s%s\n' % (thread,
+                                         ' (overrunning)' if other == tid
+                                         else ''))
+            lines.extend(traceback.format_stack(frame))
+        try:
+            with open(self.path, 'a') as f:
+                f.write(''.join(lines))
+        except IOError:
+            pass
+        if self.log:
+            self.log(IMPORTANT, '%s ran over its %ss budget; stacks written '
+                                'to %s.' % (name, budget, self.path))
+
+
+# Things whose memory is not held by a mod, even when a mod refers to them
+_shared = (types.ModuleType, type, types.FunctionType,
+           types.BuiltinFunctionType, types.MethodType)
+
+
+def _held(roots, limit=200000):
+    """
+    Sum up the sizes of the objects reachable from `roots`, not counting
+    modules, classes and functions, looking at no more than `limit` objects.
+    """
+    seen = set()
+    size = 0
+    todo = list(roots)
+    while todo and len(seen) < limit:
+        obj = todo.pop()
+        if id(obj) in seen or isinstance(obj, _shared):
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj, 0)
+        todo.extend(gc.get_referents(obj))
+    return size, len(seen)
+
+
+def memory_report(mods, count=5):
+    """
+    Describe where memory is going, as a list of lines: the objects held by
+    the globals of each of `mods` (a {name: module} dict), the objects that
+    the garbage collector tracks, by type, and, if tracemalloc is tracing,
+    the files that allocated most.
+    """
+    held = []
+    for name, mod in mods.items():
+        size, objs = _held(v for k, v in vars(mod).items()
+                           if not k.startswith('__'))
+        held.append((size, name, objs))
+    held.sort(reverse=True)
+    lines = ['Mods: ' + ', '.join('%s %.1fkB (%s objects)' % (
+      name, size / 1024., objs) for size, name, objs in held)]
+
+    types_ = defaultdict(int)
+    objects = gc.get_objects()
+    for obj in objects:
+        types_[type(obj).__name__] += 1
+    top = sorted(types_.items(), key=lambda i: -i[1])[:count]
+    lines.append('%s tracked objects; most are %s' % (
+      len(objects), ', '.join('%s=%s' % i for i in top)))
+    del objects
+
+    if tracemalloc and tracemalloc.is_tracing():
+        current, peak = tracemalloc.get_traced_memory()
+        stats = tracemalloc.take_snapshot().statistics('filename')[:count]
+        lines.append('%.1fkB traced (peak %.1fkB); most from %s' % (
+          current / 1024., peak / 1024., ', '.join(
+            '%s %.1fkB' % (s.traceback[0].filename, s.size / 1024.)
+            for s in stats)))
+    return lines
+
+
+PROFILER = Profiler()
+# Replaced by a started one in lof_bot if the config asks for it
+WATCHDOG = Watchdog()
@@ -0,0 +1,324 @@
+"""
+LOF BOT REACTOR
+===============
+
+This module provides a single-threaded `select()` loop for running many bot
+connections at once. Work is done by timers and by generator-based tasks, which
+yield what they are waiting for:
+
+    def task(sock):
+        yield readable(sock, timeout=30)    # raises Timeout after 30 seconds
+        data = sock.recv(2048)
+        yield sleep(1)
+        count = yield other_task()          # runs a sub-task to its end
+        raise Return(count)                 # gives the sub-task's result
+"""
+
+import sys
+import time
+import errno
+import heapq
+import select
+import socket
+import types
+
+
+__all__ = ['Reactor', 'Task', 'Timer', 'Return', 'Timeout', 'readable',
+           'writable', 'sleep']
+
+
+class Return(Exception):
+
+    """
+    Raised by a task to finish with a result, since Python 2 generators cannot
+    return one.
+    """
+
+    def __init__(self, value=None):
+        Exception.__init__(self, value)
+        self.value = value
+
+
+class Timeout(Exception):
+
+    """
+    Thrown into a task whose wait ran out of time.
+    """
+
+
+class _Wait(object):
+    __slots__ = ('kind', 'sock', 'timeout')
+
+    def __init__(self, kind, sock, timeout):
+        self.kind = kind
+        self.sock = sock
+        self.timeout = timeout
+
+
+def readable(sock, timeout=None):
+    """
+    Wait for `sock` to be readable, for at most `timeout` seconds.
+    """
+    return _Wait('r', sock, timeout)
+
+
+def writable(sock, timeout=None):
+    """
+    Wait for `sock` to be writable, for at most `timeout` seconds.
+    """
+    return _Wait('w', sock, timeout)
+
+
+def sleep(seconds):
+    """
+    Wait for `seconds` seconds.
+    """
+    return _Wait('s', None, seconds)
+
+
+class Timer(object):
+
+    """
+    A callback scheduled on a `Reactor`. May be cancelled before it runs.
+    """
+
+    __slots__ = ('when', 'callback', 'args', 'cancelled')
+
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class Task(object):
+
+    """
+    A running generator, along with the sub-tasks it is waiting on.
+    """
+
+    def __init__(self, gen, callback=None):
+        self.stack = [gen]
+        self.callback = callback
+        self.timer = None
+        self.done = False
+        self.result = None
+        self.error = None
+
+
+class Reactor(object):
+
+    """
+    The event loop. Not thread-safe: everything must be scheduled from the
+    thread running it.
+    """
+
+    def __init__(self):
+        # sock -> task, for one-off waits
+        self.wait_read = {}
+        self.wait_write = {}
+        # sock -> callback, for persistent readers
+        self.readers = {}
+        # (when, sequence, Timer) heap
+        self.timers = []
+        self.seq = 0
+        self.running = False
+
+    ### Timers
+
+    def call_later(self, delay, callback, *args):
+        """
+        Run `callback(*args)` in `delay` seconds. Returns the `Timer`.
+        """
+        timer = Timer(time.time() + delay, callback, args)
+        self.seq += 1
+        heapq.heappush(self.timers, (timer.when, self.seq, timer))
+        return timer
+
+    def call_soon(self, callback, *args):
+        """
+        Run `callback(*args)` on the next pass through the loop.
+        """
+        return self.call_later(0, callback, *args)
+
+    ### Readers
+
+    def add_reader(self, sock, callback):
+        """
+        Call `callback()` whenever `sock` is readable, until removed.
+        """
+        self.readers[sock] = callback
+
+    def remove_reader(self, sock):
+        self.readers.pop(sock, None)
+
+    ### Tasks
+
+    def spawn(self, gen, callback=None):
+        """
+        Start running generator `gen` as a task. `callback(task)` is called
+        once it finishes. Returns the `Task`.
+        """
+        task = Task(gen, callback)
+        self.call_soon(self._step, task)
+        return task
+
+    def _step(self, task, value=None, error=None):
+        stack = task.stack
+        while True:
+            gen = stack[-1]
+            try:
+                if error is not None:
+                    req = gen.throw(error)
+                else:
+                    req = gen.send(value)
+            except Return as r:
+                value, error = r.value, None
+            except StopIteration:
+                value, error = None, None
+            except Exception as e:
+                value, error = None, e
+                exc_info = sys.exc_info()
+            else:
+                value = error = None
+                if isinstance(req, types.GeneratorType):
+                    stack.append(req)
+                    continue
+                if req is None:
+                    self.call_soon(self._step, task)
+                else:
+                    self._wait(task, req)
+                return
+
+            # The generator on top finished, so hand its result down
+            stack.pop()
+            if not stack:
+                task.done = True
+                task.result = value
+                task.error = error
+                if task.callback:
+                    task.callback(task)
+                elif error is not None:
+                    # Nobody else is going to hear about it
+                    sys.excepthook(*exc_info)
+                return
+
+    def _wait(self, task, req):
+        if req.kind == 's':
+            task.timer = self.call_later(req.timeout, self._wake, task, None)
+            return
+
+        waits = self.wait_read if req.kind == 'r' else self.wait_write
+        waits[req.sock] = task
+        if req.timeout is not None:
+            task.timer = self.call_later(req.timeout, self._wake, task,
+                                         (waits, req.sock))
+
+    def _wake(self, task, timed_out):
+        task.timer = None
+        if timed_out is None:
+            self._step(task)
+        else:
+            waits, sock = timed_out
+            del waits[sock]
+            self._step(task, error=Timeout())
+
+    def _ready(self, waits, sock):
+        task = waits.pop(sock)
+        if task.timer:
+            task.timer.cancel()
+            task.timer = None
+        self._step(task)
+
+    def _drop_bad(self):
+        """
+        Find the sockets that select() fails on, and stop waiting on them:
+        tasks waiting on one get a `socket.error`, and its reader (if any) is
+        removed and called once more, so that its recv() fails.
+        """
+        def bad(sock):
+            try:
+                select.select([sock], [], [], 0)
+            except (select.error, socket.error, ValueError):
+                return True
+            return False
+
+        error = socket.error(errno.EBADF, 'Socket closed while waited on')
+        for waits in (self.wait_read, self.wait_write):
+            for sock in [sock for sock in waits if bad(sock)]:
+                task = waits.pop(sock)
+                if task.timer:
+                    task.timer.cancel()
+                    task.timer = None
+                self._step(task, error=error)
+        for sock in [sock for sock in self.readers if bad(sock)]:
+            self.readers.pop(sock)()
+
+    ### Running
+
+    def run_once(self, timeout=None):
+        """
+        Wait for at most `timeout` seconds (or until the next timer is due),
+        then run everything that has become ready.
+        """
+        timers = self.timers
+        if timers:
+            delay = max(0, timers[0][0] - time.time())
+            timeout = delay if timeout is None else min(timeout, delay)
+
+        rlist = list(self.readers) + list(self.wait_read)
+        wlist = list(self.wait_write)
+        if rlist or wlist:
+            try:
+                rlist, wlist, _ = select.select(rlist, wlist, [], timeout)
+            except (select.error, socket.error, ValueError):
+                # A socket closed under us; tell whoever was waiting on it,
+                # or the next select() would fail all over again
+                self._drop_bad()
+                rlist = wlist = []
+        elif timeout:
+            time.sleep(timeout)
+
+        for sock in rlist:
+            if sock in self.wait_read:
+                self._ready(self.wait_read, sock)
+            else:
+                callback = self.readers.get(sock)
+                if callback:
+                    callback()
+        for sock in wlist:
+            if sock in self.wait_write:
+                self._ready(self.wait_write, sock)
+
+        now = time.time()
+        while timers and timers[0][0] <= now:
+            timer = heapq.heappop(timers)[2]
+            if not timer.cancelled:
+                timer.callback(*timer.args)
+
+    def run(self):
+        """
+        Run until `stop()` is called or there is nothing left to do.
+        """
+        self.running = True
+        while self.running and (self.timers or self.readers or
+                                self.wait_read or self.wait_write):
+            self.run_once()
+        self.running = False
+
+    def stop(self):
+        self.running = False
+
+    def run_until_complete(self, gen):
+        """
+        Run generator `gen` as a task, and the loop until it finishes. Returns
+        its result, or raises its error.
+        """
+        task = self.spawn(gen, lambda task: self.stop())
+        self.run()
+        if task.error is not None:
+            raise task.error
+        return task.result
@@ -0,0 +1,97 @@
+"""
+LOF BOT RELAY
+=============
+
+This module spreads relayed whispers over the master and every ready slave, so
+that relay capacity grows with the number of slaves rather than being capped by
+the master's send budget.
+"""
+
+import time
+
+from taskit.threaded import allocate_lock
+
+from sendq import PRIO_RELAY
+from supervisor import READY
+
+
+__all__ = ['RelayFanout']
+
+
+class RelayFanout(object):
+
+    """
+    Picks a connection for each relayed whisper. A listener sticks to the
+    connection they were last given for as long as it still has relay traffic
+    queued or unsent, and for `stick` seconds after, which keeps their
+    messages in order; otherwise the least-loaded ready connection is chosen.
+    """
+
+    def __init__(self, master, stick=1.):
+        self.master = master
+        self.stick = stick
+        self.lock = allocate_lock()
+        # listener -> (bot, time of the last whisper relayed through it)
+        self.assigned = {}
+        # account -> whispers relayed
+        self.sent = {}
+        # Whispers with no connection to go out on
+        self.dropped = 0
+
+    def _ready(self, bot):
+        """
+        Get `bot`'s send queue if it can take whispers, otherwise None.
+        """
+        # Read once; the reactor may clear it at any time
+        sendq = bot.sendq
+        if sendq is not None and bot.state == READY:
+            return sendq
+        return None
+
+    def _load(self, sendq):
+        return sendq.depth()[PRIO_RELAY]
+
+    def _pick(self, nick, now):
+        bot, last = self.assigned.get(nick, (None, 0))
+        if bot is not None:
+            sendq = self._ready(bot)
+            if sendq is not None and (
+               now - last < self.stick or sendq.pending is not None or
+               self._load(sendq)):
+                return bot
+
+        ready = [(b, self._ready(b))
+                 for b in [self.master] + self.master.slavelist]
+        ready = [(b, sendq) for b, sendq in ready if sendq is not None]
+        if not ready:
+            # Bots on threads of their own have no send queues, and send
+            # straight away; on a reactor, nobody is connected
+            return None if self.master.reactor else self.master
+        return min(ready, key=lambda pair: self._load(pair[1]))[0]
+
+    def whisper(self, nick, msg):
+        """
+        Relay whisper `msg` to `nick` through whichever connection is best,
+        or drop it if none is connected.
+        """
+        now = time.time()
+        with self.lock:
+            bot = self._pick(nick, now)
+            if bot is None:
+                self.dropped += 1
+                return
+            self.assigned[nick] = (bot, now)
+            bot.whisper(nick, msg, PRIO_RELAY)
+            self.sent[bot.account] = self.sent.get(bot.account, 0) + 1
+
+    def stats(self):
+        """
+        Get a list of (account, whispers relayed, relay whispers waiting) for
+        the master and every slave.
+        """
+        stats = []
+        for b in [self.master] + self.master.slavelist:
+            sendq = b.sendq
+            stats.append((b.account, self.sent.get(b.account, 0),
+                          self._load(sendq) if sendq else 0))
+        return stats
@@ -0,0 +1,132 @@
+#! /usr/bin/env python
+"""
+LOF BOT REPLAY
+==============
+
+Feeds the in-coming packets of a capture (see capture.py) back through
+`PacketBuffer` and a client's packet handling, at the recorded speed or as fast
+as possible, and reports throughput and per-packet handling latency. Nothing is
+sent anywhere; out-going packets are only counted.
+
+    python replay.py [--realtime] [--bot] [--workers N] some.cap
+
+`--bot` replays through a full `LOFBot` set up from config.py, mods and all,
+rather than a bare `TMWAClient`. `--workers N` hands packets to a `Dispatcher`
+with N workers, as the live bot does, rather than handling them inline.
+"""
+
+import sys
+import time
+
+from capture import read_capture, IN
+from dispatch import Dispatcher
+import lof_bot
+from lof_bot import TMWAClient, LOFBot, BotBase, LOFLogNode
+from utils import percentile
+from wire import PacketBuffer
+
+
+class ReplayMixin(object):
+
+    """
+    Turns a client class into one without a connection.
+    """
+
+    def __init__(self, *args, **kw):
+        self.sent = 0
+        self.latencies = []
+        super(ReplayMixin, self).__init__('replay', 0, 'replay', '', *args,
+                                          **kw)
+        self.buff = PacketBuffer()
+        self.ready = True
+        self.update_subscriptions()
+
+    def send(self, packet, priority=0):
+        self.sent += 1
+
+    def _handle_packet(self, packet):
+        try:
+            super(ReplayMixin, self)._handle_packet(packet)
+        finally:
+            self.latencies.append(time.time() - packet.queued)
+
+
+def make_client(bot=False):
+    """
+    Set up a connection-less client to replay through.
+    """
+    # Stand in for the logger that lof_bot's __main__ sets up
+    lof_bot.log = log = LOFLogNode(())
+    TMWAClient.set_log(log)
+    if not bot:
+        return type('ReplayClient', (ReplayMixin, TMWAClient), {})()
+
+    import config
+    BotBase.set_mod_conf(config.mod_conf)
+    LOFBot.set_mods(config.master_mods)
+    client = type('ReplayBot', (ReplayMixin, LOFBot), {})()
+    client.online_players = []
+    return client
+
+
+def replay(records, client, dispatcher=None, realtime=False):
+    """
+    Replay the in-coming (timestamp, direction, data) `records` through
+    `client`. Returns (packets fed, seconds taken).
+    """
+    buff = client.buff
+    count = 0
+    first = None
+    start = time.time()
+
+    for timestamp, direction, data in records:
+        if direction != IN:
+            continue
+        if realtime:
+            if first is None:
+                first = timestamp
+            delay = (timestamp - first) - (time.time() - start)
+            if delay > 0:
+                time.sleep(delay)
+
+        buff.feed(data)
+        for packet in buff:
+            packet.queued = time.time()
+            count += 1
+            if dispatcher:
+                dispatcher.submit(client, packet)
+            else:
+                client._handle_packet(packet)
+
+    # Wait for the workers to catch up
+    while len(client.latencies) < count:
+        time.sleep(.001)
+    return count, time.time() - start
+
+
+def main(args):
+    realtime = '--realtime' in args
+    bot = '--bot' in args
+    workers = 0
+    if '--workers' in args:
+        workers = int(args[args.index('--workers') + 1])
+    path = args[-1]
+
+    client = make_client(bot)
+    # 'block' so that nothing is shed and every packet is accounted for
+    dispatcher = Dispatcher(workers, overload='block') if workers else None
+    with open(path, 'rb') as f:
+        count, taken = replay(read_capture(f), client, dispatcher, realtime)
+
+    lat = sorted(client.latencies)
+    skipped = sum(client.buff.skipped.values())
+    print('%s packets handled (%s skipped) in %.3fs: %d packets/s' % (
+      count, skipped, taken, (count + skipped) / max(taken, 1e-9)))
+    if lat:
+        print('latency ms: p50 %.3f, p90 %.3f, p99 %.3f, max %.3f' % tuple(
+          1000 * percentile(lat, p) for p in (50, 90, 99, 100)))
+    print('%s packets sent in response' % client.sent)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -15,6 +15,76 @@ master = ('GeorgeBot', 'channel_0', 'my_p@ssw0rd_is_dud3', 'North')
 slaves = [('GeorgeBot_s1', 'channel_s1', 'cH33z3_Gr1n_4_u', 'East'), 
           ('GeorgeBot_s2', 'channel_s2', 'Lo57_1337!_5oS', 'West')]
 
+### Packet dispatch ##########
+
+# `workers` threads handle packets off at most `queue` waiting ones. `order` 
+# keeps packets about the same 'being' or of the same 'type' in order (or None 
+# for no ordering), and `overload` either 'shed's relay chatter or 'block's 
+# receiving when the queue is full.
+dispatch = {'workers': 4, 'queue': 512, 'order': 'being', 'overload': 'shed'}
+
+### Send queue ###############
+
+# Chat goes out at `rate` packets a second per bot, with up to `burst` saved 
+# up; queued packets are flushed together every `tick` seconds, and a peer 
+# which takes nothing for `timeout` seconds is dropped.
+send = {'rate': 1.5, 'burst': 6, 'tick': 0.05, 'timeout': 120}
+
+### Connection supervision ###
+
+# Ping every `ping_interval` seconds; a connection silent for `degraded_after` 
+# intervals is degraded, and after `dead_after` it is reconnected, waiting 
+# `backoff` seconds (doubling per failure, up to `backoff_max`) between tries.
+supervision = {'ping_interval': 15, 'degraded_after': 2, 'dead_after': 4, 
+               'backoff': 1, 'backoff_max': 60}
+
+### Periodic callbacks #######
+
+# Each bot runs its mods' periodic callbacks on a pool of `workers` threads.
+scheduler = {'workers': 2}
+
+### Log writing ############
+
+# Log files are written in batches every `interval` seconds; past `limit` 
+# waiting records, the less important ones are dropped.
+log_writer = {'interval': 0.1, 'limit': 10000}
+
+# Log files are set aside once they pass `max_bytes` or have been open for 
+# `max_age` seconds, and gzipped if `compress`; the newest `keep` are kept. 
+# Unknown packets go to lofbot.net.pkt, which capture.py reads.
+log_files = {'max_bytes': 10 * 2 ** 20, 'max_age': 24 * 3600, 'keep': 10, 
+             'compress': True}
+
+### Traffic capture ##########
+
+# A directory to record every bot's packets to (see capture.py and replay.py), 
+# or None.
+capture_dir = None
+
+### Database ###############
+
+# At most `max_size` connections are open at once; a thread waits up to 
+# `timeout` seconds for one. Connections idle for `idle_timeout` seconds are 
+# closed, and ones checked out for `leak_timeout` seconds are logged, along 
+# with where they were checked out.
+sql_pool = {'max_size': 8, 'timeout': 10, 'idle_timeout': 300, 
+            'leak_timeout': 60}
+
+### Diagnostics ##############
+
+# When a command or a periodic callback runs for over its budget (seconds, or 
+# None for no limit), the stacks of all threads are written to `path`. None to 
+# not watch them.
+watchdog = {'path': 'lofbot.stacks.log', 'command_budget': 2., 
+            'periodic_budget': 10.}
+
+### Metrics ##################
+
+# Every `interval` seconds, all metrics (see `.admin stats`) are written to 
+# `path` as 'json' or 'prometheus' text. None to not write them.
+metrics_dump = {'path': 'lofbot.metrics.json', 'interval': 60, 
+                'format': 'json'}
+
 ### Mod lists ################
 
 master_mods = ['ping', 'online', 'tell', 'listing', 'translate', 'listen', 
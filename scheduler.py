@@ -0,0 +1,262 @@
+"""
+LOF BOT SCHEDULER
+=================
+
+This module runs the periodic callbacks of mods, each on its own cadence. Mods
+list them in `periodic`, either by name or as a (name, options) pair:
+
+    periodic = ['ping_cb', ('get_playerlist', dict(interval=30, timeout=20))]
+
+The options are those of `Job`. Due runs are found by a reactor timer and run
+on a small pool of worker threads, so that one slow callback only ever holds up
+itself.
+"""
+
+import sys
+import time
+import heapq
+import random
+
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+
+from taskit.log import IMPORTANT
+from taskit.threaded import threaded, allocate_lock
+
+import metrics
+import profiler
+
+
+__all__ = ['Scheduler', 'Job']
+
+
+JOB_SECONDS = metrics.histogram('lofbot_periodic_seconds', 
+                                'Periodic callback run times, by callback', 
+                                'job')
+JOB_ERRORS = metrics.counter('lofbot_periodic_errors_total', 
+                             'Periodic callback failures, by callback', 'job')
+JOB_TIMEOUTS = metrics.counter('lofbot_periodic_timeouts_total', 
+                               'Periodic callback timeouts, by callback', 
+                               'job')
+
+
+class Job(object):
+
+    """
+    A callback run every `interval` seconds, along with its statistics.
+    """
+
+    def __init__(self, name, func, interval=12, jitter=0, timeout=None,
+                 overlap=False, delay=0):
+        """
+        jitter  -- Up to this many seconds are added to each due time at
+                   random, to keep jobs from bunching up.
+        timeout -- Seconds a run may take before it is given up on; it is left
+                   to finish, but no longer counts as running, and its worker
+                   is replaced. Defaults to `interval`.
+        overlap -- Whether a run may start while the last is still going;
+                   otherwise a run falling due then is skipped.
+        delay   -- Seconds before the first run.
+        """
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.jitter = jitter
+        self.timeout = interval if timeout is None else timeout
+        self.overlap = overlap
+        self.delay = delay
+
+        # The unjittered due time, which advances by exactly `interval`
+        self.base = None
+        self.due = None
+        # Run number -> start time (None while queued), for the runs going
+        self.running = {}
+        self.started = 0
+
+        self.runs = 0
+        self.skips = 0
+        self.timeouts = 0
+        self.errors = 0
+        self.run_time = 0.
+        self.worst_run = 0.
+        self.late = 0.
+        self.worst_late = 0.
+
+    def stats(self):
+        """
+        Get a dict of the runs finished, skipped, timed out and failed, the
+        average and worst run time and lateness in seconds, the number running
+        now, and the seconds until the next run.
+        """
+        runs = self.runs or 1
+        started = self.started or 1
+        return dict(name=self.name, interval=self.interval, runs=self.runs,
+                    skips=self.skips, timeouts=self.timeouts,
+                    errors=self.errors, avg_run=self.run_time / runs,
+                    worst_run=self.worst_run, avg_late=self.late / started,
+                    worst_late=self.worst_late, running=len(self.running),
+                    next=self.due - time.time() if self.due else None)
+
+
+class Scheduler(object):
+
+    """
+    Runs `Job`s on a pool of `workers` threads, timed by `reactor`. Jobs may
+    be changed from any thread.
+    """
+
+    # Most seconds between checks, which bounds how long a change of jobs or
+    # a timeout takes to be noticed
+    max_sleep = 1.
+
+    def __init__(self, reactor, workers=2, args=(), log=None):
+        """
+        args -- Passed to every callback.
+        log  -- A `log(level, msg)` function for timeouts.
+        """
+        self.reactor = reactor
+        self.workers = workers
+        self.args = args
+        self.log = log
+
+        self.lock = allocate_lock()
+        self.jobs = {}
+        # (due, sequence, job) heap
+        self.heap = []
+        self.seq = 0
+        self.queue = Queue()
+        self.pool = False
+        self.timer = None
+
+    def start(self):
+        """
+        Start (or resume) running jobs.
+        """
+        if not self.pool:
+            self.pool = True
+            for i in range(self.workers):
+                threaded(self._work, ())
+        if self.timer is None:
+            self.timer = self.reactor.call_soon(self._tick)
+
+    def stop(self):
+        """
+        Stop starting runs until `start()`ed again. Runs already going are
+        left to finish.
+        """
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+
+    def set_jobs(self, jobs):
+        """
+        Replace all the jobs with `jobs`. A job taking the place of one of the
+        same name keeps its schedule and statistics.
+        """
+        now = time.time()
+        with self.lock:
+            old = self.jobs
+            self.jobs = {}
+            self.heap = []
+            for job in jobs:
+                prev = old.get(job.name)
+                if prev is not None:
+                    for attr in ('func', 'interval', 'jitter', 'timeout',
+                                 'overlap'):
+                        setattr(prev, attr, getattr(job, attr))
+                    job = prev
+                else:
+                    job.base = now + job.delay
+                    job.due = job.base + random.uniform(0, job.jitter)
+                self.jobs[job.name] = job
+                self._push(job)
+
+    def _push(self, job):
+        self.seq += 1
+        heapq.heappush(self.heap, (job.due, self.seq, job))
+
+    def _advance(self, job, now):
+        job.base += job.interval
+        if job.base < now - job.interval:
+            # Far behind (stopped for a while?); don't try to catch up
+            job.base = now
+        job.due = job.base + random.uniform(0, job.jitter)
+        self._push(job)
+
+    def _tick(self):
+        now = time.time()
+        with self.lock:
+            heap = self.heap
+            while heap and heap[0][0] <= now:
+                due, seq, job = heapq.heappop(heap)
+                if job.running and not job.overlap:
+                    job.skips += 1
+                else:
+                    job.started += 1
+                    run = job.started
+                    job.running[run] = None
+                    self.queue.put((job, run, due))
+                self._advance(job, now)
+
+            for job in self.jobs.values():
+                for run, start in list(job.running.items()):
+                    if start is not None and now - start > job.timeout:
+                        self._expire(job, run)
+
+            delay = self.max_sleep
+            if heap:
+                delay = min(delay, max(0, heap[0][0] - now))
+        self.timer = self.reactor.call_later(delay, self._tick)
+
+    def _expire(self, job, run):
+        del job.running[run]
+        job.timeouts += 1
+        JOB_TIMEOUTS[job.name].inc()
+        if self.log:
+            self.log(IMPORTANT, 'Periodic callback %s has been running for '
+                                'over %ss; no longer waiting for it.' %
+                                (job.name, job.timeout))
+        # Don't let it tie up the pool; its worker retires once it finishes
+        threaded(self._work, ())
+
+    def _work(self):
+        queue = self.queue
+        while True:
+            job, run, due = queue.get()
+
+            start = time.time()
+            late = start - due
+            with self.lock:
+                job.running[run] = start
+                job.late += late
+                job.worst_late = max(job.worst_late, late)
+
+            watchdog = profiler.WATCHDOG
+            token = watchdog.begin(job.name, watchdog.periodic_budget)
+            try:
+                job.func(*self.args)
+            except Exception:
+                job.errors += 1
+                JOB_ERRORS[job.name].inc()
+                sys.excepthook(*sys.exc_info())
+
+            taken = time.time() - start
+            watchdog.end(token)
+            JOB_SECONDS[job.name].observe(taken)
+            with self.lock:
+                replaced = job.running.pop(run, None) is None
+                job.runs += 1
+                job.run_time += taken
+                job.worst_run = max(job.worst_run, taken)
+            if replaced:
+                return
+
+    def stats(self):
+        """
+        Get the `Job.stats()` of every job, in the order they next run.
+        """
+        with self.lock:
+            jobs = sorted(self.jobs.values(), key=lambda job: job.due)
+        return [job.stats() for job in jobs]
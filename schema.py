@@ -8,7 +8,8 @@ db_loc = os.path.join(os.path.dirname(__file__), 'database.sqlite')
 
 
 def connector():
-    conn = sqlite3.connect(db_loc)
+    # Pooled connections move between threads
+    conn = sqlite3.connect(db_loc, check_same_thread=False)
     conn.text_factory = str
     return conn
 
@@ -22,6 +23,7 @@ class Listing(BaseMapper):
     # word: one like "at" or "for", used in a phrase like "50 shoes for 500gp"
     columns = (Integer('price'), Integer('quantity'),
                VarChar('seller', 30), VarChar('item', 40), VarChar('word', 10))
+    indexes = (Index('seller'),)
 
     def add(self):
         if not self._in_db:
@@ -39,16 +41,20 @@ class Listing(BaseMapper):
 class Message(BaseMapper):
     tablename = 'message'
     columns = (VarChar('text', 200), VarChar('recipient', 30))
+    indexes = (Index('recipient'),)
 
 
 class Listener(BaseMapper):
     tablename = 'listener'
     columns = (VarChar('listener', 30), Integer('listening'), Text('ignores'))
+    indexes = (Index('listener'), Index('listening'))
 
 
 class Price(BaseMapper):
     tablename = 'price'
     columns = (VarChar('item', 40), Integer('quantity'), Integer('price'))
+    # Covers `.tmw-price`, which then never reads the table itself
+    indexes = (Index('item', 'quantity', 'price'),)
 
     @classmethod
     def clear_table(cls):
@@ -58,6 +64,23 @@ class Price(BaseMapper):
 class Sighting(BaseMapper):
     tablename = 'sighting'
     columns = (VarChar('player', 30), Integer('time'), Integer('count'))
+    # One row per player, which `refresh_sightings()` upserts on
+    indexes = (Unique('player'), Index('time'), Index('count'))
+
+    @classmethod
+    def migrate(cls):
+        # The get-or-create this used to be kept with could race, leaving 
+        # players with several rows; merge them into the first
+        curs = get_cursor()
+        curs.execute('update sighting set '
+                     'count=(select sum(s.count) from sighting s '
+                     'where s.player=sighting.player), '
+                     'time=(select max(s.time) from sighting s '
+                     'where s.player=sighting.player) '
+                     'where player in (select player from sighting '
+                     'group by player having count(*) > 1)')
+        curs.execute('delete from sighting where id not in '
+                     '(select min(id) from sighting group by player)')
 
 
 # For persisting singletons
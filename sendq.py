@@ -0,0 +1,185 @@
+"""
+LOF BOT SEND QUEUE
+==================
+
+This module provides the per-connection out-going packet scheduler. Packets are
+queued by priority from any thread and written out by a reactor timer, which
+coalesces everything it may send in one tick into a single `send()`. Chat is
+paced by a token bucket so that tmwAthena's flood protection never mutes or
+kicks the bot.
+
+Sends never block, since the reactor thread is shared by every bot: whatever
+the socket won't take now is kept, and finished on later ticks before anything
+else goes out.
+"""
+
+import time
+import errno
+import socket
+from collections import deque
+
+from taskit.threaded import allocate_lock
+
+from wire import BYTES_OUT
+
+
+__all__ = ['SendQueue', 'PRIO_CONTROL', 'PRIO_COMMAND', 'PRIO_RELAY',
+           'PRIO_COSMETIC']
+
+
+## Priority lanes, most urgent first
+
+# Protocol upkeep (pings, name requests, movement); never held back
+PRIO_CONTROL = 0
+# Replies to commands, and anything else a player is waiting on
+PRIO_COMMAND = 1
+# Relayed chatter
+PRIO_RELAY = 2
+# Emotes, facing and the like
+PRIO_COSMETIC = 3
+
+LANE_NAMES = ['control', 'command', 'relay', 'cosmetic']
+
+
+class SendQueue(object):
+
+    """
+    Queues out-going packets for one connection. Every lane but
+    `PRIO_CONTROL` costs a token per packet; tokens come back at `rate` per
+    second, up to `burst` saved up.
+    """
+
+    def __init__(self, reactor, conn, rate=1.5, burst=6, tick=0.05,
+                 timeout=120, on_error=None):
+        """
+        tick     -- Seconds between flushes.
+        timeout  -- Seconds the socket may take no data at all before sending 
+                    fails.
+        on_error -- Called with the `socket.error` if sending fails.
+        """
+        self.reactor = reactor
+        self.conn = conn
+        self.rate = rate
+        self.burst = burst
+        self.tick = tick
+        self.timeout = timeout
+        self.on_error = on_error
+
+        self.lanes = [deque() for name in LANE_NAMES]
+        self.lock = allocate_lock()
+        self.tokens = burst
+        self.refilled = time.time()
+        self.timer = None
+        # Bytes the socket has yet to take, and since when it has taken none
+        self.pending = None
+        self.stalled = None
+
+        # Per lane: packets sent, total and worst seconds spent queued
+        self.sent = [0] * len(LANE_NAMES)
+        self.waited = [0.] * len(LANE_NAMES)
+        self.worst = [0.] * len(LANE_NAMES)
+        self.flushes = 0
+
+    def start(self):
+        # From now on everything goes out through here, a bit at a time
+        self.conn.setblocking(False)
+        self.timer = self.reactor.call_later(self.tick, self._flush)
+
+    def close(self):
+        """
+        Stop flushing. Anything still queued is dropped.
+        """
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        self.pending = None
+
+    def put(self, data, priority=PRIO_CONTROL):
+        """
+        Queue packet bytes `data` in lane `priority`. Thread-safe.
+        """
+        with self.lock:
+            self.lanes[priority].append((time.time(), data))
+
+    def _flush(self):
+        self.timer = self.reactor.call_later(self.tick, self._flush)
+
+        now = time.time()
+        if self.pending is not None:
+            # The rest of what was started goes first, to keep packets whole
+            # and in order
+            self._send(self.pending, now)
+            if self.pending is not None:
+                return
+
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.refilled) * self.rate)
+        self.refilled = now
+
+        chunks = []
+        with self.lock:
+            for priority, lane in enumerate(self.lanes):
+                while lane:
+                    if priority != PRIO_CONTROL:
+                        if self.tokens < 1:
+                            break
+                        self.tokens -= 1
+                    queued, data = lane.popleft()
+                    chunks.append(data)
+
+                    waited = now - queued
+                    self.sent[priority] += 1
+                    self.waited[priority] += waited
+                    if waited > self.worst[priority]:
+                        self.worst[priority] = waited
+
+        if not chunks:
+            return
+        self.flushes += 1
+        self._send(bytearray().join(chunks), now)
+
+    def _send(self, data, now):
+        """
+        Send as much of `data` as the socket takes without blocking, keeping
+        the rest as `pending`.
+        """
+        try:
+            sent = self.conn.send(data)
+        except socket.error as e:
+            if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                self._fail(e)
+                return
+            sent = 0
+        BYTES_OUT.inc(sent)
+
+        if sent == len(data):
+            self.pending = self.stalled = None
+            return
+        self.pending = data[sent:]
+        if sent or self.stalled is None:
+            self.stalled = now
+        elif now - self.stalled > self.timeout:
+            self._fail(socket.timeout('send queue stalled for %ss' %
+                                      self.timeout))
+
+    def _fail(self, error):
+        self.close()
+        if self.on_error:
+            self.on_error(error)
+
+    def depth(self):
+        """
+        Get the number of packets waiting in each lane. Bytes the socket has
+        yet to take are not counted.
+        """
+        return [len(lane) for lane in self.lanes]
+
+    def stats(self):
+        """
+        Get a list of (lane name, waiting, sent, average wait, worst wait)
+        for every lane, with the waits in seconds.
+        """
+        return [(name, len(self.lanes[i]), self.sent[i],
+                 self.waited[i] / self.sent[i] if self.sent[i] else 0.,
+                 self.worst[i])
+                for i, name in enumerate(LANE_NAMES)]
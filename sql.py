@@ -1,7 +1,7 @@
 """
 MicrORM+ is a mini ORM with mega features. It is fully SQLite3 thread-safe, and 
 also supports MySQL for larger installations. Compared to SQLAlchemy, MicrORM+ 
-is much smaller, at less than 350 lines; much less magical; and, with almost 
+is much smaller, at a few hundred lines; much less magical; and, with almost 
 all functionality in one well-documented class, much more obvious and readable. 
 Plus, MicrORM+'s interface is quite similar to that of Django's DB, and easier 
 to use than SQLAchemy's powerful but esoteric codebase.
@@ -11,100 +11,500 @@ Copyright (c) 2012-2013 Daniel Foerster/Dsigner Software <pydsigner@gmail.com>
 and released under the LGPL, version 3 or later.
 """
 
-__version__ = '1.4.1'
+__version__ = '1.5.0'
 
 
 import sys
 import os
+import time
+import copy
+import weakref
+import itertools
+import threading
+import traceback
+from contextlib import contextmanager
 
 try:
-    from thread import get_ident
+    import metrics
 except ImportError:
-    from _thread import get_ident
+    # Used on its own, without the LoF bot
+    metrics = None
 
 
 __all__ = ['init', 'get_cursor', 'get_connection', 'close_connection', 
-           'commit_and_close', 'initialize_database', 'comp', 'ID', 'Integer', 
-           'Float', 'VarChar', 'Text', 'DateTime', 'BaseMapper']
+           'commit_and_close', 'connection', 'set_pool_options', 'pool_stats', 
+           'session', 'Session', 'initialize_database', 'comp', 'ID', 
+           'Integer', 'Float', 'VarChar', 'Text', 'DateTime', 'Index', 
+           'Unique', 'BaseMapper', 'Query', 'ConnectionPool', 'PoolTimeout']
 
 
-_cursor_pool = {}
-_connector = None
+_pool = None
+_pool_options = {}
 _dictify = None
+# This thread's `Session`, as `session`
+_sessions = threading.local()
 
+# Every ORM operation fetches the cursor once per statement
+if metrics:
+    _queries = metrics.counter('lofbot_sql_queries_total', 
+                               'Database cursor fetches, about one per query')
+else:
+    _queries = None
 
-def init(connector, converter):
+
+class PoolTimeout(Exception):
+    
+    """
+    Raised when no connection frees up in time.
+    """
+
+
+class _Binding(object):
+    
+    """
+    A thread's hold on a connection. It goes away with the thread, which is 
+    how leaked connections are found.
+    """
+    
+    __slots__ = ('conn', 'cursor', 'depth', '__weakref__')
+    
+    def __init__(self, conn):
+        self.conn = conn
+        self.cursor = conn.cursor()
+        # `connection()` blocks entered
+        self.depth = 0
+
+
+class ConnectionPool(object):
+    
+    """
+    Up to `max_size` connections made by `connector`, each checked out by one 
+    thread at a time. Connections must be usable from any thread (for 
+    SQLite3, `check_same_thread=False`). Thread-safe.
+    
+    A thread checks out a connection on its first `get_cursor()`, and keeps it 
+    until `close_connection()` or the end of the outermost `connection()` 
+    block. Connections idle for over `idle_timeout` seconds are closed. Ones 
+    checked out for over `leak_timeout` seconds are reported through `warn`, 
+    along with where they were checked out, and those of threads that have 
+    finished are taken back.
+    """
+    
+    # Seconds between checks for idle and leaked connections
+    sweep_interval = 1.
+    
+    def __init__(self, connector, max_size=8, timeout=10., idle_timeout=300., 
+                 leak_timeout=60., track_stacks=True, warn=None):
+        """
+        timeout      -- Seconds to wait for a connection when all are out, 
+                        before raising `PoolTimeout`.
+        track_stacks -- Whether to note where each connection was checked out, 
+                        for leak reports.
+        warn         -- A function taking a message, for leak reports; by 
+                        default they go to stderr.
+        """
+        self.connector = connector
+        self.max_size = max_size
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.leak_timeout = leak_timeout
+        self.track_stacks = track_stacks
+        self.warn = warn
+        
+        self.cond = threading.Condition()
+        # (connection, checked in at), least recently used first
+        self.idle = []
+        # connection -> [weak reference to the `_Binding` (None if checked 
+        # out by hand), checked out at, stack, reported]
+        self.busy = {}
+        # Each thread's `_Binding`, as `binding`
+        self.local = threading.local()
+        self.swept = time.time()
+        
+        self.created = self.checkouts = self.waits = self.timeouts = 0
+        self.evicted = self.leaks = self.reclaimed = self.peak = 0
+    
+    def checkout(self):
+        """
+        Check a connection out, making one if there are fewer than `max_size` 
+        and none idle, or waiting for one otherwise.
+        """
+        stack = traceback.extract_stack()[:-2] if self.track_stacks else None
+        with self.cond:
+            deadline = None
+            while True:
+                self._sweep()
+                if self.idle:
+                    conn = self.idle.pop()[0]
+                    break
+                if len(self.busy) < self.max_size:
+                    conn = self.connector()
+                    self.created += 1
+                    break
+                now = time.time()
+                if deadline is None:
+                    deadline = now + self.timeout
+                    self.waits += 1
+                if now >= deadline:
+                    self.timeouts += 1
+                    raise PoolTimeout('All %s connections are checked out!' % 
+                                      self.max_size)
+                # Wake up now and then to look for finished threads' 
+                # connections
+                self.swept = 0
+                self.cond.wait(min(deadline - now, self.sweep_interval))
+            
+            self.busy[conn] = [None, time.time(), stack, False]
+            self.checkouts += 1
+            self.peak = max(self.peak, len(self.busy))
+        return conn
+    
+    def checkin(self, conn):
+        """
+        Return a connection, rolling back anything not committed.
+        """
+        try:
+            conn.rollback()
+            broken = False
+        except Exception:
+            # Make room for a new one
+            self._close(conn)
+            broken = True
+        with self.cond:
+            # Unless it was taken back as leaked
+            if self.busy.pop(conn, None) is not None and not broken:
+                self.idle.append((conn, time.time()))
+            self.cond.notify()
+    
+    def cursor(self):
+        """
+        Get the cursor of this thread's connection, checking one out if need 
+        be.
+        """
+        binding = getattr(self.local, 'binding', None)
+        if binding is None:
+            conn = self.checkout()
+            binding = self.local.binding = _Binding(conn)
+            self.busy[conn][0] = weakref.ref(binding)
+        return binding.cursor
+    
+    def release(self, commit=False):
+        """
+        Check this thread's connection back in, if it has one, committing 
+        first if `commit`.
+        """
+        binding = getattr(self.local, 'binding', None)
+        if binding:
+            self.local.binding = None
+            if commit:
+                binding.conn.commit()
+            self.checkin(binding.conn)
+    
+    @contextmanager
+    def connection(self, commit=False):
+        """
+        Give this thread a connection for the length of a `with` block, 
+        committing at the end if `commit` and nothing went wrong. Blocks may 
+        be nested; the outermost checks the connection back in.
+        """
+        self.cursor()
+        binding = self.local.binding
+        binding.depth += 1
+        try:
+            yield binding.conn
+            if commit:
+                binding.conn.commit()
+        finally:
+            binding.depth -= 1
+            if not binding.depth:
+                self.release()
+    
+    def _close(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+    
+    def _sweep(self):
+        # Call with `cond` held
+        now = time.time()
+        if now - self.swept < self.sweep_interval:
+            return
+        self.swept = now
+        
+        while self.idle and now - self.idle[0][1] > self.idle_timeout:
+            self._close(self.idle.pop(0)[0])
+            self.evicted += 1
+        
+        if not self.busy:
+            return
+        for conn, info in list(self.busy.items()):
+            owner, since, stack, reported = info
+            if owner is not None and owner() is None:
+                # Its thread has finished
+                del self.busy[conn]
+                self.reclaimed += 1
+                if not reported:
+                    self.leaks += 1
+                    self._report(info, 'was never checked back in by its '
+                                       'thread, which has finished')
+                try:
+                    conn.rollback()
+                    self.idle.append((conn, now))
+                except Exception:
+                    self._close(conn)
+            elif not reported and now - since > self.leak_timeout:
+                info[3] = True
+                self.leaks += 1
+                self._report(info, 'has been checked out for %.1fs' % 
+                                   (now - since))
+    
+    def _report(self, info, what):
+        msg = 'A database connection %s.' % what
+        if info[2]:
+            msg += ' It was checked out at:\n' + ''.join(
+              traceback.format_list(info[2])).rstrip()
+        if self.warn:
+            self.warn(msg)
+        else:
+            sys.stderr.write(msg + '\n')
+    
+    def stats(self):
+        """
+        Get a dict of the connections open, idle and checked out (and the 
+        most ever out at once), plus counts of connections made, checkouts, 
+        waits, timeouts, idle connections closed, leaks and leaked 
+        connections taken back.
+        """
+        with self.cond:
+            return dict(size=len(self.idle) + len(self.busy), 
+                        idle=len(self.idle), busy=len(self.busy), 
+                        max_size=self.max_size, peak=self.peak, 
+                        created=self.created, checkouts=self.checkouts, 
+                        waits=self.waits, timeouts=self.timeouts, 
+                        evicted=self.evicted, leaks=self.leaks, 
+                        reclaimed=self.reclaimed)
+
+
+def init(connector, converter, **options):
     """
     Set the connection generator and the row2dict-like converter. Must be 
-    called before accessing the database.
+    called before accessing the database. `options` are passed on to the 
+    `ConnectionPool`.
     """
-    global _connector, _dictify
-    _connector = connector
+    global _pool, _dictify
+    _pool_options.update(options)
+    _pool = ConnectionPool(connector, **_pool_options)
     _dictify = converter
 
 
+def set_pool_options(**options):
+    """
+    Change the `ConnectionPool`'s `max_size`, `timeout`, `idle_timeout`, 
+    `leak_timeout`, `track_stacks` or `warn`. May be called before `init()`.
+    """
+    for name in options:
+        if name not in ('max_size', 'timeout', 'idle_timeout', 
+                        'leak_timeout', 'track_stacks', 'warn'):
+            raise TypeError('No such pool option: %s' % name)
+    _pool_options.update(options)
+    if _pool:
+        for name, value in options.items():
+            setattr(_pool, name, value)
+
+
+def pool_stats():
+    """
+    Get the `ConnectionPool.stats()`, or None before `init()`.
+    """
+    return _pool.stats() if _pool else None
+
+
 def get_cursor():
     """
-    Get or create the cursor for this thread.
+    Get the cursor for this thread, checking a connection out of the pool if 
+    this thread has none.
     """
-    tid = get_ident()
-    if tid in _cursor_pool:
-        return _cursor_pool[tid]
-    
-    conn = _connector()
-    curs = conn.cursor()
-    _cursor_pool[tid] = curs
-    return curs
+    if _queries:
+        _queries.inc()
+    return _pool.cursor()
 
 
 def get_connection():
     """
-    Get or create the connection for this thread.
+    Get the connection for this thread, checking one out if need be.
     """
-    return get_cursor().connection
+    return _pool.cursor().connection
+
+
+def connection(commit=False):
+    """
+    A context manager giving this thread a connection for the length of a 
+    `with` block:
+    
+        with connection(commit=True):
+            Listener.get(listener=nick).listening = True
+    
+    Uncommitted changes are rolled back at the end. See 
+    `ConnectionPool.connection()`.
+    """
+    return _pool.connection(commit)
 
 
 def close_connection():
     """
-    Close the connection for this thread, if there is one. It's a Good Idea for 
-    the threads of long-running processes to close their database connections 
-    after finishing their actual DB communications (setting column values, 
-    add()ing, get()ing, remove()ing, and filter()ing all access the database) 
-    to avoid having a cache full of connections that will never be used again. 
-    Although these connections may be reused in a different thread with the 
-    same identification, this is unlikely, as many possible thread IDs exist.
+    Check this thread's connection back into the pool, if it has one, rolling 
+    back anything not committed. Threads should do this when they are done 
+    with the database (setting column values, add()ing, get()ing, remove()ing, 
+    and filter()ing all use it), or use `connection()`; a connection kept 
+    longer holds up the rest of the pool, and is reported as a leak.
     """
-    tid = get_ident()
-    if tid in _cursor_pool:
-        _cursor_pool.pop(tid).connection.close()
+    _pool.release()
 
 
 def commit_and_close():
     """
     Same as `close_connection()` above, but commits changes first.
     """
-    tid = get_ident()
-    if tid in _cursor_pool:
-        c = _cursor_pool.pop(tid).connection
-        c.commit()
-        c.close()
+    _pool.release(commit=True)
+
+
+class Session(object):
+    
+    """
+    A unit of work: while one is open on a thread (see `session()`), setting 
+    a column only marks the row dirty, and `flush()` writes each dirty row 
+    with one UPDATE, batching rows that changed the same columns into one 
+    `executemany()`. Queries flush first, so that they see the changes. Rows 
+    are still added and removed right away.
+    """
+    
+    def __init__(self):
+        # row -> numbers of the columns changed
+        self.dirty = {}
+    
+    def _mark(self, row, i):
+        cols = self.dirty.get(row)
+        if cols is None:
+            cols = self.dirty[row] = set()
+        cols.add(i)
+    
+    def flush(self):
+        """
+        Write out the changes so far. Returns the number of rows updated.
+        """
+        if not self.dirty:
+            return 0
+        dirty = self.dirty
+        self.dirty = {}
+        
+        # (mapper, column numbers) -> parameter tuples
+        shapes = {}
+        for row, cols in dirty.items():
+            values = row._values
+            # Not added yet, in which case add() will write it all
+            if values[0] is None:
+                continue
+            cols = tuple(sorted(cols))
+            params = shapes.get((type(row), cols))
+            if params is None:
+                params = shapes[type(row), cols] = []
+            params.append(tuple(values[i] for i in cols) + (values[0],))
+        
+        curs = get_cursor()
+        for (cls, cols), params in shapes.items():
+            names = tuple(cls._names[i] for i in cols)
+            curs.executemany(cls._statement('update', names), params)
+        return sum(len(params) for params in shapes.values())
+    
+    def commit(self):
+        """
+        Flush, then commit this thread's connection.
+        """
+        self.flush()
+        get_connection().commit()
+    
+    def rollback(self):
+        """
+        Forget the changes not flushed yet, and roll back this thread's 
+        connection. Rows keep their changed values.
+        """
+        self.dirty = {}
+        get_connection().rollback()
+
+
+@contextmanager
+def session(commit=True):
+    """
+    Open a `Session` on this thread for the length of a `with` block, along 
+    with a `connection()`:
+    
+        with session():
+            for s in Sighting.filter(player=p):
+                s.count += 1
+                s.time = time()
+    
+    At the end it commits, or if not `commit`, only flushes, leaving the 
+    changes for an enclosing `connection()` block to commit or roll back. 
+    Nothing is written if the block raises. A `session()` inside another 
+    joins it.
+    """
+    current = getattr(_sessions, 'session', None)
+    if current is not None:
+        yield current
+        return
+    
+    current = _sessions.session = Session()
+    try:
+        with connection():
+            yield current
+            if commit:
+                current.commit()
+            else:
+                current.flush()
+    finally:
+        _sessions.session = None
+
+
+def _autoflush():
+    """
+    Flush this thread's session, if it has one, so that a query sees its 
+    changes.
+    """
+    current = getattr(_sessions, 'session', None)
+    if current is not None and current.dirty:
+        current.flush()
 
 
 def initialize_database(classes):
     """
-    Create all the tables required for `classes`.
+    Create all the tables required for `classes`, bring them up to date with 
+    `BaseMapper.migrate()`, and create any of their indexes that are missing. 
+    Anything that fails is reported and skipped, so that the rest still gets 
+    done. Returns False if anything failed.
     """
-    for cls in classes:
-        table = cls.tablename
-        try:
-            mk = cls._mk_create()
-            get_cursor().execute('create table if not exists %s (%s)' %
-                                 (table, mk))
-        except Exception as e:
-            sys.excepthook(*sys.exc_info())
-            # What!
-            return False
-    return True
+    ok = True
+    with connection(commit=True):
+        for cls in classes:
+            table = cls.tablename
+            try:
+                mk = cls._mk_create()
+                get_cursor().execute('create table if not exists %s (%s)' %
+                                     (table, mk))
+                cls.migrate()
+            except Exception as e:
+                sys.excepthook(*sys.exc_info())
+                # What! Its indexes would fail too
+                ok = False
+                continue
+            
+            for index in cls.indexes:
+                try:
+                    get_cursor().execute(index.create(table))
+                except Exception as e:
+                    sys.excepthook(*sys.exc_info())
+                    ok = False
+    return ok
 
 
 def comp(col, comp='='):
@@ -162,10 +562,99 @@ class DateTime(object):
         return '%s datetime' % self.name
 
 
+##### Indexes ################
+
+
+class Index(object):
+    
+    """
+    An index on one or more columns, listed in a mapper's `indexes`. Several 
+    columns make a composite index, which also serves lookups on its first 
+    columns alone.
+    """
+    
+    unique = False
+    
+    def __init__(self, *cols):
+        self.cols = cols
+    
+    def name(self, table):
+        return '%s_%s_%s' % (table, '_'.join(self.cols), 
+                             'key' if self.unique else 'idx')
+    
+    def create(self, table):
+        return 'create %sindex if not exists %s on %s(%s)' % (
+          'unique ' if self.unique else '', self.name(table), table, 
+          ', '.join(self.cols))
+
+
+class Unique(Index):
+    
+    """
+    An index which also keeps any two rows from having the same values in its 
+    columns.
+    """
+    
+    unique = True
+
+
 ##### Main Class #############
 
 
-class BaseMapper(object):
+class MapperMeta(type):
+    
+    """
+    Compiles mapper classes as they are made: each column gets a property 
+    reading from the row's value list, and SQL is built once per kind of 
+    statement and set of keys, then kept on the class.
+    """
+    
+    def __new__(meta, name, bases, attrs):
+        # Rows keep their values in one list, without an instance dict
+        attrs.setdefault('__slots__', ())
+        return type.__new__(meta, name, bases, attrs)
+    
+    def __init__(cls, name, bases, attrs):
+        type.__init__(cls, name, bases, attrs)
+        names = ('id',) + tuple(col.name for col in cls.columns)
+        cls._names = names
+        cls._index = dict((col, i) for i, col in enumerate(names))
+        # (kind, keys) -> SQL
+        cls._sql = {}
+        cls._select = 'select %s from %s' % (', '.join(names), cls.tablename)
+        for i, col in enumerate(names):
+            setattr(cls, col, _column_property(cls, i, col))
+
+
+def _column_property(cls, i, col):
+    """
+    Make the property for column `col`, number `i`, of mapper `cls`.
+    """
+    def get(self):
+        return self._values[i]
+    
+    if col == 'id':
+        return property(get)
+    
+    update = 'update %s set %s=? where id=?' % (cls.tablename, col)
+    
+    def put(self, val):
+        self._values[i] = val
+        current = getattr(_sessions, 'session', None)
+        if current is not None:
+            current._mark(self, i)
+        else:
+            get_cursor().execute(update, (val, self._values[0]))
+    
+    return property(get, put)
+
+
+# Gives BaseMapper its metaclass under both Python 2 and 3
+_MapperBase = MapperMeta('_MapperBase', (object,), 
+                         dict(tablename=None, columns=(), indexes=()))
+
+
+class BaseMapper(_MapperBase):
     
     """
     Base class for row/instance mappers. One-word row names that must not be 
@@ -178,37 +667,53 @@ class BaseMapper(object):
       filter
       get
       all
+      query
+      indexes
+      analyze
     It is hoped that no one needs such names as `_filter` or `get_items`. Note 
-    that `id` is created automatically, as it is required.
+    that `id` is created automatically, as it is required. Mappers may not 
+    give their rows attributes other than columns; see `MapperMeta`.
     """
     
-    # Internals
-    _col_prefix = '_col_'
-    _have_built = False
+    # The row's values, in `_names` order; the columns it was made with; and 
+    # whether it is in the database
+    __slots__ = ('_values', '_cols', '_in_db')
     
     # Override these
     tablename = None
     columns = ()
+    # `Index`es and `Unique`s, made by `initialize_database()`
+    indexes = ()
     
     def __init__(self, row):
         """
         Sets information from dict-like object `row`.
         """
-        cols = row.keys()
-        self._all_cols = list(cols)
-        
-        self._in_db = 'id' in row.keys()
-        
-        if not self._have_built:
-            self._build_properties()
-            self._have_built = True
-        
+        cols = tuple(row.keys())
+        values = [None] * len(self._names)
+        index = self._index
         for col in cols:
-            self._set_property(col, row[col])
+            values[index[col]] = row[col]
+        
+        self._values = values
+        self._cols = cols
+        self._in_db = 'id' in cols
+    
+    @classmethod
+    def _load(cls, values):
+        """
+        Make a row from all its values, as `_select` fetches them, without 
+        going through a dict.
+        """
+        self = cls.__new__(cls)
+        self._values = list(values)
+        self._cols = cls._names
+        self._in_db = True
+        return self
     
     def __repr__(self):
         name = self.__class__.__name__
-        vals = ', '.join('%s=%r' % (col, self[col]) for col in self._all_cols)
+        vals = ', '.join('%s=%r' % (col, self[col]) for col in self._cols)
         return '<%s %s>' % (name, vals)
     
     def __getitem__(self, x):
@@ -229,56 +734,29 @@ class BaseMapper(object):
         """
         Get an tuple version of the column list.
         """
-        return tuple(self._all_cols)
+        return self._cols
     
     def get_values(self):
         """
         Get an tuple of this row's values.
         """
-        return tuple(getattr(self, col) for col in self._all_cols)
+        values = self._values
+        index = self._index
+        return tuple(values[index[col]] for col in self._cols)
     
     def get_items(self):
         """
         Get an tuple of the (column, value) pairs of this row.
         """
-        return tuple((col, getattr(self, col)) for col in self._all_cols)
+        return tuple(zip(self._cols, self.get_values()))
     
     ### Internals ######
     
-    @classmethod
-    def _add_property(cls, col):
-        """
-        Build and cache the property accessor for a particular column.
-        """
-        mcol = cls._col_prefix + col
-        
-        @property
-        def prop(self):
-            return getattr(self, mcol)
-        
-        if col != 'id':
-            @prop.setter
-            def prop(self, val):
-                setattr(self, mcol, val)
-                cmd = 'update %s set %s=? where id=?' % (cls.tablename, col)
-                get_cursor().execute(cmd, (val, self.id))
-        
-        setattr(cls, col, prop)
-    
-    def _build_properties(self):
-        """
-        Create all appropriate properties for this class.
-        """
-        self._add_property('id')
-        for col in self.get_keys():
-            if col != 'id':
-                self._add_property(col)
-    
     def _set_property(self, col, val):
         """
         Initialize the hidden value of a column.
         """
-        setattr(self, self._col_prefix + col, val)
+        self._values[self._index[col]] = val
     
     @classmethod
     def _mk_create(cls):
@@ -289,33 +767,69 @@ class BaseMapper(object):
         cols += cls.columns
         return ', '.join(str(col) for col in cols)
     
+    @classmethod
+    def _statement(cls, kind, keys):
+        """
+        Get the SQL for a 'select', 'count' or 'delete' filtered on `keys`; 
+        an 'insert' or 'update' (by ID) of columns `keys`; an 'upsert' of 
+        `keys` = (key columns, columns, {column: update expression}.items()). 
+        It is built the first time. Used internally.
+        """
+        sql = cls._sql.get((kind, keys))
+        if sql is not None:
+            return sql
+        
+        where = ' where ' + ' and '.join(comp(k) for k in keys) if keys else ''
+        if kind == 'select':
+            sql = cls._select + where
+        elif kind == 'count':
+            sql = 'select count(id) from %s%s' % (cls.tablename, where)
+        elif kind == 'delete':
+            sql = 'delete from %s%s' % (cls.tablename, where)
+        elif kind == 'insert':
+            sql = 'insert into %s(%s) values (%s)' % (
+              cls.tablename, ', '.join(keys), ', '.join('?' for k in keys))
+        elif kind == 'update':
+            sql = 'update %s set %s where id=?' % (
+              cls.tablename, ', '.join(comp(k) for k in keys))
+        elif kind == 'upsert':
+            key_cols, cols, update = keys
+            sets = dict((col, 'excluded.' + col) for col in cols 
+                        if col not in key_cols)
+            sets.update(update)
+            sql = '%s on conflict(%s) do %s' % (
+              cls._statement('insert', cols), ', '.join(key_cols), 
+              'update set ' + ', '.join('%s=%s' % item for item in 
+                                        sorted(sets.items())) 
+              if sets else 'nothing')
+        else:
+            raise ValueError('Unknown kind of statement: %s' % kind)
+        cls._sql[kind, keys] = sql
+        return sql
+    
     @classmethod
     def _filter(cls, **filters):
         """
         Get the raw cursor result for a query. Used internally.
         """
-        start = 'select * from %s where ' % cls.tablename
-        cont = ' and '.join(comp(k) for k in filters)
-        vals = tuple(filters.values())
-        return get_cursor().execute(start + cont, vals)
+        _autoflush()
+        return get_cursor().execute(cls._statement('select', tuple(filters)), 
+                                    tuple(filters.values()))
     
     ### Class-wides ####
     
     @classmethod
     def count(cls, **filters):
-        base = 'select count(id) from %s' % cls.tablename
-        if filters:
-            base += ' where ' + ' and '.join(comp(k) for k in filters)
-            vals = tuple(filters.values())
-            res = get_cursor().execute(base, vals)
-        else:
-            res = get_cursor().execute(base)
-        return res.fetchone()[0]
+        sql = cls._statement('count', tuple(filters))
+        _autoflush()
+        return get_cursor().execute(sql, tuple(filters.values())).fetchone()[0]
     
     @classmethod
     def all(cls):
-        curs = get_cursor().execute('select * from %s' % cls.tablename)
-        return (cls(_dictify(curs, row)) for row in curs)
+        _autoflush()
+        curs = get_cursor().execute(cls._select)
+        load = cls._load
+        return (load(row) for row in curs)
     
     @classmethod
     def filter(cls, **filters):
@@ -323,18 +837,185 @@ class BaseMapper(object):
         Get all the results for **filters.
         """
         curs = cls._filter(**filters)
-        return (cls(_dictify(curs, row)) for row in curs)
+        load = cls._load
+        return (load(row) for row in curs)
     
     @classmethod
     def get(cls, **filters):
         """
         Get exactly one result for **filters or None.
         """
-        curs = cls._filter(**filters)
-        res = curs.fetchone()
+        res = cls._filter(**filters).fetchone()
         if res is None:
             return
-        return cls(_dictify(curs, res))
+        return cls._load(res)
+    
+    @classmethod
+    def query(cls, **filters):
+        """
+        Start a `Query` for **filters, which may use its operators.
+        """
+        return Query(cls).filter(**filters)
+    
+    @classmethod
+    def _load_some(cls, cols, values):
+        """
+        Make a row from the values of `cols` only. Used internally.
+        """
+        row = [None] * len(cls._names)
+        index = cls._index
+        for col, value in zip(cols, values):
+            row[index[col]] = value
+        self = cls.__new__(cls)
+        self._values = row
+        self._cols = cols
+        self._in_db = True
+        return self
+    
+    ### Bulk changes ###
+    
+    @classmethod
+    def migrate(cls):
+        """
+        Fix up what is already in the table before `initialize_database()` 
+        makes its indexes; rows that a new `Unique` would refuse, say. Does 
+        nothing unless overridden.
+        """
+    
+    @classmethod
+    def analyze(cls):
+        """
+        Have the database gather statistics on the table and its indexes, 
+        for the query planner. Worth doing after a bulk load.
+        """
+        return get_cursor().execute('analyze %s' % cls.tablename)
+    
+    @classmethod
+    def _batches(cls, rows, columns, batch_size):
+        """
+        Split `rows` (sequences in `columns` order, or dicts) into lists of 
+        parameter tuples. Yields (columns, batch) pairs. Used internally.
+        """
+        rows = iter(rows)
+        for first in rows:
+            if isinstance(first, dict):
+                # The first row's keys go for all of them
+                if columns is None:
+                    columns = tuple(first)
+                rows = (tuple(row[col] for col in columns) 
+                        for row in itertools.chain((first,), rows))
+            else:
+                if columns is None:
+                    columns = cls._names[1:]
+                rows = itertools.chain((tuple(first),), rows)
+            break
+        else:
+            return
+        
+        while True:
+            batch = list(itertools.islice(rows, batch_size))
+            if not batch:
+                return
+            yield tuple(columns), batch
+    
+    @classmethod
+    def bulk_add(cls, rows, columns=None, batch_size=1000):
+        """
+        Insert `rows`, which may be any iterable, `batch_size` at a time 
+        through `executemany()`. Rows are sequences of the values of 
+        `columns` (by default, all but `id`), or dicts, all with the same keys 
+        as the first. Returns the number of rows inserted.
+        """
+        curs = get_cursor()
+        count = 0
+        for columns, batch in cls._batches(rows, columns, batch_size):
+            curs.executemany(cls._statement('insert', columns), batch)
+            count += len(batch)
+        return count
+    
+    @classmethod
+    def upsert(cls, key_cols, rows, columns=None, update=None, 
+               batch_size=1000):
+        """
+        Insert `rows` (as for `bulk_add()`), updating instead those rows that 
+        have the same values for `key_cols` as a row already in the table. 
+        By default the other columns are set to the new values; `update` maps 
+        columns to other SQL expressions, in which `excluded.<column>` is the 
+        new value:
+        
+            Sighting.upsert(['player'], [(player, time(), 1)], 
+                            update={'count': 'count + excluded.count'})
+        
+        `key_cols` must have a `Unique` index, declared in `indexes` and made 
+        by `initialize_database()`. Needs SQLite 3.24 or later. Returns the 
+        number of rows inserted or updated.
+        """
+        key_cols = tuple(key_cols)
+        update = tuple(sorted((update or {}).items()))
+        _autoflush()
+        curs = get_cursor()
+        cls._check_unique(curs, key_cols)
+        count = 0
+        for columns, batch in cls._batches(rows, columns, batch_size):
+            sql = cls._statement('upsert', (key_cols, columns, update))
+            curs.executemany(sql, batch)
+            count += len(batch)
+        return count
+    
+    @classmethod
+    def _check_unique(cls, curs, key_cols):
+        """
+        Make sure that the unique index on `key_cols` exists, looking for it 
+        only the first time. Used internally.
+        """
+        if ('unique', key_cols) in cls._sql:
+            return
+        # Making it here would be DDL, which commits the open transaction
+        name = Unique(*key_cols).name(cls.tablename)
+        found = curs.execute("select name from sqlite_master "
+                             "where type='index' and name=?", 
+                             (name,)).fetchone()
+        if found is None:
+            cols = ', '.join(map(repr, key_cols))
+            raise ValueError('%s has no unique index %s; declare Unique(%s) '
+                             'in its indexes' % (cls.__name__, name, cols))
+        cls._sql['unique', key_cols] = name
+    
+    @classmethod
+    def bulk_remove(cls, batch_size=1000, **filters):
+        """
+        Delete every row matching `filters` with one statement, or every row 
+        if there are none. One filter may be given a list (or any iterable 
+        but a string) of values, to delete the rows matching any of them 
+        through `executemany()`:
+        
+            Listing.bulk_remove(id=[3, 5, 8])
+        
+        Returns the number of rows deleted.
+        """
+        many = [k for k, v in filters.items() 
+                if hasattr(v, '__iter__') and not isinstance(v, basestring)]
+        if len(many) > 1:
+            raise ValueError('Only one filter may have many values!')
+        
+        _autoflush()
+        curs = get_cursor()
+        if not many:
+            sql = cls._statement('delete', tuple(filters))
+            return curs.execute(sql, tuple(filters.values())).rowcount
+        
+        key = many[0]
+        values = iter(filters.pop(key))
+        keys = tuple(filters) + (key,)
+        fixed = tuple(filters.values())
+        sql = cls._statement('delete', keys)
+        count = 0
+        while True:
+            batch = [fixed + (v,) 
+                     for v in itertools.islice(values, batch_size)]
+            if not batch:
+                return count
+            count += curs.executemany(sql, batch).rowcount
     
     ### Save/remove #####
     
@@ -344,18 +1025,11 @@ class BaseMapper(object):
         resulting cursor object if the row was added, otherwise None.
         """
         if not self._in_db:
-            keys = self._all_cols
-            
-            to_insert = ', '.join(keys)
-            qmarks = ', '.join('?' for i in range(len(keys)))
-            
-            cmd = 'insert into %s(%s) values (%s)'
-            cmd %= (self.tablename, to_insert, qmarks)
-            
+            cmd = self._statement('insert', self._cols)
             res = get_cursor().execute(cmd, self.get_values())
             
-            self._set_property('id', res.lastrowid)
-            self._all_cols.insert(0, 'id')
+            self._values[0] = res.lastrowid
+            self._cols = ('id',) + self._cols
             self._in_db = True
             
             return res
@@ -366,10 +1040,193 @@ class BaseMapper(object):
         but may be canceled with a rollback. Returns the resulting cursor 
         object if the row was removed, otherwise None.
         """
-        id = getattr(self, self._col_prefix + 'id', None)
+        id = self._values[0]
         if id is None:
             return
         
-        cmd = 'delete from %s where id=?' % self.tablename
+        cmd = self._statement('delete', ('id',))
         return get_cursor().execute(cmd, (id,))
 
+
+##### Queries ################
+
+
+# Filter operators of the form col__op, and the SQL they make
+_operators = {'eq': '=', 'ne': '!=', 'lt': '<', 'lte': '<=', 'gt': '>', 
+              'gte': '>=', 'like': ' like '}
+
+# Functions `Query.aggregate()` knows
+_aggregates = ('min', 'max', 'sum', 'total', 'avg', 'count')
+
+# LIMIT is needed for OFFSET; this is as good as none
+_no_limit = 2 ** 63 - 1
+
+
+def _condition(key, value):
+    """
+    Turn filter `key`=`value` into a (SQL, parameters) pair. Used internally.
+    """
+    if '?' in key:
+        # Given as comp() would be
+        return key, (value,)
+    
+    col, sep, op = key.rpartition('__')
+    if not sep:
+        col, op = key, 'eq'
+    
+    if op == 'in':
+        values = tuple(value)
+        if not values:
+            # Nothing is in nothing
+            return '0', ()
+        return '%s in (%s)' % (col, ', '.join('?' for v in values)), values
+    elif op == 'between':
+        low, high = value
+        return '%s between ? and ?' % col, (low, high)
+    elif op not in _operators:
+        raise ValueError('Unknown filter operator: %s' % op)
+    elif value is None and op in ('eq', 'ne'):
+        return '%s is %snull' % (col, 'not ' if op == 'ne' else ''), ()
+    return comp(col, _operators[op]), (value,)
+
+
+class Query(object):
+    
+    """
+    A select on a mapper's table, built up a step at a time, and run when 
+    iterated over. Each step gives a new query, leaving the old one as it was:
+    
+        top = Sighting.query(time__gte=since).order_by('-count').limit(5)
+        for sighting in top.only('player', 'count'):
+            ...
+    
+    Filters are given as for `BaseMapper.filter()`, or as `col__op`=value, 
+    where op is one of eq, ne, lt, lte, gt, gte, like, in (any iterable of 
+    values) or between (a (low, high) pair).
+    """
+    
+    def __init__(self, mapper):
+        self.mapper = mapper
+        # (SQL, parameters) pairs, all of which must hold
+        self.where = ()
+        # (column, descending) pairs
+        self.order = ()
+        self.cols = None
+        self.max_rows = None
+        self.skip = 0
+    
+    def _clone(self, **changes):
+        query = copy.copy(self)
+        query.__dict__.update(changes)
+        return query
+    
+    def _check(self, cols):
+        for col in cols:
+            if col not in self.mapper._index:
+                raise ValueError('%s has no column %s' % (
+                  self.mapper.__name__, col))
+    
+    def filter(self, **filters):
+        return self._clone(where=self.where + tuple(
+          _condition(key, value) for key, value in sorted(filters.items())))
+    
+    def order_by(self, *cols):
+        """
+        Sort by `cols`, in that order of importance; a column name starting 
+        with '-' sorts from highest to lowest.
+        """
+        order = tuple((col.lstrip('-'), col.startswith('-')) for col in cols)
+        self._check(col for col, desc in order)
+        return self._clone(order=self.order + order)
+    
+    def limit(self, count):
+        return self._clone(max_rows=count)
+    
+    def offset(self, skip):
+        return self._clone(skip=skip)
+    
+    def only(self, *cols):
+        """
+        Fetch just `cols` (and the ID); other columns of the rows read None.
+        """
+        self._check(cols)
+        return self._clone(cols=('id',) + tuple(c for c in cols if c != 'id'))
+    
+    def _build(self, head):
+        """
+        Get the SQL and parameters for `head` with the filters on. Used 
+        internally.
+        """
+        params = ()
+        if not self.where:
+            return head, params
+        for sql, values in self.where:
+            params += values
+        return '%s where %s' % (head, ' and '.join(
+          sql for sql, values in self.where)), params
+    
+    def __iter__(self):
+        mapper = self.mapper
+        if self.cols is None:
+            head = mapper._select
+            load = mapper._load
+        else:
+            cols = self.cols
+            head = 'select %s from %s' % (', '.join(cols), mapper.tablename)
+            load = lambda row: mapper._load_some(cols, row)
+        
+        sql, params = self._build(head)
+        if self.order:
+            sql += ' order by ' + ', '.join(
+              col + (' desc' if desc else '') for col, desc in self.order)
+        if self.max_rows is not None or self.skip:
+            sql += ' limit ? offset ?'
+            params += (_no_limit if self.max_rows is None else self.max_rows, 
+                       self.skip)
+        
+        _autoflush()
+        curs = get_cursor().execute(sql, params)
+        return (load(row) for row in curs)
+    
+    def first(self):
+        """
+        Get the first row, or None if there are none.
+        """
+        for row in self.limit(1):
+            return row
+    
+    def count(self):
+        """
+        Count the rows matching the filters, whatever the limit and offset.
+        """
+        sql, params = self._build('select count(id) from %s' % 
+                                  self.mapper.tablename)
+        _autoflush()
+        return get_cursor().execute(sql, params).fetchone()[0]
+    
+    def aggregate(self, **exprs):
+        """
+        Work out aggregates over the rows matching the filters, in the 
+        database. Keys name the function (min, max, sum, total, avg or count), 
+        optionally followed by '_' and anything, to tell apart several of one 
+        function; values are columns or SQL expressions. Returns a dict of the 
+        results by key:
+        
+            Price.query(item=item).aggregate(
+              min='price', max='price', sum_items='quantity', 
+              sum_total='quantity * price')
+        
+        Like `count()`, this ignores the limit and offset.
+        """
+        keys = sorted(exprs)
+        funcs = []
+        for key in keys:
+            func = key.split('_', 1)[0]
+            if func not in _aggregates:
+                raise ValueError('Unknown aggregate: %s' % func)
+            funcs.append('%s(%s)' % (func, exprs[key]))
+        
+        sql, params = self._build('select %s from %s' % (
+          ', '.join(funcs), self.mapper.tablename))
+        _autoflush()
+        return dict(zip(keys, get_cursor().execute(sql, params).fetchone()))
@@ -0,0 +1,131 @@
+"""
+LOF BOT SUPERVISOR
+==================
+
+This module keeps bot connections alive: it brings them all up in parallel on a
+reactor, notices when one has died (by EOF, or by the server going quiet for
+too long despite our pings), and reconnects it with jittered exponential
+backoff.
+"""
+
+import sys
+import time
+import random
+import socket
+
+from taskit.log import ERROR, IMPORTANT
+
+from reactor import sleep
+
+
+__all__ = ['Supervisor', 'CONNECTING', 'READY', 'DEGRADED', 'DEAD']
+
+
+## Connection states
+
+CONNECTING = 'connecting'
+READY = 'ready'
+# Connected, but the server has been quiet for longer than it should be
+DEGRADED = 'degraded'
+DEAD = 'dead'
+
+
+class Supervisor(object):
+
+    """
+    Supervises any number of clients on one reactor.
+    """
+
+    def __init__(self, reactor, ping_interval=15, degraded_after=2,
+                 dead_after=4, backoff=1, backoff_max=60):
+        """
+        ping_interval  -- Seconds between pings (and health checks).
+        degraded_after -- Ping intervals of silence before a connection is
+                          considered degraded...
+        dead_after     -- ...and before it is given up on and reconnected.
+        backoff        -- Seconds to wait before the first reconnect; doubled
+                          for every failure in a row...
+        backoff_max    -- ...up to this many.
+        """
+        self.reactor = reactor
+        self.ping_interval = ping_interval
+        self.degraded_after = degraded_after * ping_interval
+        self.dead_after = dead_after * ping_interval
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.clients = []
+        self.reconnects = {}
+        self.timer = None
+
+    def watch(self, client):
+        """
+        Start supervising `client` as a task of its own.
+        """
+        self.reactor.spawn(self.supervise(client))
+
+    def supervise(self, client):
+        """
+        Connect `client` and keep it connected until it quits. A task.
+        """
+        self.clients.append(client)
+        self.reconnects[client.account] = 0
+        if self.timer is None:
+            self.timer = self.reactor.call_later(self.ping_interval,
+                                                 self._check)
+        failures = 0
+        try:
+            while True:
+                client.state = CONNECTING
+                if (yield client.connect_task()):
+                    failures = 0
+                    client.state = READY
+                    try:
+                        client.on_ready()
+                    except Exception:
+                        sys.excepthook(*sys.exc_info())
+                    yield client.main_task()
+                    if client.done:
+                        # Asked to quit, rather than cut off
+                        return
+                    client.log(ERROR, 'Lost the connection!')
+
+                client.state = DEAD
+                delay = min(self.backoff_max, self.backoff * 2 ** failures)
+                # Jitter, so that a restarted server isn't hit all at once
+                delay *= random.uniform(0.5, 1.5)
+                failures += 1
+                self.reconnects[client.account] += 1
+                client.log(IMPORTANT, 'Reconnecting in %.1f seconds...' % delay)
+                yield sleep(delay)
+        finally:
+            client.state = DEAD
+            self.clients.remove(client)
+            if not self.clients:
+                self.timer.cancel()
+                self.timer = None
+
+    def _check(self):
+        self.timer = self.reactor.call_later(self.ping_interval, self._check)
+        now = time.time()
+        for client in self.clients:
+            if client.state not in (READY, DEGRADED):
+                continue
+
+            silence = now - client.last_seen
+            if silence > self.dead_after:
+                client.state = DEAD
+                client.drop()
+                continue
+            client.state = DEGRADED if silence > self.degraded_after else READY
+
+            try:
+                client.ping()
+            except socket.error:
+                client.drop()
+
+    def stats(self):
+        """
+        Get a list of (account, state, reconnect count) for every client.
+        """
+        return [(c.account, c.state, self.reconnects[c.account])
+                for c in self.clients]
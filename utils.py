@@ -16,6 +16,17 @@ def rotate(itr, places):
     return itr[places:] + itr[:places]
 
 
+def percentile(ordered, p):
+    """
+    Get the `p`th percentile (0-100) of the already sorted sequence `ordered`, 
+    or None if it is empty.
+    """
+    if not ordered:
+        return None
+    i = int(round((len(ordered) - 1) * p / 100.))
+    return ordered[i]
+
+
 class Vector(object):
     
     """
@@ -8,6 +8,8 @@ This module provides an tmwAthena wire protocol wrapper for the LoF bot.
 import socket
 import struct
 
+import metrics
+
 
 __all__ = ['PacketBuffer', 'PacketIn', 'PacketOut', 'PACKET_IDS', 
            'PACKET_NAMES']
@@ -84,6 +86,15 @@ PACKET_IDS = dict(
 # Inverted -- ids to names
 PACKET_NAMES = dict(zip(PACKET_IDS.values(), PACKET_IDS.keys()))
 
+# Precompiled field readers
+_uint8 = struct.Struct('<B')
+_uint16 = struct.Struct('<H')
+_uint32 = struct.Struct('<L')
+_coords = struct.Struct('<BBB')
+
+# Shared with sendq, which sends most packets
+BYTES_OUT = metrics.counter('lofbot_bytes_out_total', 'Bytes sent')
+
 # Export the packet types into the global space -- yeah. It's ugly. >:D
 for packet_name, packet_id in PACKET_IDS.items():
     globals()[packet_name] = packet_id
@@ -123,17 +134,208 @@ def unpack(b0, b1, b2):
     return x, y, d
 
 
+### Packet schemas
+
+
+def nul_string(s):
+    """
+    Field post-processor: strip the NUL padding off a string.
+    """
+    return s.rstrip('\0')
+
+
+def ip(s):
+    """
+    Field post-processor: turn a 32-bit-packed IP into dotted form.
+    """
+    return socket.inet_ntoa(s)
+
+
+def coords(s):
+    """
+    Field post-processor: unpack 3 packed bytes into (x, y, direction).
+    """
+    return unpack(*_coords.unpack(s))
+
+
+def flag(n):
+    """
+    Field post-processor: a byte that means True when it is 1.
+    """
+    return n == 1
+
+
+class PacketSpec(object):
+    
+    """
+    The precompiled layout of one packet type in one direction. `fmt` is the 
+    `struct` format of the body following the packet ID (and the length word, 
+    for variable-length packets), and `tail` means that the body ends with a 
+    string running to the end of the packet.
+    """
+    
+    def __init__(self, packet_id, fmt, outgoing, fields=(), args=None, 
+                 tail=False, unwrap=False, variable=None):
+        """
+        fields   -- Per-field post-processors applied when decoding, in field 
+                    order; None leaves a field alone.
+        args     -- A function turning the arguments given to `PacketOut` 
+                    into the field values, if they differ.
+        unwrap   -- Decode to the lone field itself rather than a tuple.
+        variable -- Whether the packet carries a length word; looked up in 
+                    `packet_lengths` by default.
+        """
+        if variable is None:
+            variable = packet_lengths[packet_id] < 0
+        head = 'H' if outgoing else '2x'
+        if variable:
+            head *= 2
+        
+        self.packet_id = packet_id
+        self.struct = struct.Struct('<' + head + fmt)
+        self.size = self.struct.size
+        self.variable = variable
+        self.fields = tuple((i, f) for i, f in enumerate(fields) if f)
+        self.args = args
+        self.tail = tail
+        self.unwrap = unwrap
+    
+    def decode(self, data):
+        """
+        Decode the packet in buffer `data` into its field values.
+        """
+        values = self.struct.unpack_from(data, 0)
+        if self.fields:
+            values = list(values)
+            for i, f in self.fields:
+                values[i] = f(values[i])
+            values = tuple(values)
+        if self.tail:
+            values += (data[self.size:].tobytes().rstrip('\0'),)
+        if self.unwrap:
+            return values[0]
+        return values
+    
+    def encode(self, args):
+        """
+        Encode the packet for arguments `args` into a new `bytearray`.
+        """
+        if self.args:
+            args = self.args(*args)
+        args = [a.encode() if isinstance(a, unicode) else a for a in args]
+        
+        size = self.size
+        if self.tail:
+            tail = args.pop()
+            size += len(tail)
+        if self.variable:
+            args.insert(0, size)
+        
+        data = bytearray(size)
+        self.struct.pack_into(data, 0, self.packet_id, *args)
+        if self.tail:
+            data[self.size:] = tail
+        return data
+
+
+_in_specs = {}
+_out_specs = {}
+
+
+def incoming(packet_id, fmt, fields=(), **kw):
+    """
+    Declare the layout of an in-coming packet. See `PacketSpec`.
+    """
+    _in_specs[packet_id] = PacketSpec(packet_id, fmt, False, fields, **kw)
+
+
+def outgoing(packet_id, fmt, args=None, **kw):
+    """
+    Declare the layout of an out-going packet. See `PacketSpec`.
+    """
+    _out_specs[packet_id] = PacketSpec(packet_id, fmt, True, args=args, **kw)
+
+
+def _change_act(*args):
+    # Attack is the same id, but with a being and a keep-attacking flag
+    if len(args) == 1:
+        return 0, args[0]
+    being_id, keep = args
+    return being_id, 7 if keep else 0
+
+
+## In-coming
+
+# Nick, Message
+incoming(S_WHISPER, '24s', (nul_string,), tail=True)
+# Acc ID, Message
+incoming(S_NORM_MSG, 'L', tail=True)
+incoming(S_OTHER_MSG, '', tail=True)
+# Being ID, Emote ID
+incoming(S_EMOTE, 'LB')
+# id1, accid, id2, (server name, time, etc), sex, ip, port
+incoming(S_CSERV, 'LLL30xB4sH', (None, None, None, None, ip))
+# charid, (mapname), ip, port
+incoming(S_MSERV, 'L16x4sH', (None, ip))
+# (server tick), coords. There is nothing else worthwhile -- 
+# see GameHandler::processMapLogin() @ src/net/ea/gamehandler.cpp 
+# in the Manaplus source
+incoming(S_CONNECTED, '4x3s', (coords,), unwrap=True)
+incoming(S_NAME_RES, 'L24s', (None, nul_string))
+# Beyond the end of `packet_lengths`, but it does have a length word
+incoming(S_NAME_RES2, 'L', tail=True, variable=True)
+# being id; type, death if =1 else just remove
+incoming(S_REMOVE, 'LB', (None, flag))
+# Finish this later...
+incoming(S_XXX_USED_AFTER_DEATH, '')
+# Look this up -- this isn't likely right
+incoming(S_PING, '', tail=True, unwrap=True)
+
+## Out-going
+
+# Client version (need 1 currently), account, password, and the "second 
+# version info" that ManaPlus repurposes as an ability mask, but we don't 
+# support anything they put there.
+outgoing(C_L_LOGIN, 'L24s24sB', lambda acc, pswd: (0, acc, pswd, 3))
+# The 1 is the packet protocol version we support (see tmwa's 
+# MIN_CLIENT_VERSION defined src/mmo/version.hpp )
+outgoing(C_C_LOGIN, 'LLLHB', 
+         lambda accid, id1, id2, sex: (accid, id1, id2, 1, sex))
+outgoing(C_PICK_CHAR, 'B')
+outgoing(C_M_LOGIN, 'LLLLB')
+outgoing(C_CHANGE_ACT, 'LB', _change_act)
+outgoing(C_MSG, '', tail=True)
+outgoing(C_WHISPER, '24s', tail=True)
+outgoing(C_FACE, 'HB', lambda d: (0, d))
+outgoing(C_EMOTE, 'B')
+outgoing(C_RESPAWN, 'B', lambda: (0,))
+outgoing(C_GOTO, '3s', lambda x, y, d=-1: (_coords.pack(*pack(x, y, d)),))
+outgoing(C_NAME_REQ, 'L')
+# Client tick, in milliseconds
+outgoing(C_PING, 'L')
+
+
 class PacketIn(object):
     
     """
-    An in-coming packet.
+    An in-coming packet. `data` may be a string or a memoryview slice handed 
+    out by a `PacketBuffer`; either way, no copy of the payload is made.
     """
     
     def __init__(self, data):
+        if not isinstance(data, memoryview):
+            data = memoryview(data)
         self.data = data
         self.pos = 0
         self.packet_id = self.int16()
     
+    @property
+    def raw(self):
+        """
+        A string copy of the whole packet.
+        """
+        return self.data.tobytes()
+    
     def __eq__(self, other):
         """
         Compare this message's ID to another ID.
@@ -142,73 +344,12 @@ class PacketIn(object):
     
     def parse(self):
         """
-        Parse the message according to its type.
+        Parse the message according to its type. Returns None for types 
+        without a schema.
         """
-        if self == S_WHISPER:
-            self.skip(2)
-            return self.string(24), self.string()
-        
-        elif self == S_NORM_MSG:
-            # Unknown bytes -- something, and then what seems to always be 0
-            self.skip(2)
-            # Acc ID, Message
-            return (self.int32(), self.string())
-        
-        elif self == S_OTHER_MSG:
-            self.skip(2)
-            return (self.string(),)
-        
-        elif self == S_EMOTE:
-            # Being ID, Emote ID
-            return self.int32(), self.int8()
-        
-        elif self == S_CSERV:
-            self.skip(2)
-            id1, accid, id2 = self.int32(), self.int32(), self.int32()
-            # Server name, time, etc
-            self.skip(30)
-            sex = self.int8()
-            ip = self.ip()
-            port = self.int16()
-            return id1, accid, id2, sex, ip, port
-        
-        elif self == S_MSERV:
-            charid = self.int32()
-            # Break off the trailing .gat or whatever
-            mapname = self.string(16).split('.')[0]
-            ip = self.ip()
-            port = self.int16()
-            return charid, ip, port
-        
-        elif self == S_CONNECTED:
-            self.int32()    # server tick
-            # There is nothing else worthwhile -- 
-            # see GameHandler::processMapLogin() @ src/net/ea/gamehandler.cpp 
-            # in the Manaplus source
-            return self.coords()
-        
-        elif self == S_NAME_RES:
-            being_id = self.int32()
-            name = self.string(24)
-            return being_id, name
-        
-        elif self == S_NAME_RES2:
-            size = self.int16()
-            being_id = self.int32()
-            name = self.string(size - 8)
-            return being_id, name
-        
-        elif self == S_REMOVE:
-            # being id; type, death if =1 else just remove
-            return (self.int32(), self.int8() == 1)
-        
-        elif self == S_XXX_USED_AFTER_DEATH:
-            # Finish this later...
-            return ()
-        
-        elif self == S_PING:
-            # Look this up -- this isn't likely right
-            return (self.string())
+        spec = _in_specs.get(self.packet_id)
+        if spec is not None:
+            return spec.decode(self.data)
     
     def skip(self, n):
         self.pos += n
@@ -217,7 +358,7 @@ class PacketIn(object):
         """
         Get an 8-bit integer.
         """
-        res = ord(self.data[self.pos])
+        res = _uint8.unpack_from(self.data, self.pos)[0]
         self.pos += 1
         return res
     
@@ -225,17 +366,17 @@ class PacketIn(object):
         """
         Get a 16-bit integer.
         """
-        opos = self.pos
+        res = _uint16.unpack_from(self.data, self.pos)[0]
         self.pos += 2
-        return struct.unpack('<H', self.data[opos:self.pos])[0]
+        return res
     
     def int32(self):
         """
         Get a 32-bit integer.
         """
-        opos = self.pos
+        res = _uint32.unpack_from(self.data, self.pos)[0]
         self.pos += 4
-        return struct.unpack('<L', self.data[opos:self.pos])[0]
+        return res
     
     def ip(self):
         """
@@ -243,7 +384,7 @@ class PacketIn(object):
         """
         opos = self.pos
         self.pos += 4
-        return socket.inet_ntoa(self.data[opos:self.pos])
+        return socket.inet_ntoa(self.data[opos:self.pos].tobytes())
     
     def string(self, size=None):
         """
@@ -257,12 +398,12 @@ class PacketIn(object):
             self.pos += size
             res = self.data[opos:self.pos]
         
-        return res.rstrip('\0')
+        return res.tobytes().rstrip('\0')
     
     def coords(self):
-        opos = self.pos
+        res = unpack(*_coords.unpack_from(self.data, self.pos))
         self.pos += 3
-        return unpack(*struct.unpack('<BBB', self.data[opos:self.pos]))
+        return res
 
 
 class PacketOut(object):
@@ -273,7 +414,7 @@ class PacketOut(object):
     
     def __init__(self, packet_id, *args):
         self.packet_id = packet_id
-        self.data = struct.pack('<H', packet_id)
+        self.data = _uint16.pack(packet_id)
         # Allow cutting down on code; 
         # This is the intended use pattern, after all.
         if args:
@@ -286,99 +427,22 @@ class PacketOut(object):
         return self.packet_id == other
     
     def __str__(self):
-        return self.data
+        return str(self.data)
     
     def fill(self, *args):
         """
         Fill in all the parts of the message.
         """
-        if self == C_L_LOGIN:
-            acc, pswd = args
-            # Client version. Need 1 currently.
-            self.int32(0)
-            self.string(acc, 24)
-            self.string(pswd, 24)
-            # ManaPlus has this "second version info" repurposed as an ability 
-            # mask, but we don't support anything they put there.
-            self.int8(3)
-        
-        elif self == C_C_LOGIN:
-            accid, id1, id2, sex = args
-            self.int32(accid)
-            self.int32(id1)
-            self.int32(id2)
-            # This is the packet protocol version we support
-            # (see tmwa's MIN_CLIENT_VERSION defined src/mmo/version.hpp )
-            self.int16(1)
-            self.int8(sex)
-        
-        elif self == C_PICK_CHAR:
-            # Must do this manually since we cannot rely on unpacking to do it 
-            # for us
-            assert len(args) == 1, 'This message only has one blank!'
-            self.int8(args[0])
-        
-        elif self == C_M_LOGIN:
-            accid, charid, id1, id2, sex = args
-            self.int32(accid)
-            self.int32(charid)
-            self.int32(id1)
-            self.int32(id2)
-            self.int8(sex)
-        
-        elif self == C_CHANGE_ACT and len(args) == 1:
-            # Attack is the same id
-            self.int32(0)
-            self.int8(args[0])
-        
-        elif self == C_MSG:
-            assert len(args) == 1, 'This message only has one blank!'
-            self.int16(len(args[0]) + 4)
-            self.string(args[0])
-        
-        elif self == C_WHISPER:
-            nick, msg = args
-            self.int16(len(msg) + 28)
-            try:
-                self.string(nick, 24)
-            except Exception:
-                print(' '.join('%02x' % ord(c) for c in self.data))
-                print(' '.join('%02x' % ord(c) for c in nick))
-                raise
-            self.string(msg)
-        
-        elif self == C_FACE:
-            assert len(args) == 1, 'This message only has one blank!'
-            self.int16(0)
-            self.int8(args[0])
-        
-        elif self == C_EMOTE:
-            assert len(args) == 1, 'This message only has one blank!'
-            self.int8(args[0])
-        
-        elif self == C_RESPAWN:
-            assert not args, 'This message does not have any blanks!'
-            self.int8(0)
-        
-        elif self == C_ATTACK:
-            being_id, keep = args
-            self.int32(being_id)
-            self.int8(7 if keep else 0)
-            print(repr(self.data))
-        
-        elif self == C_GOTO:
-            self.coords(*args)
-        
-        elif self == C_NAME_REQ:
-            assert len(args) == 1, 'This message only has one blank!'
-            self.int32(args[0])
-        
-        else:
+        spec = _out_specs.get(self.packet_id)
+        if spec is None:
             # That is, or we know not how to use this message ID...
             assert not args, 'This message does not have any blanks!'
+        else:
+            self.data = spec.encode(args)
     
     def send(self, conn):
         conn.sendall(self.data)
+        BYTES_OUT.inc(len(self.data))
     
     def int8(self, i):
         self.data += chr(i)
@@ -402,38 +466,110 @@ class PacketOut(object):
 
 
 class PacketBuffer(object):
-    def __init__(self):
+    
+    """
+    Frames the in-coming byte stream into `PacketIn`s.
+    
+    Data is received straight into a preallocated `bytearray` arena, and each 
+    packet handed out is a memoryview slice of it, so framing a burst copies 
+    nothing. Since handed-out packets may still be parsed on other threads, 
+    the arena is never written twice: when it runs out of room, a new one is 
+    allocated and only the unconsumed tail (at most a partial packet, usually) 
+    is moved over. The old arena lives on for as long as its packets do.
+    """
+    
+    def __init__(self, size=65536):
+        """
+        size -- The initial (and minimum) arena size in bytes.
+        """
+        self.size = size
+        # The packet IDs worth handing out, or None for all of them. Others 
+        # are skipped by length alone, and counted per ID in `skipped`.
+        self.wanted = None
+        self.skipped = {}
+        # Called with every framed packet's memoryview, wanted or not
+        self.tap = None
         self.reset()
     
     def reset(self):
-        self.buff = ''
-
+        self.buff = bytearray(self.size)
+        self.view = memoryview(self.buff)
+        self.start = self.end = 0
+    
+    def __len__(self):
+        """
+        Get the number of buffered bytes not yet handed out.
+        """
+        return self.end - self.start
+    
+    def reserve(self, count):
+        """
+        Make sure there is room for `count` more bytes at the end of the 
+        buffer, moving to a new arena if needed.
+        """
+        if self.end + count <= len(self.buff):
+            return
+        
+        pending = self.end - self.start
+        size = self.size
+        while size < pending + count:
+            size *= 2
+        
+        buff = bytearray(size)
+        buff[:pending] = self.view[self.start:self.end]
+        self.buff = buff
+        self.view = memoryview(buff)
+        self.start = 0
+        self.end = pending
+    
     def feed(self, data):
-        self.buff += data
-
+        count = len(data)
+        self.reserve(count)
+        self.buff[self.end:self.end + count] = data
+        self.end += count
+    
+    def recv_into(self, conn, count=4096):
+        """
+        Receive up to `count` bytes from socket `conn` directly into the 
+        buffer. Returns the number of bytes received, 0 meaning EOF.
+        """
+        self.reserve(count)
+        received = conn.recv_into(self.view[self.end:self.end + count], count)
+        self.end += received
+        return received
+    
     def drop(self, count):
-        self.buff = self.buff[count:]
-
+        self.start = min(self.start + count, self.end)
+    
     def __iter__(self):
         return self
-
+    
     def next(self):
-        if len(self.buff) < 2:
-            raise StopIteration
-
-        pkttype = struct.unpack('<H', self.buff[:2])[0]
-        assert pkttype < len(packet_lengths)
-        assert packet_lengths[pkttype] != 0
-        if packet_lengths[pkttype] < 0:
-            if len(self.buff) < 4:
+        while True:
+            start = self.start
+            avail = self.end - start
+            if avail < 2:
                 raise StopIteration
-            pktlen = struct.unpack('<H', self.buff[2:4])[0]
-            assert pktlen >= 4
-        else:
+            
+            pkttype = _uint16.unpack_from(self.buff, start)[0]
+            assert pkttype < len(packet_lengths)
             pktlen = packet_lengths[pkttype]
-
-        if len(self.buff) < pktlen:
-            raise StopIteration
-        packet = self.buff[:pktlen]
-        self.buff = self.buff[pktlen:]
-        return PacketIn(packet)
+            assert pktlen != 0
+            if pktlen < 0:
+                if avail < 4:
+                    raise StopIteration
+                pktlen = _uint16.unpack_from(self.buff, start + 2)[0]
+                assert pktlen >= 4
+            
+            if avail < pktlen:
+                raise StopIteration
+            self.start = start + pktlen
+            
+            if self.tap:
+                self.tap(self.view[start:self.start])
+            
+            wanted = self.wanted
+            if wanted is None or pkttype in wanted:
+                return PacketIn(self.view[start:self.start])
+            self.skipped[pkttype] = self.skipped.get(pkttype, 0) + 1
+    __next__ = next